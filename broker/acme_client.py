@@ -1,20 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-import time
+from email.utils import parsedate_to_datetime
+import threading
 
-from acme.client import ClientV2
+import josepy
+import OpenSSL
+from acme.client import ClientNetwork, ClientV2
 from acme import messages
-from acme import errors
+
+from broker import rate_limit
+from broker.extensions import config
+
+
+class ThreadSafeClientNetwork(ClientNetwork):
+    """
+    A ClientNetwork that can be shared between threads. The stock one keeps
+    its replay nonces in a set that two threads can race to pop from.
+
+    Every request also waits its turn under the ACME rate limit shared by all
+    workers (see broker.rate_limit).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._nonce_lock = threading.RLock()
+
+    def _add_nonce(self, response):
+        with self._nonce_lock:
+            return super()._add_nonce(response)
+
+    def _get_nonce(self, url, new_nonce_url):
+        with self._nonce_lock:
+            return super()._get_nonce(url, new_nonce_url)
+
+    def _send_request(self, method, url, *args, **kwargs):
+        rate_limit.wait_for_token("acme")
+        return super()._send_request(method, url, *args, **kwargs)
+
+
+def in_parallel(fn, items):
+    """
+    Call fn on every item, at most ACME_MAX_CONCURRENT_REQUESTS at a time.
+    Returns a list of (item, result, exception), in the same order as items.
+    """
+    items = list(items)
+    if not items:
+        return []
+    workers = min(config.ACME_MAX_CONCURRENT_REQUESTS, len(items))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fn, item) for item in items]
+    results = []
+    for item, future in zip(items, futures):
+        exception = future.exception()
+        result = None if exception else future.result()
+        results.append((item, result, exception))
+    return results
+
+
+def retry_after_seconds(response, default: int = 1) -> float:
+    """How long the server asked us to wait with Retry-After, in seconds"""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return default
+    try:
+        return max(0, int(retry_after))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return default
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0, (when - now).total_seconds())
 
 
 class AcmeClient(ClientV2):
-    def get_cert_for_finalized_order(self, orderr, deadline):
-        while datetime.datetime.now() < deadline:
-            time.sleep(1)
-            response = self._post_as_get(orderr.uri)
-            body = messages.Order.from_json(response.json())
-            if body.error is not None:
-                raise errors.IssuanceError(body.error)
-            if body.certificate is not None:
-                certificate_response = self._post_as_get(body.certificate).text
-                return orderr.update(body=body, fullchain_pem=certificate_response)
-        raise errors.TimeoutError()
+    """
+    Besides the stock client, this has single-request methods for driving an
+    order through its states (pending -> ready -> processing -> valid)
+    without blocking while the CA works on it.
+    """
+
+    def refresh_order(self, orderr):
+        """Fetch the order's current state, and how long to wait before asking again"""
+        response = self._post_as_get(orderr.uri)
+        body = messages.Order.from_json(response.json())
+        return orderr.update(body=body), retry_after_seconds(response)
+
+    def begin_finalization(self, orderr):
+        """
+        Send the CSR for a ready order. The CA may issue the certificate right
+        away, or move the order to processing and issue it later.
+        """
+        csr = OpenSSL.crypto.load_certificate_request(
+            OpenSSL.crypto.FILETYPE_PEM, orderr.csr_pem
+        )
+        wrapped_csr = messages.CertificateRequest(csr=josepy.ComparableX509(csr))
+        response = self._post(orderr.body.finalize, wrapped_csr)
+        body = messages.Order.from_json(response.json())
+        return orderr.update(body=body), retry_after_seconds(response)
+
+    def fetch_certificate(self, orderr):
+        """Download the certificate for a valid order"""
+        fullchain_pem = self._post_as_get(orderr.body.certificate).text
+        return orderr.update(fullchain_pem=fullchain_pem)
+
+    def failed_authorizations(self, orderr):
+        """The authorizations of an invalid order that failed validation"""
+
+        def fetch(url):
+            return self._authzr_from_response(self._post_as_get(url), uri=url)
+
+        failed = []
+        for url, authzr, exception in in_parallel(fetch, orderr.body.authorizations):
+            if exception is not None:
+                raise exception
+            if authzr.body.status == messages.STATUS_INVALID:
+                failed.append(authzr)
+        return failed
@@ -1,3 +1,4 @@
+from datetime import datetime, timedelta, timezone
 import logging
 from typing import Optional
 
@@ -23,10 +24,17 @@ from openbrokerapi.service_broker import (
 from openbrokerapi.helper import to_json_response
 from openbrokerapi.response import ErrorResponse
 from sap import cf_logging
+from sqlalchemy.exc import IntegrityError
 
 
 from broker import validators
-from broker.extensions import config, db
+from broker.extensions import (
+    config,
+    current_wal_lsn,
+    db,
+    read_replica,
+    replica_configured,
+)
 from broker.models import (
     Operation,
     ALBServiceInstance,
@@ -46,6 +54,7 @@ from broker.tasks.pipelines import (
     queue_all_cdn_broker_migration_tasks_for_operation,
     queue_all_domain_broker_migration_tasks_for_operation,
 )
+from broker.tasks.huey import huey
 
 ALB_PLAN_ID = "6f60835c-8964-4f1f-a19a-579fb27ce694"
 CDN_PLAN_ID = "1cc78b0c-c296-48f5-9182-0b38404f79ef"
@@ -104,25 +113,26 @@ class API(ServiceBroker):
         :rtype: LastOperation
         """
 
-        instance = ServiceInstance.query.get(instance_id)
+        with read_replica(min_lsn=last_write_lsn(instance_id)):
+            instance = ServiceInstance.query.get(instance_id)
 
-        if not instance:
-            raise errors.ErrInstanceDoesNotExist
+            if not instance:
+                raise errors.ErrInstanceDoesNotExist
 
-        if not operation_data:
-            raise errors.ErrBadRequest(msg="Missing operation ID")
+            if not operation_data:
+                raise errors.ErrBadRequest(msg="Missing operation ID")
 
-        operation = instance.operations.filter_by(id=int(operation_data)).first()
+            operation = instance.operations.filter_by(id=int(operation_data)).first()
 
-        if not operation:
-            raise errors.ErrBadRequest(
-                msg=f"Invalid operation id {operation_data} for service {instance_id}"
-            )
+            if not operation:
+                raise errors.ErrBadRequest(
+                    msg=f"Invalid operation id {operation_data} for service {instance_id}"
+                )
 
-        return LastOperation(
-            state=Operation.States(operation.state),
-            description=operation.step_description,
-        )
+            return LastOperation(
+                state=Operation.States(operation.state),
+                description=operation.step_description,
+            )
 
     def provision(
         self, instance_id: str, details: ProvisionDetails, async_allowed: bool, **kwargs
@@ -137,10 +147,16 @@ class API(ServiceBroker):
         if not domain_names:
             raise errors.ErrBadRequest("'domains' parameter required.")
 
-        self.logger.info("validating CNAMEs")
-        validators.CNAME(domain_names).validate()
-        self.logger.info("validating unique domains")
-        validators.UniqueDomains(domain_names).validate()
+        # migration instances are created synchronously, so always validate them here
+        validate_async = (
+            config.ASYNC_PROVISION_VALIDATION and details.plan_id != MIGRATION_PLAN_ID
+        )
+        unique_domains = validators.UniqueDomains(domain_names)
+        if not validate_async:
+            self.logger.info("validating CNAMEs")
+            validators.CNAME(domain_names).validate()
+            self.logger.info("validating unique domains")
+            unique_domains.validate()
 
         if details.plan_id == CDN_PLAN_ID:
             instance = provision_cdn_instance(instance_id, domain_names, params)
@@ -168,10 +184,23 @@ class API(ServiceBroker):
             step_description="Queuing tasks",
         )
 
+        if validate_async:
+            # the rest of the validation happens in the pipeline
+            self.logger.info("reserving domains")
+            unique_domains.reserve(instance)
+
         db.session.add(instance)
         db.session.add(operation)
         self.logger.info("committing db session")
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if validate_async:
+                # someone else reserved one of our domains since we checked
+                unique_domains.check_reservations(instance_id)
+            raise
+        remember_write(instance_id)
         self.logger.info("queueing tasks")
         queue(operation.id, cf_logging.FRAMEWORK.context.get_correlation_id())
         self.logger.info("all done. Returning provisioned service spec")
@@ -202,6 +231,7 @@ class API(ServiceBroker):
 
         db.session.add(operation)
         db.session.commit()
+        remember_write(instance_id)
         if details.plan_id == CDN_PLAN_ID:
             queue_all_cdn_deprovision_tasks_for_operation(
                 operation.id, cf_logging.FRAMEWORK.context.get_correlation_id()
@@ -237,7 +267,9 @@ class API(ServiceBroker):
             raise errors.ErrBadRequest("Instance has an active operation in progress")
 
         domain_names = parse_domain_options(params)
+        previous_domain_names = instance.domain_names
         noop = True
+        unique_domains = None
         if domain_names is not None:
             self.logger.info("validating CNAMEs")
             validators.CNAME(domain_names).validate()
@@ -245,9 +277,10 @@ class API(ServiceBroker):
             self.logger.info("validating unique domains")
             validators.UniqueDomains(domain_names).validate(instance)
             noop = noop and (sorted(domain_names) == sorted(instance.domain_names))
-            if instance.instance_type == "cdn_service_instance" and noop:
-                instance.new_certificate = instance.current_certificate
             instance.domain_names = domain_names
+            if instance.domain_reservations:
+                unique_domains = validators.UniqueDomains(domain_names)
+                unique_domains.reserve(instance)
 
         if instance.instance_type == "cdn_service_instance":
             # N.B. we're using "param" in params rather than
@@ -303,10 +336,12 @@ class API(ServiceBroker):
                 instance.error_responses = params["error_responses"]
                 validators.ErrorResponseConfig(instance.error_responses).validate()
 
+            reuse_current_certificate(instance, previous_domain_names)
             queue = queue_all_cdn_update_tasks_for_operation
         elif instance.instance_type == "alb_service_instance":
             if details.plan_id != ALB_PLAN_ID:
                 raise ClientError("Updating service plan is not supported")
+            reuse_current_certificate(instance, previous_domain_names)
             queue = queue_all_alb_update_tasks_for_operation
         elif instance.instance_type == "migration_service_instance":
             if details.plan_id == CDN_PLAN_ID:
@@ -340,7 +375,15 @@ class API(ServiceBroker):
         )
         db.session.add(operation)
         db.session.add(instance)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if unique_domains is not None:
+                # someone else reserved one of our domains since we checked
+                unique_domains.check_reservations(instance_id)
+            raise
+        remember_write(instance_id)
 
         queue(operation.id, cf_logging.FRAMEWORK.context.get_correlation_id())
 
@@ -367,6 +410,28 @@ class API(ServiceBroker):
         pass
 
 
+def _last_write_key(instance_id: str) -> str:
+    return f"instance_last_write_lsn:{instance_id}"
+
+
+def remember_write(instance_id: str):
+    """
+    Remember where the database was after we changed this instance, so
+    last_operation doesn't read from a replica that hasn't caught up yet
+    """
+    if replica_configured():
+        huey.storage.conn.set(
+            _last_write_key(instance_id), current_wal_lsn(), ex=60 * 60
+        )
+
+
+def last_write_lsn(instance_id: str) -> Optional[str]:
+    if not replica_configured():
+        return None
+    lsn = huey.storage.conn.get(_last_write_key(instance_id))
+    return lsn.decode() if lsn else None
+
+
 def parse_cookie_options(params):
     forward_cookies = params.get("forward_cookies", None)
     if forward_cookies is not None:
@@ -413,6 +478,25 @@ def parse_domain_options(params):
         return [d.strip().lower() for d in domains]
 
 
+def reuse_current_certificate(instance, previous_domain_names):
+    """
+    Have the update use the current certificate, rather than getting a new one,
+    if it covers exactly the domains and isn't due for renewal
+    """
+    certificate = instance.current_certificate
+    if certificate is None or certificate.expires_at is None:
+        return
+    # certificates from before we recorded their SANs were issued for the
+    # domains the instance had before this update
+    covered = certificate.subject_alternative_names or previous_domain_names
+    if sorted(covered or []) != sorted(instance.domain_names):
+        return
+    margin = timedelta(days=config.CERTIFICATE_RENEWAL_MARGIN_IN_DAYS)
+    if certificate.expires_at - margin <= datetime.now(timezone.utc):
+        return
+    instance.new_certificate = certificate
+
+
 def provision_cdn_instance(instance_id: str, domain_names: list, params: dict):
     instance = CDNServiceInstance(id=instance_id, domain_names=domain_names)
     queue = queue_all_cdn_provision_tasks_for_operation
@@ -11,7 +11,7 @@ from sap.cf_logging import flask_logging
 
 # We need to import models, even though it's unused, in order to enable
 # `flask db migrate`
-from broker import models  # noqa: F401
+from broker import instrumentation, models  # noqa: F401
 from broker.api import API, ClientError
 from broker.extensions import config, db, migrate
 
@@ -25,6 +25,7 @@ def create_app():
 
     db.init_app(app)
     migrate.init_app(app, db)
+    instrumentation.init_app(app)
 
     credentials = openbrokerapi.BrokerCredentials(
         app.config["BROKER_USERNAME"], app.config["BROKER_PASSWORD"]
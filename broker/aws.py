@@ -1,22 +1,97 @@
-import boto3
-import botocore
+"""
+boto3 clients for the AWS services we use, e.g. `aws.route53`.
 
+Importing boto3 and building clients is slow, and most processes that import
+this module (like the web app, which only queues tasks) never call AWS. So
+each client is created the first time it's used, and then reused.
+"""
+
+import logging
+import threading
+import time
+
+from broker import rate_limit
 from broker.extensions import config
 
-commercial_session = boto3.Session(
-    region_name=config.AWS_COMMERCIAL_REGION,
-    aws_access_key_id=config.AWS_COMMERCIAL_ACCESS_KEY_ID,
-    aws_secret_access_key=config.AWS_COMMERCIAL_SECRET_ACCESS_KEY,
-)
-route53 = commercial_session.client("route53")
-# iam for cloudfront distributions needs to be in commercial
-iam_commercial = commercial_session.client("iam")
-cloudfront = commercial_session.client("cloudfront")
-govcloud_session = boto3.Session(
-    region_name=config.AWS_GOVCLOUD_REGION,
-    aws_access_key_id=config.AWS_GOVCLOUD_ACCESS_KEY_ID,
-    aws_secret_access_key=config.AWS_GOVCLOUD_SECRET_ACCESS_KEY,
-)
-alb = govcloud_session.client("elbv2")
-# iam for albs needs to be govcloud
-iam_govcloud = govcloud_session.client("iam")
+logger = logging.getLogger(__name__)
+
+# (session, service) for each client we expose
+_CLIENTS = {
+    "route53": ("commercial", "route53"),
+    # iam for cloudfront distributions needs to be in commercial
+    "iam_commercial": ("commercial", "iam"),
+    "cloudfront": ("commercial", "cloudfront"),
+    "alb": ("govcloud", "elbv2"),
+    # iam for albs needs to be govcloud
+    "iam_govcloud": ("govcloud", "iam"),
+}
+
+_sessions = {}
+# boto3 sessions aren't thread safe, so only make one client at a time
+_lock = threading.Lock()
+
+
+def _session(name: str):
+    if name not in _sessions:
+        import boto3
+
+        if name == "commercial":
+            _sessions[name] = boto3.Session(
+                region_name=config.AWS_COMMERCIAL_REGION,
+                aws_access_key_id=config.AWS_COMMERCIAL_ACCESS_KEY_ID,
+                aws_secret_access_key=config.AWS_COMMERCIAL_SECRET_ACCESS_KEY,
+            )
+        else:
+            _sessions[name] = boto3.Session(
+                region_name=config.AWS_GOVCLOUD_REGION,
+                aws_access_key_id=config.AWS_GOVCLOUD_ACCESS_KEY_ID,
+                aws_secret_access_key=config.AWS_GOVCLOUD_SECRET_ACCESS_KEY,
+            )
+    return _sessions[name]
+
+
+def _rate_limit(client, service: str, account: str):
+    # before-send runs for every HTTP request, including botocore's own retries
+    def wait_for_token(**kwargs):
+        rate_limit.wait_for_token(service, account)
+
+    client.meta.events.register("before-send", wait_for_token)
+
+
+def __getattr__(name: str):
+    if name not in _CLIENTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _lock:
+        if name not in globals():
+            session, service = _CLIENTS[name]
+            client = _session(session).client(service)
+            _rate_limit(client, service, session)
+            # cache it as a module attribute, so we don't come back here for it
+            globals()[name] = client
+    return globals()[name]
+
+
+def call_with_backoff(
+    method, error_codes, timeout, first_delay=0.5, max_delay=8, **kwargs
+):
+    """
+    Call method(**kwargs), retrying with exponential backoff while it fails with
+    one of error_codes, for up to timeout seconds. This is for waiting on AWS's
+    eventual consistency, like a new IAM certificate becoming visible to ELB, for
+    only as long as it actually takes.
+    """
+    from botocore.exceptions import ClientError
+
+    deadline = time.monotonic() + timeout
+    delay = first_delay
+    while True:
+        try:
+            return method(**kwargs)
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            remaining = deadline - time.monotonic()
+            if code not in error_codes or remaining <= 0:
+                raise
+            logger.info("%s failed with %s, retrying", method.__name__, code)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
@@ -30,14 +30,104 @@ class Config:
         self.cfenv = AppEnv()
         self.FLASK_ENV = self.env("FLASK_ENV")
         self.TMPDIR = self.env("TMPDIR", "/app/tmp/")
+        # the longest we wait for TXT records to show up on every nameserver
+        # before answering ACME challenges anyway
         self.DNS_PROPAGATION_SLEEP_TIME = self.env("DNS_PROPAGATION_SLEEP_TIME", "300")
+        # resolvers to check for TXT records, as host[:port], besides the root
+        # domain's own nameservers
+        self.DNS_PROPAGATION_PUBLIC_RESOLVERS = self.env.list(
+            "DNS_PROPAGATION_PUBLIC_RESOLVERS", []
+        )
         self.CLOUDFRONT_PROPAGATION_SLEEP_TIME = 60  # Seconds
         self.SQLALCHEMY_TRACK_MODIFICATIONS = False
         self.TESTING = True
         self.DEBUG = True
-        self.ACME_POLL_TIMEOUT_IN_SECONDS = self.env("ACME_POLL_TIMEOUT_IN_SECONDS", 90)
+        # how long retrieve_certificate waits on an order the CA is still working
+        # on before giving the worker back and checking again later
+        self.ACME_POLL_TIMEOUT_IN_SECONDS = self.env.int(
+            "ACME_POLL_TIMEOUT_IN_SECONDS", 15
+        )
+        # how long after placing an order we keep checking back on it before
+        # treating it as failed
+        self.ACME_MAX_ORDER_WAIT_IN_SECONDS = self.env.int(
+            "ACME_MAX_ORDER_WAIT_IN_SECONDS", 3600
+        )
+        # how many requests one task makes to the ACME server at once, e.g. when
+        # answering challenges for an instance with many domains
+        self.ACME_MAX_CONCURRENT_REQUESTS = self.env.int(
+            "ACME_MAX_CONCURRENT_REQUESTS", 8
+        )
         self.AWS_POLL_WAIT_TIME_IN_SECONDS = 60
         self.AWS_POLL_MAX_ATTEMPTS = 10
+        # how long a task worker trusts that an operation is not canceled before
+        # checking with the database again
+        self.CANCELED_OPERATIONS_CACHE_TTL_IN_SECONDS = 300
+        # check CNAMEs and domain uniqueness in the provision pipeline instead of
+        # before responding to the provision request
+        self.ASYNC_PROVISION_VALIDATION = self.env.bool(
+            "ASYNC_PROVISION_VALIDATION", False
+        )
+        # finish CDN deprovisioning once the distribution is disabling, and leave
+        # deleting it and its certificates to the reaper in broker.tasks.cron
+        self.CDN_DEPROVISION_REAPER = self.env.bool("CDN_DEPROVISION_REAPER", False)
+        # how long a queued task has to wait to be worth one more priority level
+        # (see broker.tasks.huey.Priority), so background work isn't starved
+        self.TASK_PRIORITY_AGING_SECONDS = self.env.int(
+            "TASK_PRIORITY_AGING_SECONDS", 300
+        )
+        # requests per second to each API, shared by all workers (see
+        # broker.rate_limit). AWS limits are per account, so commercial and
+        # GovCloud each get these.
+        self.RATE_LIMITS = dict(
+            route53=self.env.float("ROUTE53_REQUESTS_PER_SECOND", 4),
+            cloudfront=self.env.float("CLOUDFRONT_REQUESTS_PER_SECOND", 4),
+            iam=self.env.float("IAM_REQUESTS_PER_SECOND", 8),
+            elbv2=self.env.float("ELBV2_REQUESTS_PER_SECOND", 8),
+            acme=self.env.float("ACME_REQUESTS_PER_SECOND", 15),
+        )
+        # callers wait this long for their turn before giving up and retrying later
+        self.RATE_LIMIT_MAX_WAIT_SECONDS = self.env.int(
+            "RATE_LIMIT_MAX_WAIT_SECONDS", 30
+        )
+        # certificates are renewed once they're this close to expiring, and updates
+        # reuse the current certificate if it has longer than this left
+        self.CERTIFICATE_RENEWAL_MARGIN_IN_DAYS = self.env.int(
+            "CERTIFICATE_RENEWAL_MARGIN_IN_DAYS", 30
+        )
+        # queue renewals for instances whose certificates the nightly drift check
+        # finds missing from AWS (see broker.tasks.drift)
+        self.DRIFT_AUTO_REPAIR = self.env.bool("DRIFT_AUTO_REPAIR", False)
+        # server certificates nothing in the database refers to are deleted once
+        # they're this old (see iam.delete_orphaned_server_certificates)
+        self.ORPHANED_CERTIFICATE_GRACE_PERIOD_IN_DAYS = self.env.int(
+            "ORPHANED_CERTIFICATE_GRACE_PERIOD_IN_DAYS", 7
+        )
+        self.IAM_MAX_CONCURRENT_REQUESTS = self.env.int(
+            "IAM_MAX_CONCURRENT_REQUESTS", 4
+        )
+        # AWS's limit on record sets in a hosted zone. We warn when the zone gets
+        # close, since raising it takes a support case.
+        self.ROUTE53_ZONE_RECORD_LIMIT = self.env.int(
+            "ROUTE53_ZONE_RECORD_LIMIT", 10000
+        )
+        # how many certificates' chains deduplicate_certificate_chains moves a minute
+        self.CERTIFICATE_CHAIN_BATCH_SIZE = self.env.int(
+            "CERTIFICATE_CHAIN_BATCH_SIZE", 500
+        )
+        # broker.tasks.retention moves rows older than these out to archived_row:
+        # finished operations, and everything belonging to instances deactivated
+        # this long ago
+        self.OPERATION_RETENTION_DAYS = self.env.int("OPERATION_RETENTION_DAYS", 90)
+        self.DEACTIVATED_INSTANCE_RETENTION_DAYS = self.env.int(
+            "DEACTIVATED_INSTANCE_RETENTION_DAYS", 365
+        )
+        # rows moved per transaction, and how long to wait between transactions
+        self.ARCHIVE_BATCH_SIZE = self.env.int("ARCHIVE_BATCH_SIZE", 1000)
+        self.ARCHIVE_BATCH_PAUSE_SECONDS = self.env.float(
+            "ARCHIVE_BATCH_PAUSE_SECONDS", 1
+        )
+        # how far behind the primary the read replica can be before we stop using it
+        self.REPLICA_MAX_LAG_SECONDS = self.env.int("REPLICA_MAX_LAG_SECONDS", 5)
 
         # https://docs.aws.amazon.com/Route53/latest/APIReference/API_AliasTarget.html
         self.CLOUDFRONT_HOSTED_ZONE_ID = "Z2FDTNDATAQYW2"
@@ -54,6 +144,7 @@ class AppConfig(Config):
         self.BROKER_USERNAME = self.env("BROKER_USERNAME")
         self.BROKER_PASSWORD = self.env("BROKER_PASSWORD")
         self.SQLALCHEMY_DATABASE_URI = normalize_db_url(self.env("DATABASE_URL"))
+        self.SQLALCHEMY_BINDS = replica_binds(self.env("DATABASE_REPLICA_URL", None))
         self.ALB_LISTENER_ARNS = self.env.list("ALB_LISTENER_ARNS")
         self.ALB_LISTENER_ARNS = list(set(self.ALB_LISTENER_ARNS))
         self.AWS_COMMERCIAL_REGION = self.env("AWS_COMMERCIAL_REGION")
@@ -96,6 +187,7 @@ class AppConfig(Config):
         self.SMTP_TO = self.env("SMTP_TO")
         self.SMTP_TLS = True
         self.RUN_CRON = self.env.int("INSTANCE_INDEX", default=1) == 0
+        # the longest we'll wait for IAM certificate changes to reach ELB
         self.IAM_CERTIFICATE_PROPAGATION_TIME = 30
 
 
@@ -151,6 +243,7 @@ class DockerConfig(Config):
     def __init__(self):
         super().__init__()
         self.SQLALCHEMY_DATABASE_URI = f"postgresql://localhost/{self.FLASK_ENV}"
+        self.SQLALCHEMY_BINDS = replica_binds(self.env("DATABASE_REPLICA_URL", None))
         self.REDIS_HOST = "localhost"
         self.REDIS_PORT = 6379
         self.REDIS_PASSWORD = "sekrit"
@@ -158,7 +251,9 @@ class DockerConfig(Config):
         self.BROKER_USERNAME = "broker"
         self.BROKER_PASSWORD = "sekrit"
         self.ACME_DIRECTORY = "https://localhost:14000/dir"
-        self.DNS_VERIFICATION_SERVER = "127.0.0.1:8053"
+        self.DNS_VERIFICATION_SERVER = self.env(
+            "DNS_VERIFICATION_SERVER", "127.0.0.1:8053"
+        )
         self.ROUTE53_ZONE_ID = "TestZoneID"
         self.DNS_ROOT_DOMAIN = "domains.cloud.test"
         self.DATABASE_ENCRYPTION_KEY = "Local Dev Encrytpion Key"
@@ -219,3 +314,10 @@ def normalize_db_url(url):
     if url.split(":")[0] == "postgres":
         url = url.replace("postgres:", "postgresql:", 1)
     return url
+
+
+def replica_binds(replica_url):
+    # the read replica is optional - see broker.extensions.read_replica
+    if not replica_url:
+        return {}
+    return {"replica": normalize_db_url(replica_url)}
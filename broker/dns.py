@@ -1,17 +1,37 @@
-import dns.resolver
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+from typing import Dict, List
 
 from broker.extensions import config
 
-(_nameserver, _port) = config.DNS_VERIFICATION_SERVER.split(":")
+logger = logging.getLogger(__name__)
+
 _root_dns = config.DNS_ROOT_DOMAIN
-_resolver = dns.resolver.Resolver(configure=False)
-_resolver.nameservers = [_nameserver]
-_resolver.port = int(_port)
+# built on first use - see _get_resolver
+_resolver = None
+
+
+def _get_resolver():
+    # dnspython is imported when it's first needed, like the resolver: it brings
+    # in requests_toolbelt and OpenSSL, which the web app doesn't otherwise need
+    import dns.resolver
+
+    global _resolver
+    if _resolver is None:
+        (nameserver, port) = config.DNS_VERIFICATION_SERVER.split(":")
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = [nameserver]
+        resolver.port = int(port)
+        _resolver = resolver
+    return _resolver
 
 
 def get_cname(domain: str) -> str:
+    import dns.resolver
+
     try:
-        answers = _resolver.resolve(domain, "CNAME")
+        answers = _get_resolver().resolve(domain, "CNAME")
 
         return answers[0].target.to_text(omit_final_dot=True)
 
@@ -28,3 +48,90 @@ def acme_challenge_cname_target(domain: str) -> str:
 
 def acme_challenge_cname_name(domain: str) -> str:
     return f"_acme-challenge.{domain}"
+
+
+def _parse_nameserver(nameserver: str):
+    host, _, port = nameserver.partition(":")
+    return host, int(port or 53)
+
+
+def authoritative_nameservers(zone: str) -> List[str]:
+    """The addresses of the nameservers for zone, as host:port"""
+    resolver = _get_resolver()
+    addresses = []
+    for ns in resolver.resolve(zone, "NS"):
+        for a in resolver.resolve(ns.target, "A"):
+            addresses.append(f"{a.address}:53")
+    return addresses
+
+
+def get_txt_values(name: str, nameserver: str) -> set:
+    """Ask one nameserver directly, without recursion or caching, for name's TXT values"""
+    import dns.message
+    import dns.query
+    import dns.rdatatype
+
+    host, port = _parse_nameserver(nameserver)
+    query = dns.message.make_query(name, dns.rdatatype.TXT)
+    response = dns.query.udp(query, host, port=port, timeout=2)
+    values = set()
+    for rrset in response.answer:
+        if rrset.rdtype == dns.rdatatype.TXT:
+            for rdata in rrset:
+                values.add(b"".join(rdata.strings).decode())
+    return values
+
+
+def wait_for_txt_records(
+    records: Dict[str, str], timeout: float, interval: float = 5, nameservers=None
+) -> bool:
+    """
+    Wait until every nameserver serves every record (a dict of name: value),
+    for at most `timeout` seconds. Returns whether they all did.
+
+    By default, we check the authoritative nameservers for DNS_ROOT_DOMAIN,
+    plus any resolvers in DNS_PROPAGATION_PUBLIC_RESOLVERS.
+    """
+    import dns.exception
+
+    deadline = time.monotonic() + timeout
+    if timeout <= 0 or not records:
+        return not records
+    if nameservers is None:
+        try:
+            nameservers = authoritative_nameservers(_root_dns)
+        except dns.exception.DNSException as e:
+            logger.warning(f"could not find nameservers for {_root_dns}: {e}")
+            nameservers = []
+        nameservers += config.DNS_PROPAGATION_PUBLIC_RESOLVERS
+    if not nameservers:
+        # nothing to check, so wait as long as we're allowed to
+        time.sleep(timeout)
+        return False
+
+    waiting_for = [
+        (name, value, nameserver)
+        for name, value in records.items()
+        for nameserver in nameservers
+    ]
+
+    def visible(check):
+        name, value, nameserver = check
+        try:
+            return value in get_txt_values(name, nameserver)
+        except (dns.exception.DNSException, OSError):
+            return False
+
+    with ThreadPoolExecutor(max_workers=min(16, len(waiting_for))) as executor:
+        while True:
+            results = list(executor.map(visible, waiting_for))
+            waiting_for = [
+                check for check, found in zip(waiting_for, results) if not found
+            ]
+            if not waiting_for:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.info(f"still waiting for TXT records: {waiting_for}")
+                return False
+            time.sleep(min(interval, remaining))
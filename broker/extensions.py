@@ -1,8 +1,121 @@
+from collections import Counter
+from contextlib import contextmanager
+import contextvars
+import logging
+
+from flask import current_app
 from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm, text
 
 from broker.config import config_from_env
 
+logger = logging.getLogger(__name__)
+
 config = config_from_env()
-db = SQLAlchemy()
 migrate = Migrate()
+
+# the bind key for the read replica in SQLALCHEMY_BINDS
+REPLICA_BIND = "replica"
+
+# whether the current block of code asked to read from the replica
+_reading_from_replica = contextvars.ContextVar("reading_from_replica", default=False)
+
+# how many read_replica blocks used the replica, and why the others didn't.
+# These are per process, and also logged so they show up in our log metrics.
+replica_stats = Counter()
+
+
+class RoutingSession(SignallingSession):
+    """
+    Sends reads inside a read_replica block to the replica. Anything written
+    in those blocks still goes to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, *args, **kwargs):
+        # SQLAlchemy 1.4 also passes bind and some private arguments, which
+        # flask-sqlalchemy's get_bind doesn't take
+        if bind is not None:
+            return bind
+        if _reading_from_replica.get() and not self._flushing:
+            return db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+def replica_configured() -> bool:
+    return REPLICA_BIND in (current_app.config.get("SQLALCHEMY_BINDS") or {})
+
+
+def _replica_is_current(min_lsn: str = None) -> bool:
+    """
+    Check that the replica has replayed min_lsn, if given, and is not lagging
+    more than REPLICA_MAX_LAG_SECONDS behind the primary.
+    """
+    engine = db.get_engine(current_app, bind=REPLICA_BIND)
+    with engine.connect() as connection:
+        # these are all NULL when we're not actually talking to a standby,
+        # in which case we're as current as we can be
+        replayed, lag = connection.execute(
+            text("""
+                SELECT
+                    pg_last_wal_replay_lsn() >= CAST(:min_lsn AS pg_lsn),
+                    CASE
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+                    END
+                """),
+            dict(min_lsn=min_lsn or "0/0"),
+        ).one()
+    if replayed is False:
+        return False
+    return lag is None or lag <= config.REPLICA_MAX_LAG_SECONDS
+
+
+def current_wal_lsn() -> str:
+    """The primary's current WAL position, for passing to read_replica later"""
+    return db.session.execute(
+        text("SELECT CAST(pg_current_wal_lsn() AS text)")
+    ).scalar()
+
+
+@contextmanager
+def read_replica(min_lsn: str = None):
+    """
+    Send reads in this block to the read replica, if there is one and it is
+    current enough. Otherwise, the reads go to the primary as usual.
+
+    Only use this for code that doesn't write, or doesn't mind reading data a
+    little older than the primary's. Pass min_lsn (from current_wal_lsn) to make
+    sure the replica has at least caught up with a given write.
+    """
+    if not replica_configured():
+        use_replica = False
+        replica_stats["primary_no_replica"] += 1
+    else:
+        try:
+            use_replica = _replica_is_current(min_lsn)
+        except Exception as e:
+            logger.warning("could not check read replica, using primary: %s", e)
+            use_replica = False
+            replica_stats["primary_replica_error"] += 1
+        else:
+            replica_stats["replica" if use_replica else "primary_replica_lag"] += 1
+        log = logger.debug if use_replica else logger.info
+        log(
+            "reading from %s",
+            "replica" if use_replica else "primary",
+            extra=dict(replica_stats=dict(replica_stats)),
+        )
+    token = _reading_from_replica.set(use_replica)
+    try:
+        yield use_replica
+    finally:
+        _reading_from_replica.reset(token)
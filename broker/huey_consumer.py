@@ -1,3 +1,2 @@
-from broker.app import create_app
 from broker.tasks.huey import huey  # noqa F401
 from broker.tasks import pipelines, cron  # noqa F401
@@ -0,0 +1,92 @@
+"""
+Counts database queries and time spent in the database, per code path.
+
+A code path is the OSBAPI endpoint handling the current request (e.g.
+`open_broker.provision`) or the name of the huey task being run (e.g.
+`create_user`). Queries outside of either are counted under `None`.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import contextvars
+import time
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_code_path = contextvars.ContextVar("code_path", default=None)
+
+# per-process totals, for looking at from a shell or logging
+query_stats = defaultdict(lambda: dict(queries=0, seconds=0.0))
+
+# stats dicts currently collecting queries - see recording()
+_recorders = []
+
+
+def current_code_path():
+    return _code_path.get()
+
+
+def enter_code_path(name: str):
+    """Attribute queries to `name` until exit_code_path is called with the result"""
+    return _code_path.set(name)
+
+
+def exit_code_path(token):
+    _code_path.reset(token)
+
+
+@contextmanager
+def code_path(name: str):
+    token = enter_code_path(name)
+    try:
+        yield
+    finally:
+        exit_code_path(token)
+
+
+@contextmanager
+def recording():
+    """
+    Collect query stats for every code path run inside this block, separately
+    from the per-process totals.
+    """
+    stats = defaultdict(lambda: dict(queries=0, seconds=0.0))
+    _recorders.append(stats)
+    try:
+        yield stats
+    finally:
+        _recorders.remove(stats)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_times", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start_times"].pop()
+    path = _code_path.get()
+    for stats in [query_stats] + _recorders:
+        stats[path]["queries"] += 1
+        stats[path]["seconds"] += elapsed
+
+
+def _enter_endpoint():
+    request.environ["broker.code_path_token"] = enter_code_path(request.endpoint)
+
+
+def _exit_endpoint(exc=None):
+    token = request.environ.pop("broker.code_path_token", None)
+    if token is not None:
+        exit_code_path(token)
+
+
+def init_app(app):
+    app.before_request(_enter_endpoint)
+    app.teardown_request(_exit_endpoint)
+
+
+if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
@@ -1,5 +1,8 @@
 from enum import Enum
+import hashlib
+
 from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import deferred, load_only
 
 from openbrokerapi.service_broker import OperationState
 from sqlalchemy_utils.types.encrypted.encrypted_type import (
@@ -27,43 +30,108 @@ class ACMEUser(Base):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String, nullable=False)
     uri = db.Column(db.String, nullable=False)
-    private_key_pem = db.Column(
-        StringEncryptedType(db.Text, db_encryption_key, AesGcmEngine, "pkcs5"),
-        nullable=False,
+    # only the ACME tasks need these, and the key has to be decrypted
+    private_key_pem = deferred(
+        db.Column(
+            StringEncryptedType(db.Text, db_encryption_key, AesGcmEngine, "pkcs5"),
+            nullable=False,
+        ),
+        group="key",
     )
 
-    registration_json = db.Column(db.Text)
+    registration_json = deferred(db.Column(db.Text), group="key")
     service_instances = db.relation(
         "ServiceInstance", backref="acme_user", lazy="dynamic"
     )
 
 
+class CertificateChain(Base):
+    # the intermediates, which nearly every certificate shares with lots of
+    # others, so each chain is stored once
+    __tablename__ = "certificate_chain"
+
+    sha256 = db.Column(db.String(64), primary_key=True)
+    pem = db.Column(db.Text, nullable=False)
+
+    @classmethod
+    def for_pem(cls, pem: str) -> "CertificateChain":
+        sha256 = hashlib.sha256(pem.encode()).hexdigest()
+        # we can be called while the certificate is still being built
+        with db.session.no_autoflush:
+            chain = cls.query.get(sha256)
+            if chain is None:
+                # another worker may be storing the same chain right now
+                db.session.execute(
+                    postgresql.insert(cls)
+                    .values(sha256=sha256, pem=pem)
+                    .on_conflict_do_nothing()
+                )
+                chain = cls.query.get(sha256)
+        return chain
+
+    def __repr__(self):
+        return f"<CertificateChain {self.sha256}>"
+
+
 class Certificate(Base):
     id = db.Column(db.Integer, primary_key=True)
     service_instance_id = db.Column(
         db.String, db.ForeignKey("service_instance.id"), nullable=False
     )
     subject_alternative_names = db.Column(postgresql.JSONB, default=[])
-    leaf_pem = db.Column(db.Text)
+    # The PEMs are big, and the key has to be decrypted, so they're only loaded
+    # (together) when something uses one. Most things only want the IAM names.
+    leaf_pem = deferred(db.Column(db.Text), group="pem")
     expires_at = db.Column(db.TIMESTAMP(timezone=True))
-    private_key_pem = db.Column(
-        StringEncryptedType(db.Text, db_encryption_key, AesGcmEngine, "pkcs5")
+    private_key_pem = deferred(
+        db.Column(
+            StringEncryptedType(db.Text, db_encryption_key, AesGcmEngine, "pkcs5")
+        ),
+        group="pem",
+    )
+    csr_pem = deferred(db.Column(db.Text), group="pem")
+    certificate_chain_sha256 = db.Column(
+        db.String(64),
+        db.ForeignKey(
+            "certificate_chain.sha256",
+            name="fk__certificate__certificate_chain__certificate_chain_sha256",
+        ),
     )
-    csr_pem = db.Column(db.Text)
-    fullchain_pem = db.Column(db.Text)
+    certificate_chain = db.relation(CertificateChain)
+    # where chains were kept before certificate_chain - move_certificate_chains
+    # empties it
+    _fullchain_pem = deferred(db.Column("fullchain_pem", db.Text), group="pem")
     iam_server_certificate_id = db.Column(db.String)
     iam_server_certificate_name = db.Column(db.String)
     iam_server_certificate_arn = db.Column(db.String)
     challenges = db.relation(
         "Challenge", backref="certificate", lazy="dynamic", cascade="all, delete-orphan"
     )
-    order_json = db.Column(db.Text)
+    order_json = deferred(db.Column(db.Text), group="order")
+    # the ACME order's status: pending, ready, processing, valid, or invalid
+    order_status = db.Column(db.String)
+    # when we placed the order, so we know when to stop waiting on it
+    ordered_at = db.Column(db.TIMESTAMP(timezone=True))
+
+    @property
+    def fullchain_pem(self):
+        if self.certificate_chain is not None:
+            return self.certificate_chain.pem
+        return self._fullchain_pem
+
+    @fullchain_pem.setter
+    def fullchain_pem(self, pem):
+        self.certificate_chain = None if pem is None else CertificateChain.for_pem(pem)
+        self._fullchain_pem = None
 
 
 class ServiceInstance(Base):
     __tablename__ = "service_instance"
     id = db.Column(db.String(36), primary_key=True)
     operations = db.relation("Operation", backref="service_instance", lazy="dynamic")
+    domain_reservations = db.relation(
+        "DomainReservation", backref="service_instance", cascade="all, delete-orphan"
+    )
     acme_user_id = db.Column(db.Integer, db.ForeignKey("acme_user.id"))
     domain_names = db.Column(postgresql.JSONB, default=[])
     instance_type = db.Column(db.Text)
@@ -112,13 +180,11 @@ class ServiceInstance(Base):
     }
 
     def has_active_operations(self):
-        for operation in self.operations:
-            if (
-                operation.state == Operation.States.IN_PROGRESS.value
-                and operation.canceled_at is None
-            ):
-                return True
-        return False
+        active = self.operations.filter(
+            Operation.state == Operation.States.IN_PROGRESS.value,
+            Operation.canceled_at.is_(None),
+        )
+        return db.session.query(active.exists()).scalar()
 
     def __repr__(self):
         return f"<ServiceInstance {self.id} {self.domain_names}>"
@@ -181,6 +247,7 @@ class Operation(Base):
         RENEW = "Renew"
         UPDATE = "Update"
         MIGRATE_TO_BROKER = "Migrate to broker"
+        CLEANUP = "Cleanup"
 
     id = db.Column(db.Integer, primary_key=True)
     service_instance_id = db.Column(
@@ -200,6 +267,54 @@ class Operation(Base):
         return f"<Operation {self.id} {self.state}>"
 
 
+class DomainReservation(Base):
+    # claims a domain for a service instance while its domains are validated
+    # asynchronously. The primary key keeps concurrent provisions from both
+    # claiming the same domain.
+    __tablename__ = "domain_reservation"
+
+    domain = db.Column(db.String, primary_key=True)
+    service_instance_id = db.Column(
+        db.String, db.ForeignKey("service_instance.id"), nullable=False, index=True
+    )
+
+    def __repr__(self):
+        return f"<DomainReservation {self.domain} {self.service_instance_id}>"
+
+
+class Route53Record(Base):
+    # our copy of a record set in config.ROUTE53_ZONE_ID, kept current by
+    # broker.tasks.route53, so we can tell what's in the zone without asking AWS.
+    # record_set holds just the parts we compare (see route53.indexed), or is
+    # empty for one we deleted since the last listing (see route53.DELETED).
+    __tablename__ = "route53_record"
+
+    name = db.Column(db.String, primary_key=True)
+    type = db.Column(db.String, primary_key=True)
+    record_set = db.Column(postgresql.JSONB, nullable=False)
+
+    def __repr__(self):
+        return f"<Route53Record {self.name} {self.type}>"
+
+
+class ArchivedRow(Base):
+    # a row broker.tasks.retention moved out of one of the other tables, as it
+    # was when it was moved
+    __tablename__ = "archived_row"
+
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String, nullable=False)
+    row_id = db.Column(db.String, nullable=False)
+    data = db.Column(postgresql.JSONB, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_archived_row_table_name_row_id", table_name, row_id),
+    )
+
+    def __repr__(self):
+        return f"<ArchivedRow {self.table_name} {self.row_id}>"
+
+
 class Challenge(Base):
     id = db.Column(db.Integer, primary_key=True)
     certificate_id = db.Column(
@@ -215,6 +330,26 @@ class Challenge(Base):
         return f"<Challenge {self.id} {self.domain}>"
 
 
+def move_certificate_chains(batch_size: int) -> int:
+    """
+    Move up to batch_size chains from their certificates into
+    certificate_chain, and return how many were moved
+    """
+    certificates = (
+        Certificate.query.options(load_only(Certificate._fullchain_pem))
+        .filter(Certificate._fullchain_pem.isnot(None))
+        .order_by(Certificate.id)
+        .limit(batch_size)
+        # so we don't wait on certificates a task is working on
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    for certificate in certificates:
+        certificate.fullchain_pem = certificate._fullchain_pem
+    db.session.commit()
+    return len(certificates)
+
+
 def change_instance_type(service_instance: ServiceInstance, new_type: type, session):
     """
     creates a new service instance of a given type based on an old service instance.
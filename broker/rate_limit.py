@@ -0,0 +1,85 @@
+"""
+Rate limits for the APIs we call, shared by every worker through Redis.
+
+Each limit is a token bucket that refills at config.RATE_LIMITS[service] tokens
+per second, and holds at most one second's worth. Taking a token that isn't
+there yet means waiting until it is, so adding workers doesn't add throttling
+errors from AWS or Let's Encrypt.
+"""
+
+import logging
+import threading
+import time
+
+from broker.extensions import config
+
+logger = logging.getLogger(__name__)
+
+# Reserves a token from the bucket in KEYS[1], which refills at ARGV[1] tokens
+# per second, if one will be there within ARGV[2] seconds. Tokens can be
+# reserved before they're there, so the bucket can go negative, and each caller
+# gets its own turn instead of all of them waking up at once to fight over the
+# next token. Returns {1 if reserved else 0, seconds until the token is there}.
+TAKE_TOKEN = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local max_wait = tonumber(ARGV[2])
+local burst = math.max(rate, 1)
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local wait = math.max(0, (1 - tokens) / rate)
+local reserved = 0
+if wait <= max_wait then
+    tokens = tokens - 1
+    reserved = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+return {reserved, tostring(wait)}
+"""
+
+_script = None
+_lock = threading.Lock()
+
+
+class RateLimitExceeded(RuntimeError):
+    pass
+
+
+def _take_token(key: str, rate: float, max_wait: float):
+    global _script
+    from broker.tasks.huey import huey
+
+    with _lock:
+        if _script is None:
+            _script = huey.storage.conn.register_script(TAKE_TOKEN)
+    reserved, wait = _script(keys=[key], args=[rate, max_wait])
+    return bool(reserved), float(wait)
+
+
+def wait_for_token(service: str, account: str = "default"):
+    """
+    Wait until we're allowed another call to service (one of the keys of
+    config.RATE_LIMITS) for account. Raises RateLimitExceeded if that would take
+    longer than config.RATE_LIMIT_MAX_WAIT_SECONDS.
+    """
+    rate = config.RATE_LIMITS.get(service)
+    if not rate:
+        return
+    key = f"rate_limit:{account}:{service}"
+    try:
+        reserved, wait = _take_token(key, rate, config.RATE_LIMIT_MAX_WAIT_SECONDS)
+    except Exception:
+        # better to risk a throttling error than to stop calling the API
+        logger.exception("Failed checking the rate limit for %s", key)
+        return
+    if not reserved:
+        raise RateLimitExceeded(
+            f"Calls to {service} ({account}) are booked up for the next {wait:.0f}s"
+        )
+    if wait:
+        time.sleep(wait)
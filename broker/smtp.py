@@ -1,16 +1,21 @@
+from collections import defaultdict
 from email.mime.text import MIMEText
+import html
+import logging
 import smtplib
 import ssl
+import threading
 
 from broker.extensions import config
 
+logger = logging.getLogger(__name__)
+
+# one connection per process, shared by everything that sends mail
+_connection = None
+_connection_lock = threading.Lock()
 
-def send_email(email, subject, body):
-    msg = MIMEText(body, "html")
-    msg["Subject"] = subject
-    msg["To"] = email
-    msg["From"] = config.SMTP_FROM
 
+def _connect():
     s = smtplib.SMTP(config.SMTP_HOST, config.SMTP_PORT)
 
     # if we have a cert, then trust it
@@ -23,20 +28,88 @@ def send_email(email, subject, body):
     # if smtp credentials were provided, login
     if config.SMTP_USER is not None and config.SMTP_PASS is not None:
         s.login(config.SMTP_USER, config.SMTP_PASS)
+    return s
+
 
-    s.sendmail(config.SMTP_FROM, [email], msg.as_string())
-    s.quit()
+def _get_connection():
+    # must be called with _connection_lock held
+    global _connection
+    if _connection is not None:
+        try:
+            status, _ = _connection.noop()
+        except (smtplib.SMTPException, OSError):
+            status = None
+        if status != 250:
+            _close_connection()
+    if _connection is None:
+        _connection = _connect()
+    return _connection
 
 
-def send_failed_operation_alert(operation):
+def _close_connection():
+    global _connection
+    if _connection is None:
+        return
+    try:
+        _connection.quit()
+    except (smtplib.SMTPException, OSError):
+        _connection.close()
+    _connection = None
+
+
+def send_email(email, subject, body):
+    msg = MIMEText(body, "html")
+    msg["Subject"] = subject
+    msg["To"] = email
+    msg["From"] = config.SMTP_FROM
+
+    with _connection_lock:
+        s = _get_connection()
+        try:
+            s.sendmail(config.SMTP_FROM, [email], msg.as_string())
+        except (smtplib.SMTPServerDisconnected, OSError):
+            # don't leave a dead connection around for the next email
+            _close_connection()
+            raise
+
+
+def build_failed_operations_digest(alerts):
+    """
+    Build the subject and body for one email covering many failed operations.
+    `alerts` are the dicts queued by broker.tasks.huey.queue_failed_operation_alert
+    """
+    groups = defaultdict(list)
+    for alert in alerts:
+        groups[(alert["step_description"], alert["instance_type"])].append(alert)
+
     subject = f"[{config.FLASK_ENV}] - external-domain-broker pipeline failed"
+    if len(alerts) > 1:
+        subject = f"[{config.FLASK_ENV}] - external-domain-broker {len(alerts)} pipelines failed"
+
+    sections = []
+    # biggest groups first - those are the ones that point at an outage
+    for (step, instance_type), group in sorted(
+        groups.items(), key=lambda item: (-len(item[1]), str(item[0]))
+    ):
+        rows = "".join(f"""
+<li>
+operation id: {alert["operation_id"]},
+operation type: {html.escape(str(alert["action"]))},
+service instance id: {html.escape(str(alert["service_instance_id"]))}
+</li>""" for alert in group)
+        sections.append(f"""
+<h2>{len(group)} failed at: {html.escape(str(step))}</h2>
+service instance type: {html.escape(str(instance_type))} <br/>
+<ul>{rows}
+</ul>""")
+
     body = f"""
 <h1>Pipeline failed unexpectedly!</h1>
-
-operation id: {operation.id} <br/>
-operation type: {operation.action} <br/>
-failed step: {operation.step_description} <br/>
-service instance id: {operation.service_instance_id} <br/>
-service instance type: {operation.service_instance.instance_type} <br/>
+{"".join(sections)}
     """
+    return subject, body
+
+
+def send_failed_operations_digest(alerts):
+    subject, body = build_failed_operations_digest(alerts)
     send_email(config.SMTP_TO, subject, body)
@@ -2,9 +2,10 @@ import logging
 import time
 
 from sqlalchemy import and_
+from sqlalchemy.orm import load_only
 from sqlalchemy.orm.attributes import flag_modified
 
-from broker.aws import alb
+from broker import aws
 from broker.extensions import config, db
 from broker.models import ALBServiceInstance, Certificate, Operation
 from broker.tasks import huey
@@ -12,16 +13,34 @@ from broker.tasks import huey
 logger = logging.getLogger(__name__)
 
 
+def list_listener_certificates(listener_arns):
+    """The ARNs of the certificates on each listener, by listener ARN"""
+    certificates = {}
+    for listener_arn in listener_arns:
+        arns = set()
+        kwargs = {}
+        while True:
+            response = aws.alb.describe_listener_certificates(
+                ListenerArn=listener_arn, **kwargs
+            )
+            arns.update(c["CertificateArn"] for c in response["Certificates"])
+            if not response.get("NextMarker"):
+                break
+            kwargs["Marker"] = response["NextMarker"]
+        certificates[listener_arn] = arns
+    return certificates
+
+
 def get_lowest_used_alb(listener_arns):
     https_listeners = []
     for listener_arn in listener_arns:
-        certificates = alb.describe_listener_certificates(ListenerArn=listener_arn)
+        certificates = aws.alb.describe_listener_certificates(ListenerArn=listener_arn)
         https_listeners.append(
             dict(listener_arn=listener_arn, certificates=certificates["Certificates"])
         )
     https_listeners.sort(key=lambda x: len(x["certificates"]))
     selected_arn = https_listeners[0]["listener_arn"]
-    listener_data = alb.describe_listeners(ListenerArns=[selected_arn])
+    listener_data = aws.alb.describe_listeners(ListenerArns=[selected_arn])
     listener_data = listener_data["Listeners"][0]
     return listener_data["LoadBalancerArn"], listener_data["ListenerArn"]
 
@@ -62,11 +81,15 @@ def add_certificate_to_alb(operation_id, **kwargs):
     db.session.add(operation)
     db.session.commit()
 
-    alb.add_listener_certificates(
+    # new IAM certificates take a little while to show up for ELB
+    aws.call_with_backoff(
+        aws.alb.add_listener_certificates,
+        ["CertificateNotFound"],
+        config.IAM_CERTIFICATE_PROPAGATION_TIME,
         ListenerArn=service_instance.alb_listener_arn,
         Certificates=[{"CertificateArn": certificate.iam_server_certificate_arn}],
     )
-    alb_config = alb.describe_load_balancers(
+    alb_config = aws.alb.describe_load_balancers(
         LoadBalancerArns=[service_instance.alb_arn]
     )
     service_instance.domain_internal = alb_config["LoadBalancers"][0]["DNSName"]
@@ -90,7 +113,7 @@ def remove_certificate_from_alb(operation_id, **kwargs):
     db.session.commit()
 
     if service_instance.alb_listener_arn is not None:
-        alb.remove_listener_certificates(
+        aws.alb.remove_listener_certificates(
             ListenerArn=service_instance.alb_listener_arn,
             Certificates=[
                 {
@@ -100,19 +123,22 @@ def remove_certificate_from_alb(operation_id, **kwargs):
         )
     db.session.add(service_instance)
     db.session.commit()
-    time.sleep(config.IAM_CERTIFICATE_PROPAGATION_TIME)
 
 
 @huey.retriable_task
 def remove_certificate_from_previous_alb(operation_id, **kwargs):
     operation = Operation.query.get(operation_id)
     service_instance = operation.service_instance
-    remove_certificate = Certificate.query.filter(
-        and_(
-            Certificate.service_instance_id == service_instance.id,
-            Certificate.id != service_instance.current_certificate_id,
+    remove_certificate = (
+        Certificate.query.options(load_only(Certificate.iam_server_certificate_arn))
+        .filter(
+            and_(
+                Certificate.service_instance_id == service_instance.id,
+                Certificate.id != service_instance.current_certificate_id,
+            )
         )
-    ).first()
+        .first()
+    )
 
     operation.step_description = "Removing SSL certificate from load balancer"
     flag_modified(operation, "step_description")
@@ -122,7 +148,7 @@ def remove_certificate_from_previous_alb(operation_id, **kwargs):
     time.sleep(int(config.DNS_PROPAGATION_SLEEP_TIME))
 
     if service_instance.previous_alb_listener_arn is not None:
-        alb.remove_listener_certificates(
+        aws.alb.remove_listener_certificates(
             ListenerArn=service_instance.previous_alb_listener_arn,
             Certificates=[
                 {"CertificateArn": remove_certificate.iam_server_certificate_arn}
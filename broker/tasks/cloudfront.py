@@ -3,10 +3,10 @@ import time
 
 from sqlalchemy.orm.attributes import flag_modified
 
-from broker.aws import cloudfront
+from broker import aws
 from broker.extensions import config, db
 from broker.models import Operation, CDNServiceInstance
-from broker.tasks import huey
+from broker.tasks import huey, iam
 
 logger = logging.getLogger(__name__)
 
@@ -76,13 +76,15 @@ def create_distribution(operation_id: int, **kwargs):
 
     if service_instance.cloudfront_distribution_id:
         try:
-            cloudfront.get_distribution(Id=service_instance.cloudfront_distribution_id)
-        except cloudfront.exceptions.NoSuchDistribution:
+            aws.cloudfront.get_distribution(
+                Id=service_instance.cloudfront_distribution_id
+            )
+        except aws.cloudfront.exceptions.NoSuchDistribution:
             pass
         else:
             return
     cookies = get_cookie_policy(service_instance)
-    response = cloudfront.create_distribution(
+    response = aws.cloudfront.create_distribution(
         DistributionConfig={
             "CallerReference": service_instance.id,
             "Aliases": get_aliases(service_instance),
@@ -180,16 +182,16 @@ def disable_distribution(operation_id: int, **kwargs):
         return
 
     try:
-        distribution_config = cloudfront.get_distribution_config(
+        distribution_config = aws.cloudfront.get_distribution_config(
             Id=service_instance.cloudfront_distribution_id
         )
         distribution_config["DistributionConfig"]["Enabled"] = False
-        cloudfront.update_distribution(
+        aws.cloudfront.update_distribution(
             DistributionConfig=distribution_config["DistributionConfig"],
             Id=service_instance.cloudfront_distribution_id,
             IfMatch=distribution_config["ETag"],
         )
-    except cloudfront.exceptions.NoSuchDistribution:
+    except aws.cloudfront.exceptions.NoSuchDistribution:
         return
 
 
@@ -221,10 +223,10 @@ def wait_for_distribution_disabled(operation_id: int, **kwargs):
             raise RuntimeError("Failed to disable distribution")
         time.sleep(config.CLOUDFRONT_PROPAGATION_SLEEP_TIME)
         try:
-            status = cloudfront.get_distribution(
+            status = aws.cloudfront.get_distribution(
                 Id=service_instance.cloudfront_distribution_id
             )
-        except cloudfront.exceptions.NoSuchDistribution:
+        except aws.cloudfront.exceptions.NoSuchDistribution:
             return
         enabled = status["Distribution"]["DistributionConfig"]["Enabled"]
 
@@ -243,16 +245,80 @@ def delete_distribution(operation_id: int, **kwargs):
         return
 
     try:
-        status = cloudfront.get_distribution(
+        status = aws.cloudfront.get_distribution(
             Id=service_instance.cloudfront_distribution_id
         )
-        cloudfront.delete_distribution(
+        aws.cloudfront.delete_distribution(
             Id=service_instance.cloudfront_distribution_id, IfMatch=status["ETag"]
         )
-    except cloudfront.exceptions.NoSuchDistribution:
+    except aws.cloudfront.exceptions.NoSuchDistribution:
         return
 
 
+def list_distributions():
+    """Summaries of every distribution in the account, by ID"""
+    distributions = {}
+    for page in aws.cloudfront.get_paginator("list_distributions").paginate():
+        for distribution in page["DistributionList"].get("Items", []):
+            distributions[distribution["Id"]] = distribution
+    return distributions
+
+
+def reap_disabled_distributions():
+    """
+    Delete the distributions that deprovisioning left disabling, once CloudFront
+    has finished with them, and then the instances' certificates. Returns the
+    ids of the instances cleaned up.
+    """
+    service_instances = (
+        CDNServiceInstance.query.filter(
+            CDNServiceInstance.deactivated_at.isnot(None),
+            CDNServiceInstance.cloudfront_distribution_id.isnot(None),
+        )
+        .order_by(CDNServiceInstance.deactivated_at)
+        .all()
+    )
+    if not service_instances:
+        return []
+
+    # one listing for all of them, instead of a get_distribution each
+    distributions = list_distributions()
+
+    reaped = []
+    for service_instance in service_instances:
+        distribution_id = service_instance.cloudfront_distribution_id
+        distribution = distributions.get(distribution_id)
+        try:
+            if distribution is not None:
+                if distribution["Enabled"] or distribution["Status"] != "Deployed":
+                    continue
+                try:
+                    status = aws.cloudfront.get_distribution(Id=distribution_id)
+                    aws.cloudfront.delete_distribution(
+                        Id=distribution_id, IfMatch=status["ETag"]
+                    )
+                except aws.cloudfront.exceptions.NoSuchDistribution:
+                    pass
+            iam.delete_instance_server_certificates(
+                aws.iam_commercial, service_instance
+            )
+        except Exception:
+            # try again on the next run
+            logger.exception(
+                "Failed reaping distribution",
+                extra={
+                    "service_instance_id": service_instance.id,
+                    "cloudfront_distribution_id": distribution_id,
+                },
+            )
+            continue
+        service_instance.cloudfront_distribution_id = None
+        db.session.add(service_instance)
+        db.session.commit()
+        reaped.append(service_instance.id)
+    return reaped
+
+
 @huey.retriable_task
 def wait_for_distribution(operation_id: str, **kwargs):
     operation = Operation.query.get(operation_id)
@@ -263,7 +329,7 @@ def wait_for_distribution(operation_id: str, **kwargs):
     db.session.add(operation)
     db.session.commit()
 
-    waiter = cloudfront.get_waiter("distribution_deployed")
+    waiter = aws.cloudfront.get_waiter("distribution_deployed")
     waiter.wait(
         Id=service_instance.cloudfront_distribution_id,
         WaiterConfig={
@@ -283,13 +349,13 @@ def update_certificate(operation_id: str, **kwargs):
     db.session.add(operation)
     db.session.commit()
 
-    config = cloudfront.get_distribution_config(
+    config = aws.cloudfront.get_distribution_config(
         Id=service_instance.cloudfront_distribution_id
     )
     config["DistributionConfig"]["ViewerCertificate"][
         "IAMCertificateId"
     ] = service_instance.new_certificate.iam_server_certificate_id
-    cloudfront.update_distribution(
+    aws.cloudfront.update_distribution(
         DistributionConfig=config["DistributionConfig"],
         Id=service_instance.cloudfront_distribution_id,
         IfMatch=config["ETag"],
@@ -311,7 +377,7 @@ def update_distribution(operation_id: str, **kwargs):
     db.session.add(operation)
     db.session.commit()
 
-    config_response = cloudfront.get_distribution_config(
+    config_response = aws.cloudfront.get_distribution_config(
         Id=service_instance.cloudfront_distribution_id
     )
     etag = config_response["ETag"]
@@ -337,7 +403,7 @@ def update_distribution(operation_id: str, **kwargs):
     config["Aliases"] = get_aliases(service_instance)
     config["CustomErrorResponses"] = get_custom_error_responses(service_instance)
 
-    cloudfront.update_distribution(
+    aws.cloudfront.update_distribution(
         DistributionConfig=config,
         Id=service_instance.cloudfront_distribution_id,
         IfMatch=etag,
@@ -353,7 +419,7 @@ def update_distribution(operation_id: str, **kwargs):
 def remove_s3_bucket_from_cdn_broker_instance(operation_id: str, **kwargs):
     operation = Operation.query.get(operation_id)
     service_instance = operation.service_instance
-    config_response = cloudfront.get_distribution_config(
+    config_response = aws.cloudfront.get_distribution_config(
         Id=service_instance.cloudfront_distribution_id
     )
     etag = config_response["ETag"]
@@ -387,7 +453,7 @@ def remove_s3_bucket_from_cdn_broker_instance(operation_id: str, **kwargs):
         config[
             "Comment"
         ] = "external domain service https://cloud-gov/external-domain-broker"
-        cloudfront.update_distribution(
+        aws.cloudfront.update_distribution(
             DistributionConfig=config,
             Id=service_instance.cloudfront_distribution_id,
             IfMatch=etag,
@@ -398,7 +464,7 @@ def remove_s3_bucket_from_cdn_broker_instance(operation_id: str, **kwargs):
 def add_logging_to_bucket(operation_id: str, **kwargs):
     operation = Operation.query.get(operation_id)
     service_instance = operation.service_instance
-    config_response = cloudfront.get_distribution_config(
+    config_response = aws.cloudfront.get_distribution_config(
         Id=service_instance.cloudfront_distribution_id
     )
     dist_config = config_response["DistributionConfig"]
@@ -410,7 +476,7 @@ def add_logging_to_bucket(operation_id: str, **kwargs):
             "Bucket": config.CDN_LOG_BUCKET,
             "Prefix": f"{service_instance.id}/",
         }
-        cloudfront.update_distribution(
+        aws.cloudfront.update_distribution(
             DistributionConfig=dist_config,
             Id=service_instance.cloudfront_distribution_id,
             IfMatch=etag,
@@ -1,22 +1,35 @@
 import datetime
+import json
 import logging
 
 from huey import crontab
 
-from broker.extensions import config, db
-from broker.models import Certificate, ServiceInstance, Operation
-from broker.tasks import huey
+from broker.extensions import config, db, read_replica
+from broker.models import (
+    Certificate,
+    ServiceInstance,
+    Operation,
+    move_certificate_chains,
+)
+from broker.tasks import drift, huey, retention
+from broker.tasks.cloudfront import reap_disabled_distributions
+from broker.tasks.iam import delete_orphaned_server_certificates
+from broker.tasks.route53 import sync_zone_index
 from broker.tasks.pipelines import (
+    queue_all_alb_cleanup_tasks_for_operation,
     queue_all_alb_deprovision_tasks_for_operation,
     queue_all_alb_provision_tasks_for_operation,
     queue_all_alb_renewal_tasks_for_operation,
     queue_all_alb_update_tasks_for_operation,
+    queue_all_cdn_cleanup_tasks_for_operation,
     queue_all_cdn_deprovision_tasks_for_operation,
     queue_all_cdn_broker_migration_tasks_for_operation,
     queue_all_cdn_provision_tasks_for_operation,
     queue_all_cdn_update_tasks_for_operation,
     queue_all_cdn_renewal_tasks_for_operation,
 )
+from broker.tasks.update_operations import reconcile_canceled_operations
+from broker.smtp import send_failed_operations_digest
 
 logger = logging.getLogger(__name__)
 
@@ -25,19 +38,34 @@ logger = logging.getLogger(__name__)
 def scan_for_expiring_certs():
     if not config.RUN_CRON:
         return
-    with huey.huey.flask_app.app_context():
+    with huey.flask_app().app_context():
         logger.info("Scanning for expired certificates")
-        # TODO: skip SIs with active operations
-        certificates = Certificate.query.filter(
-            Certificate.expires_at - datetime.timedelta(days=30)
-            < datetime.datetime.now()
-        ).all()
-        instances = [
-            c.service_instance
-            for c in certificates
-            if not c.service_instance.deactivated_at
-            and not c.service_instance.has_active_operations()
-        ]
+        with read_replica():
+            # just the ids - not the certificates themselves
+            expiring = db.session.query(Certificate.service_instance_id).filter(
+                Certificate.expires_at
+                - datetime.timedelta(days=config.CERTIFICATE_RENEWAL_MARGIN_IN_DAYS)
+                < datetime.datetime.now()
+            )
+            instance_ids = [
+                service_instance.id
+                for service_instance in ServiceInstance.query.filter(
+                    ServiceInstance.id.in_(expiring),
+                    ServiceInstance.deactivated_at.is_(None),
+                )
+                if not service_instance.has_active_operations()
+            ]
+        # the replica may be a little behind, so check again on the primary -
+        # that the instances are still active and haven't started an operation
+        # since - before we start renewals
+        instances = (
+            ServiceInstance.query.populate_existing()
+            .filter(
+                ServiceInstance.id.in_(instance_ids),
+                ServiceInstance.deactivated_at.is_(None),
+            )
+            .all()
+        )
         cdn_renewals = []
         alb_renewals = []
         for instance in instances:
@@ -70,20 +98,123 @@ def scan_for_expiring_certs():
 def restart_stalled_pipelines():
     if not config.RUN_CRON:
         return
-    with huey.huey.flask_app.app_context():
+    with huey.flask_app().app_context():
+        # make sure operations un-canceled by hand don't get canceled again
+        reconcile_canceled_operations()
         for operation in scan_for_stalled_pipelines():
             reschedule_operation(operation)
 
 
+@huey.huey.periodic_task(crontab(month="*", hour="*", day="*", minute="*"))
+def refresh_canceled_operations():
+    if not config.RUN_CRON:
+        return
+    with huey.flask_app().app_context():
+        return reconcile_canceled_operations()
+
+
+@huey.huey.periodic_task(crontab(month="*", hour="*", day="*", minute="*/5"))
+def reap_cloudfront_distributions():
+    if not config.RUN_CRON:
+        return
+    with huey.flask_app().app_context():
+        logger.info("Reaping disabled CloudFront distributions")
+        # n.b. this return is only for testing - huey ignores it.
+        return reap_disabled_distributions()
+
+
+@huey.huey.periodic_task(crontab(month="*", hour="*", day="*", minute="37"))
+def sync_route53_index():
+    if not config.RUN_CRON:
+        return
+    with huey.flask_app().app_context():
+        logger.info("Syncing the Route53 record index")
+        count = sync_zone_index()
+        if count >= config.ROUTE53_ZONE_RECORD_LIMIT * 0.8:
+            logger.warning(
+                "Route53 zone has %s of its %s record sets",
+                count,
+                config.ROUTE53_ZONE_RECORD_LIMIT,
+            )
+        # n.b. this return is only for testing - huey ignores it.
+        return count
+
+
+@huey.huey.periodic_task(crontab(month="*", hour="4", day="*", minute="17"))
+def check_for_drift():
+    if not config.RUN_CRON:
+        return
+    with huey.flask_app().app_context():
+        logger.info("Checking for drift between the database and AWS")
+        # n.b. this return is only for testing - huey ignores it.
+        return drift.reconcile(auto_repair=config.DRIFT_AUTO_REPAIR)
+
+
+@huey.huey.periodic_task(crontab(month="*", hour="5", day="*", minute="23"))
+def collect_orphaned_server_certificates():
+    if not config.RUN_CRON:
+        return
+    with huey.flask_app().app_context():
+        logger.info("Collecting orphaned server certificates")
+        # n.b. this return is only for testing - huey ignores it.
+        return delete_orphaned_server_certificates()
+
+
+@huey.huey.periodic_task(crontab(month="*", hour="*", day="*", minute="*"))
+def deduplicate_certificate_chains():
+    if not config.RUN_CRON:
+        return
+    with huey.flask_app().app_context():
+        moved = move_certificate_chains(config.CERTIFICATE_CHAIN_BATCH_SIZE)
+        if moved:
+            logger.info("Moved %s certificate chains to certificate_chain", moved)
+        # n.b. this return is only for testing - huey ignores it.
+        return moved
+
+
+@huey.huey.periodic_task(crontab(month="*", hour="3", day="*", minute="41"))
+def archive_old_rows():
+    if not config.RUN_CRON:
+        return
+    with huey.flask_app().app_context():
+        logger.info("Archiving rows past their retention windows")
+        # n.b. this return is only for testing - huey ignores it.
+        return retention.archive_old_rows()
+
+
+@huey.huey.periodic_task(crontab(month="*", hour="*", day="*", minute="*/5"))
+def send_failed_operation_alerts():
+    if not config.RUN_CRON:
+        return
+    conn = huey.huey.storage.conn
+    # take everything queued so far in one step, so alerts queued while we're
+    # sending go out with the next digest instead of getting lost
+    pipe = conn.pipeline()
+    pipe.lrange(huey.FAILED_OPERATION_ALERTS_KEY, 0, -1)
+    pipe.delete(huey.FAILED_OPERATION_ALERTS_KEY)
+    queued, _ = pipe.execute()
+    if not queued:
+        return 0
+    try:
+        send_failed_operations_digest([json.loads(alert) for alert in queued])
+    except BaseException:
+        logger.exception("Failed sending failed operation alerts, requeuing them")
+        conn.lpush(huey.FAILED_OPERATION_ALERTS_KEY, *reversed(queued))
+        raise
+    # n.b. this return is only for testing - huey ignores it.
+    return len(queued)
+
+
 def scan_for_stalled_pipelines():
     logger.info("Scanning for stalled pipelines")
     fifteen_minutes_ago = datetime.datetime.now() - datetime.timedelta(minutes=15)
-    operations = Operation.query.filter(
-        Operation.state == Operation.States.IN_PROGRESS.value,
-        Operation.updated_at <= fifteen_minutes_ago,
-        Operation.canceled_at.is_(None),
-    )
-    return [operation.id for operation in operations]
+    with read_replica():
+        operations = Operation.query.filter(
+            Operation.state == Operation.States.IN_PROGRESS.value,
+            Operation.updated_at <= fifteen_minutes_ago,
+            Operation.canceled_at.is_(None),
+        )
+        return [operation.id for operation in operations]
 
 
 def reschedule_operation(operation_id):
@@ -94,12 +225,14 @@ def reschedule_operation(operation_id):
     )
     actions = Operation.Actions
     alb_queues = {
+        actions.CLEANUP.value: queue_all_alb_cleanup_tasks_for_operation,
         actions.DEPROVISION.value: queue_all_alb_deprovision_tasks_for_operation,
         actions.PROVISION.value: queue_all_alb_provision_tasks_for_operation,
         actions.RENEW.value: queue_all_alb_renewal_tasks_for_operation,
         actions.UPDATE.value: queue_all_alb_update_tasks_for_operation,
     }
     cdn_queues = {
+        actions.CLEANUP.value: queue_all_cdn_cleanup_tasks_for_operation,
         actions.DEPROVISION.value: queue_all_cdn_deprovision_tasks_for_operation,
         actions.MIGRATE_TO_BROKER.value: queue_all_cdn_broker_migration_tasks_for_operation,
         actions.PROVISION.value: queue_all_cdn_provision_tasks_for_operation,
@@ -113,6 +246,6 @@ def reschedule_operation(operation_id):
             f"Operation {operation_id} has unknown action {operation.action}"
         )
     if operation.action == actions.RENEW.value:
-        queue(operation.id)
+        queue(operation.id, priority=huey.Priority.RECOVERY)
     else:
-        queue(operation.id, "Recovered operation")
+        queue(operation.id, "Recovered operation", priority=huey.Priority.RECOVERY)
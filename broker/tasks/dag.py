@@ -0,0 +1,115 @@
+"""
+Pipelines where a task runs as soon as the tasks it depends on are done, rather
+than after every task before it.
+
+    pipeline = Pipeline(
+        "example",
+        [
+            Step(first_task),
+            Step(second_task, after=["first_task"]),
+            Step(third_task, after=["first_task"]),
+            Step(last_task, after=["second_task", "third_task"]),
+        ],
+    )
+    pipeline.enqueue(operation_id, correlation_id, Priority.PROVISION)
+
+Here second_task and third_task run at the same time. Each step is queued as an
+ordinary huey task with a `pipeline_step` kwarg. When one succeeds, a
+post-execute hook counts it off against each of its dependents in Redis, and
+queues any dependent that isn't waiting on anything else.
+
+If a step fails, its dependents never run, the same as with `Task.then()`.
+"""
+
+import logging
+import uuid
+from typing import Dict, List, NamedTuple, Sequence
+
+from broker.tasks.huey import Priority, huey
+
+logger = logging.getLogger(__name__)
+
+# every Pipeline, by name, so the hook can find a step's dependents
+PIPELINES: Dict[str, "Pipeline"] = {}
+
+# long enough to outlast a step's retries
+RUN_TTL_IN_SECONDS = 7 * 24 * 60 * 60
+
+
+class Step(NamedTuple):
+    task: object
+    after: Sequence[str] = ()
+    name: str = None
+
+
+class Pipeline:
+    def __init__(self, name: str, steps: List[Step]):
+        self.name = name
+        self.steps = {}
+        for step in steps:
+            # a TaskWrapper's own name is only set if it was registered with
+            # name=, but the class it makes is always named
+            step = step._replace(name=step.name or step.task.task_class.__name__)
+            if step.name in self.steps:
+                raise ValueError(f"{name} has more than one step named {step.name}")
+            for dependency in step.after:
+                # which also means there can't be cycles
+                if dependency not in self.steps:
+                    raise ValueError(
+                        f"{name} step {step.name} comes before its dependency {dependency}"
+                    )
+            self.steps[step.name] = step
+        PIPELINES[name] = self
+
+    def dependents(self, step_name: str) -> List[Step]:
+        return [step for step in self.steps.values() if step_name in step.after]
+
+    def enqueue(self, operation_id, correlation_id: str, priority: Priority):
+        run_id = uuid.uuid4().hex
+        key = _run_key(run_id)
+        waiting = {
+            f"waiting_on:{step.name}": len(step.after)
+            for step in self.steps.values()
+            if step.after
+        }
+        pipe = huey.storage.conn.pipeline()
+        if waiting:
+            pipe.hset(key, mapping=waiting)
+        pipe.expire(key, RUN_TTL_IN_SECONDS)
+        pipe.execute()
+        for step in self.steps.values():
+            if not step.after:
+                self._enqueue_step(step, operation_id, run_id, correlation_id, priority)
+
+    def _enqueue_step(self, step, operation_id, run_id, correlation_id, priority):
+        task = step.task.s(
+            operation_id,
+            correlation_id=correlation_id,
+            pipeline_step=(self.name, run_id, step.name, correlation_id),
+        )
+        task.priority = priority
+        huey.enqueue(task)
+
+
+def _run_key(run_id: str) -> str:
+    return f"pipeline_run:{run_id}"
+
+
+@huey.post_execute(name="Queue pipeline steps that are ready")
+def queue_ready_steps(task, task_value, exc):
+    if exc is not None:
+        return
+    pipeline_step = task.kwargs.get("pipeline_step")
+    if pipeline_step is None:
+        return
+    pipeline_name, run_id, step_name, correlation_id = pipeline_step
+    pipeline = PIPELINES[pipeline_name]
+    operation_id = task.args[0]
+    conn = huey.storage.conn
+    for dependent in pipeline.dependents(step_name):
+        # only one of the steps it was waiting on will see this hit zero
+        waiting = conn.hincrby(_run_key(run_id), f"waiting_on:{dependent.name}", -1)
+        if waiting == 0:
+            pipeline._enqueue_step(
+                dependent, operation_id, run_id, correlation_id, task.priority
+            )
@@ -0,0 +1,234 @@
+"""
+Finds where our database and AWS disagree, for the whole fleet at once.
+
+Rather than asking AWS about each instance, we take one paginated listing of
+each kind of resource (distributions, listener certificates, server
+certificates and the Route53 zone), all at the same time, and check every
+active instance against them in one pass.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from typing import NamedTuple
+
+from sqlalchemy.orm import joinedload
+
+from broker import aws
+from broker.extensions import config, db
+from broker.models import (
+    ALBServiceInstance,
+    CDNServiceInstance,
+    Operation,
+    ServiceInstance,
+)
+from broker.tasks import alb, cloudfront, iam, route53
+from broker.tasks.pipelines import (
+    queue_all_alb_renewal_tasks_for_operation,
+    queue_all_cdn_renewal_tasks_for_operation,
+)
+
+logger = logging.getLogger(__name__)
+
+MISSING_DISTRIBUTION = "missing_distribution"
+DISTRIBUTION_DISABLED = "distribution_disabled"
+DISTRIBUTION_CERTIFICATE_MISMATCH = "distribution_certificate_mismatch"
+CERTIFICATE_NOT_ON_LISTENER = "certificate_not_on_listener"
+MISSING_SERVER_CERTIFICATE = "missing_server_certificate"
+MISSING_ALIAS_RECORD = "missing_ALIAS_record"
+
+# a renewal gets a new certificate into IAM and onto the distribution or
+# listener, so it fixes these
+REPAIRED_BY_RENEWAL = {
+    DISTRIBUTION_CERTIFICATE_MISMATCH,
+    CERTIFICATE_NOT_ON_LISTENER,
+    MISSING_SERVER_CERTIFICATE,
+}
+
+
+class Drift(NamedTuple):
+    service_instance_id: str
+    kind: str
+    detail: str
+
+
+class Inventory(NamedTuple):
+    distributions: dict
+    listener_certificates: dict
+    cloudfront_certificates: dict
+    alb_certificates: dict
+    zone: dict
+
+
+def take_inventory(listener_arns) -> Inventory:
+    """List everything we check against, each kind in its own thread"""
+    listings = dict(
+        distributions=cloudfront.list_distributions,
+        listener_certificates=lambda: alb.list_listener_certificates(listener_arns),
+        cloudfront_certificates=lambda: iam.list_server_certificates(
+            aws.iam_commercial, config.CLOUDFRONT_IAM_SERVER_CERTIFICATE_PREFIX
+        ),
+        alb_certificates=lambda: iam.list_server_certificates(
+            aws.iam_govcloud, config.ALB_IAM_SERVER_CERTIFICATE_PREFIX
+        ),
+        zone=route53.list_zone,
+    )
+    with ThreadPoolExecutor(max_workers=len(listings)) as executor:
+        futures = {name: executor.submit(fn) for name, fn in listings.items()}
+    return Inventory(**{name: future.result() for name, future in futures.items()})
+
+
+def find_drift(service_instances, inventory: Inventory):
+    drift = []
+
+    def found(service_instance, kind, detail):
+        drift.append(Drift(service_instance.id, kind, detail))
+
+    for service_instance in service_instances:
+        certificate = service_instance.current_certificate
+        if isinstance(service_instance, CDNServiceInstance):
+            server_certificates = inventory.cloudfront_certificates
+            distribution_id = service_instance.cloudfront_distribution_id
+            distribution = inventory.distributions.get(distribution_id)
+            if distribution is None:
+                found(service_instance, MISSING_DISTRIBUTION, distribution_id)
+            else:
+                if not distribution["Enabled"]:
+                    found(service_instance, DISTRIBUTION_DISABLED, distribution_id)
+                viewer_certificate = distribution["ViewerCertificate"]
+                if (
+                    viewer_certificate.get("IAMCertificateId")
+                    != certificate.iam_server_certificate_id
+                ):
+                    found(
+                        service_instance,
+                        DISTRIBUTION_CERTIFICATE_MISMATCH,
+                        f"{distribution_id} has {viewer_certificate.get('IAMCertificateId')}",
+                    )
+        elif isinstance(service_instance, ALBServiceInstance):
+            server_certificates = inventory.alb_certificates
+            listener_arn = service_instance.alb_listener_arn
+            on_listener = inventory.listener_certificates.get(listener_arn, set())
+            if certificate.iam_server_certificate_arn not in on_listener:
+                found(
+                    service_instance,
+                    CERTIFICATE_NOT_ON_LISTENER,
+                    f"{certificate.iam_server_certificate_arn} on {listener_arn}",
+                )
+        else:
+            continue
+
+        if certificate.iam_server_certificate_name not in server_certificates:
+            found(
+                service_instance,
+                MISSING_SERVER_CERTIFICATE,
+                certificate.iam_server_certificate_name,
+            )
+        for domain in service_instance.domain_names:
+            name = f"{domain}.{config.DNS_ROOT_DOMAIN}".lower()
+            if (name, "A") not in inventory.zone:
+                found(service_instance, MISSING_ALIAS_RECORD, name)
+
+    return drift
+
+
+def repair(drift):
+    """
+    Queue a renewal for each instance with drift a renewal fixes. Returns the
+    ids of the instances renewed.
+    """
+    instance_ids = {
+        d.service_instance_id for d in drift if d.kind in REPAIRED_BY_RENEWAL
+    }
+    # taking the inventory takes a while, so check again - that the instances
+    # are still active and haven't started an operation since - before we
+    # start renewals
+    service_instances = (
+        ServiceInstance.query.populate_existing()
+        .filter(
+            ServiceInstance.id.in_(instance_ids),
+            ServiceInstance.deactivated_at.is_(None),
+        )
+        .order_by(ServiceInstance.id)
+        .all()
+    )
+    repaired = []
+    cdn_renewals = []
+    alb_renewals = []
+    for service_instance in service_instances:
+        if service_instance.has_active_operations():
+            continue
+        renewal = Operation(
+            state=Operation.States.IN_PROGRESS.value,
+            service_instance=service_instance,
+            action=Operation.Actions.RENEW.value,
+            step_description="Queuing tasks",
+        )
+        db.session.add(renewal)
+        repaired.append(service_instance.id)
+        if isinstance(service_instance, CDNServiceInstance):
+            cdn_renewals.append(renewal)
+        else:
+            alb_renewals.append(renewal)
+    db.session.commit()
+    for renewal in cdn_renewals:
+        queue_all_cdn_renewal_tasks_for_operation(renewal.id)
+    for renewal in alb_renewals:
+        queue_all_alb_renewal_tasks_for_operation(renewal.id)
+    return repaired
+
+
+def reconcile(auto_repair: bool = False):
+    """
+    Check every settled, active instance against AWS, and log what doesn't
+    match. Returns the drift found, and the ids of the instances repaired.
+    """
+    busy = {
+        service_instance_id
+        for (service_instance_id,) in db.session.query(
+            Operation.service_instance_id
+        ).filter(
+            Operation.state == Operation.States.IN_PROGRESS.value,
+            Operation.canceled_at.is_(None),
+        )
+    }
+    service_instances = [
+        service_instance
+        for service_instance in ServiceInstance.query.options(
+            joinedload(ServiceInstance.current_certificate)
+        ).filter(
+            ServiceInstance.deactivated_at.is_(None),
+            ServiceInstance.current_certificate_id.isnot(None),
+        )
+        # anything with an operation going is expected to be in flux
+        if service_instance.id not in busy
+    ]
+    listener_arns = set(config.ALB_LISTENER_ARNS)
+    listener_arns.update(
+        s.alb_listener_arn
+        for s in service_instances
+        if isinstance(s, ALBServiceInstance) and s.alb_listener_arn
+    )
+
+    listed_at = route53.index_clock()
+    inventory = take_inventory(sorted(listener_arns))
+    # we have the listing anyway
+    route53.replace_index(inventory.zone, listed_at)
+
+    drift = find_drift(service_instances, inventory)
+    for d in drift:
+        logger.warning(
+            "Drift found",
+            extra={
+                "service_instance_id": d.service_instance_id,
+                "drift": d.kind,
+                "detail": d.detail,
+            },
+        )
+    logger.info(
+        "Checked %s instances against AWS and found %s problems",
+        len(service_instances),
+        len(drift),
+    )
+
+    repaired = repair(drift) if auto_repair else []
+    return drift, repaired
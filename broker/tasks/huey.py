@@ -1,16 +1,26 @@
+from enum import IntEnum
+import json
 import logging
+import struct
+import threading
+import time
 
 from flask import Flask
-from redis import ConnectionPool, SSLConnection
+from redis import ConnectionPool, Redis, RedisError, SSLConnection
 from huey import RedisHuey, signals
+from huey.exceptions import RetryTask
+from huey.storage import PriorityRedisStorage
 
 from sap import cf_logging
+from broker import instrumentation
 from broker.extensions import config, db
 from broker.models import Operation
-from broker.smtp import send_failed_operation_alert
 
 logger = logging.getLogger(__name__)
 
+# Redis list of failed operations waiting to go out in the next alert digest
+FAILED_OPERATION_ALERTS_KEY = "failed_operation_alerts"
+
 if config.REDIS_SSL:
     redis_kwargs = dict(connection_class=SSLConnection, ssl_cert_reqs=None)
 else:
@@ -22,21 +32,103 @@ connection_pool = ConnectionPool(
     password=config.REDIS_PASSWORD,
     **redis_kwargs,
 )
-huey = RedisHuey(connection_pool=connection_pool)
+# for our own keys - huey's storage isn't Redis when it runs tasks immediately
+redis = Redis(connection_pool=connection_pool)
+
+
+class Priority(IntEnum):
+    """
+    Which queued tasks run first, highest first. Pipelines set this on every
+    task they queue (see broker.tasks.pipelines).
+    """
+
+    MAINTENANCE = 0
+    RENEWAL = 1
+    RECOVERY = 2
+    DEPROVISION = 3
+    UPDATE = 4
+    PROVISION = 5
+
+
+class AgingPriorityRedisStorage(PriorityRedisStorage):
+    """
+    A priority queue where waiting counts too: every TASK_PRIORITY_AGING_SECONDS
+    a task has been queued is worth one priority level. A customer's provision
+    goes ahead of renewals queued a little earlier, but a renewal that's waited
+    long enough goes ahead of anything queued after it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the plain FIFO queue we used before, which has a different redis type
+        self.fifo_queue_key = self.queue_key
+        self.queue_key = f"{self.queue_key}.priority"
+
+    def enqueue(self, data, priority=None):
+        if priority is None:
+            priority = Priority.MAINTENANCE
+        now = time.time()
+        # lowest score is dequeued first
+        score = now - priority * config.TASK_PRIORITY_AGING_SECONDS
+        # like PriorityRedisStorage, prefix a timestamp so identical tasks don't
+        # collapse into one entry - dequeue strips it
+        prefix = struct.pack(">Q", int(now * 1e6))
+        self.conn.zadd(self.queue_key, {prefix + data: score})
+
+    def move_fifo_queue(self) -> int:
+        """Move tasks queued before we had priorities into the priority queue"""
+        moved = 0
+        # oldest first
+        data = self.conn.rpop(self.fifo_queue_key)
+        while data is not None:
+            # these are already in flight, so treat them like restarted ones
+            self.enqueue(data, Priority.RECOVERY)
+            moved += 1
+            data = self.conn.rpop(self.fifo_queue_key)
+        return moved
+
+
+huey = RedisHuey(
+    connection_pool=connection_pool, storage_class=AgingPriorityRedisStorage
+)
+
+# the Flask app tasks run in. It's made by create_app when the consumer starts,
+# or the first time a task needs it, whichever comes first.
+huey.flask_app = None
+
+
+def flask_app() -> Flask:
+    if huey.flask_app is None:
+        create_app()
+    return huey.flask_app
+
+
+class FlaskAppContext:
+    """
+    Like `flask_app().app_context()`, but doesn't need the app until a task
+    runs, so importing task modules doesn't make one.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def __enter__(self):
+        context = flask_app().app_context()
+        context.push()
+        self._local.__dict__.setdefault("contexts", []).append(context)
+        return context
 
-# these two lines need to be here so we can define [non]retriable_task
-huey.flask_app = Flask(__name__)
-huey.flask_app.config.from_object(config)
+    def __exit__(self, *exc_info):
+        self._local.contexts.pop().pop()
 
-# this line is so this all works the same in tests
-db.init_app(huey.flask_app)
 
 # Normal task, no retries
-nonretriable_task = huey.context_task(huey.flask_app.app_context())
+nonretriable_task = huey.context_task(FlaskAppContext())
 
 # These tasks retry every 10 minutes for four hours.
+RETRY_DELAY_IN_SECONDS = 10 * 60
 retriable_task = huey.context_task(
-    huey.flask_app.app_context(), retries=6 * 4, retry_delay=10 * 60
+    FlaskAppContext(), retries=6 * 4, retry_delay=RETRY_DELAY_IN_SECONDS
 )
 
 
@@ -48,6 +140,13 @@ def create_app():
     db.init_app(app)
 
 
+@huey.on_startup()
+def move_fifo_queue():
+    moved = huey.storage.move_fifo_queue()
+    if moved:
+        logger.info("Moved %s tasks from the FIFO queue to the priority queue", moved)
+
+
 @huey.on_startup()
 def initialize_logging():
     cf_logging.init()
@@ -60,12 +159,60 @@ def register_correlation_id(task):
     cf_logging.FRAMEWORK.context.set_correlation_id(correlation_id)
 
 
+@huey.pre_execute(name="Set code path")
+def enter_task_code_path(task):
+    # attribute the task's database queries to it
+    task.code_path_token = instrumentation.enter_code_path(task.name)
+
+
+@huey.post_execute(name="Reset code path")
+def exit_task_code_path(task, task_value, exc):
+    token = getattr(task, "code_path_token", None)
+    if token is not None:
+        del task.code_path_token
+        instrumentation.exit_code_path(token)
+
+
+class CheckAgainLater(RetryTask):
+    """
+    Raise this from a task that's waiting on something outside the broker to
+    run the task again in `delay` seconds, instead of blocking a worker until
+    it's done. It doesn't count against the task's retries.
+    """
+
+    def __init__(self, delay: float):
+        super().__init__(f"checking again in {delay} seconds")
+        self.delay = delay
+
+
+@huey.pre_execute(name="Remember retry delay")
+def remember_retry_delay(task):
+    # a task checking again later is requeued with its delay changed, so it
+    # carries its own delay along with it
+    args, kwargs = task.data
+    task.original_retry_delay = kwargs.pop("original_retry_delay", task.retry_delay)
+
+
+@huey.post_execute(name="Schedule check again later")
+def schedule_check_again_later(task, task_value, exc):
+    # huey requeues retried tasks after task.retry_delay, once post-execute
+    # hooks have run
+    original_retry_delay = getattr(task, "original_retry_delay", task.retry_delay)
+    if isinstance(exc, CheckAgainLater):
+        task.retry_delay = exc.delay
+        args, kwargs = task.data
+        kwargs["original_retry_delay"] = original_retry_delay
+    else:
+        # undo any earlier CheckAgainLater, so failures back off as usual
+        task.retry_delay = original_retry_delay
+
+
 @huey.signal(signals.SIGNAL_ERROR)
 def mark_operation_failed(signal, task, exc=None):
     args, kwargs = task.data
     if task.retries:
         return
-    with huey.flask_app.app_context():
+    with flask_app().app_context():
         try:
             operation = Operation.query.get(args[0])
         except BaseException as e:
@@ -75,7 +222,35 @@ def mark_operation_failed(signal, task, exc=None):
             # assume this task doesn't follow our pattern of operation_id as the first param
             # in which case this task is not a part of a provisioning/upgrade/deprovisioning pipeline
             return
+        if operation is None:
+            logger.error(f"can't mark missing operation {args[0]} failed")
+            return
         operation.state = Operation.States.FAILED.value
         db.session.add(operation)
         db.session.commit()
-        send_failed_operation_alert(operation)
+        queue_failed_operation_alert(operation)
+
+
+def queue_failed_operation_alert(operation):
+    """
+    Queue an alert for a failed operation. Alerts are sent in batches by
+    broker.tasks.cron.send_failed_operation_alerts, so this never waits on SMTP.
+    """
+    alert = dict(
+        operation_id=operation.id,
+        action=operation.action,
+        step_description=operation.step_description,
+        service_instance_id=operation.service_instance_id,
+        instance_type=(
+            operation.service_instance.instance_type
+            if operation.service_instance
+            else None
+        ),
+    )
+    try:
+        redis.rpush(FAILED_OPERATION_ALERTS_KEY, json.dumps(alert))
+    except RedisError as e:
+        # the operation is already marked failed, which is what matters
+        logger.exception(
+            msg=f"exception queuing alert for operation {operation.id}", exc_info=e
+        )
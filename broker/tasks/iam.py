@@ -1,19 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from datetime import date
-import time
+from datetime import date, datetime, timedelta, timezone
 
 from botocore.exceptions import ClientError
 from sqlalchemy import and_
+from sqlalchemy.orm import load_only
 from sqlalchemy.orm.attributes import flag_modified
 
-from broker.aws import iam_commercial, iam_govcloud
+from broker import aws
 from broker.extensions import config, db
-from broker.models import Certificate, Operation
+from broker.models import Certificate, Operation, ServiceInstance
 from broker.tasks import huey
 
 logger = logging.getLogger(__name__)
 
 
+def delete_server_certificate_when_unused(iam, name: str):
+    # a load balancer can keep using a certificate for a little while after we
+    # remove it from the listener, and IAM won't delete it until it stops
+    aws.call_with_backoff(
+        iam.delete_server_certificate,
+        ["DeleteConflict"],
+        config.IAM_CERTIFICATE_PROPAGATION_TIME,
+        ServerCertificateName=name,
+    )
+
+
+def list_server_certificates(iam, path_prefix: str):
+    """Metadata for every server certificate under path_prefix, by name"""
+    certificates = {}
+    paginator = iam.get_paginator("list_server_certificates")
+    for page in paginator.paginate(PathPrefix=path_prefix):
+        for metadata in page["ServerCertificateMetadataList"]:
+            certificates[metadata["ServerCertificateName"]] = metadata
+    return certificates
+
+
+def delete_orphaned_server_certificates():
+    """
+    Delete server certificates under our path prefixes that no active instance
+    has a record of, and that nothing is using. Returns their names.
+    """
+    # long enough that we aren't racing a pipeline that just uploaded one
+    uploaded_before = datetime.now(timezone.utc) - timedelta(
+        days=config.ORPHANED_CERTIFICATE_GRACE_PERIOD_IN_DAYS
+    )
+    orphans = []
+    for iam, path_prefix in [
+        (aws.iam_commercial, config.CLOUDFRONT_IAM_SERVER_CERTIFICATE_PREFIX),
+        (aws.iam_govcloud, config.ALB_IAM_SERVER_CERTIFICATE_PREFIX),
+    ]:
+        listed = list_server_certificates(iam, path_prefix)
+        if not listed:
+            continue
+        referenced = {
+            name
+            for (name,) in db.session.query(Certificate.iam_server_certificate_name)
+            .join(
+                ServiceInstance,
+                Certificate.service_instance_id == ServiceInstance.id,
+            )
+            .filter(
+                Certificate.iam_server_certificate_name.in_(list(listed)),
+                ServiceInstance.deactivated_at.is_(None),
+            )
+        }
+        orphans.extend(
+            (iam, name)
+            for name, metadata in sorted(listed.items())
+            if name not in referenced and metadata["UploadDate"] < uploaded_before
+        )
+
+    def delete(orphan):
+        iam, name = orphan
+        try:
+            iam.delete_server_certificate(ServerCertificateName=name)
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code == "NoSuchEntity":
+                return True
+            # a distribution or listener still has it, so it isn't garbage
+            if code != "DeleteConflict":
+                logger.exception("Failed deleting server certificate %s", name)
+            return False
+        logger.info("Deleted orphaned server certificate %s", name)
+        return True
+
+    if not orphans:
+        return []
+    # the IAM rate limit (see broker.rate_limit) keeps this from crowding out
+    # the pipelines
+    with ThreadPoolExecutor(
+        max_workers=min(config.IAM_MAX_CONCURRENT_REQUESTS, len(orphans))
+    ) as executor:
+        deleted = list(executor.map(delete, orphans))
+    return [name for (_, name), ok in zip(orphans, deleted) if ok]
+
+
+def delete_instance_server_certificates(iam, service_instance):
+    """Delete the instance's new and current certificates, if they're there"""
+    for certificate in [
+        service_instance.new_certificate,
+        service_instance.current_certificate,
+    ]:
+        if certificate is None or certificate.iam_server_certificate_name is None:
+            continue
+        try:
+            delete_server_certificate_when_unused(
+                iam, certificate.iam_server_certificate_name
+            )
+        except aws.iam_commercial.exceptions.NoSuchEntityException:
+            pass
+
+
 @huey.retriable_task
 def upload_server_certificate(operation_id: int, **kwargs):
     operation = Operation.query.get(operation_id)
@@ -27,13 +126,11 @@ def upload_server_certificate(operation_id: int, **kwargs):
 
     today = date.today().isoformat()
     if service_instance.instance_type == "cdn_service_instance":
-        iam = iam_commercial
+        iam = aws.iam_commercial
         iam_server_certificate_prefix = config.CLOUDFRONT_IAM_SERVER_CERTIFICATE_PREFIX
-        propagation_time = 0
     else:
-        iam = iam_govcloud
+        iam = aws.iam_govcloud
         iam_server_certificate_prefix = config.ALB_IAM_SERVER_CERTIFICATE_PREFIX
-        propagation_time = config.IAM_CERTIFICATE_PROPAGATION_TIME
 
     if service_instance.new_certificate.iam_server_certificate_arn is not None:
         return
@@ -69,7 +166,6 @@ def upload_server_certificate(operation_id: int, **kwargs):
     db.session.add(service_instance)
     db.session.add(certificate)
     db.session.commit()
-    time.sleep(propagation_time)
 
 
 @huey.retriable_task
@@ -83,31 +179,11 @@ def delete_server_certificate(operation_id: str, **kwargs):
     db.session.commit()
 
     if service_instance.instance_type == "cdn_service_instance":
-        iam = iam_commercial
+        iam = aws.iam_commercial
     else:
-        iam = iam_govcloud
+        iam = aws.iam_govcloud
 
-    if (
-        service_instance.new_certificate is not None
-        and service_instance.new_certificate.iam_server_certificate_name is not None
-    ):
-        try:
-            iam.delete_server_certificate(
-                ServerCertificateName=service_instance.new_certificate.iam_server_certificate_name
-            )
-        except iam_commercial.exceptions.NoSuchEntityException:
-            pass
-
-    if (
-        service_instance.current_certificate is not None
-        and service_instance.current_certificate.iam_server_certificate_name is not None
-    ):
-        try:
-            iam.delete_server_certificate(
-                ServerCertificateName=service_instance.current_certificate.iam_server_certificate_name
-            )
-        except iam_commercial.exceptions.NoSuchEntityException:
-            return
+    delete_instance_server_certificates(iam, service_instance)
 
 
 @huey.retriable_task
@@ -121,21 +197,25 @@ def delete_previous_server_certificate(operation_id: str, **kwargs):
     db.session.commit()
 
     if service_instance.instance_type == "cdn_service_instance":
-        iam = iam_commercial
+        iam = aws.iam_commercial
     else:
-        iam = iam_govcloud
-
-    for certificate in Certificate.query.filter(
-        and_(
-            Certificate.service_instance_id == service_instance.id,
-            Certificate.id != service_instance.current_certificate_id,
+        iam = aws.iam_govcloud
+
+    for certificate in (
+        Certificate.query.options(load_only(Certificate.iam_server_certificate_name))
+        .filter(
+            and_(
+                Certificate.service_instance_id == service_instance.id,
+                Certificate.id != service_instance.current_certificate_id,
+            )
         )
-    ).all():
+        .all()
+    ):
         try:
-            iam.delete_server_certificate(
-                ServerCertificateName=certificate.iam_server_certificate_name
+            delete_server_certificate_when_unused(
+                iam, certificate.iam_server_certificate_name
             )
-        except iam_commercial.exceptions.NoSuchEntityException:
+        except aws.iam_commercial.exceptions.NoSuchEntityException:
             pass
         db.session.delete(certificate)
 
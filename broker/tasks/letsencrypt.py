@@ -4,18 +4,16 @@ import re
 import time
 from datetime import datetime, timedelta, timezone
 
-import josepy
-import OpenSSL
-from acme import challenges, client, crypto_util, messages, errors
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
 from sqlalchemy.orm.attributes import flag_modified
 
+from broker import dns
 from broker.extensions import config, db
 from broker.models import ACMEUser, Certificate, Challenge, Operation
 from broker.tasks import huey
-from broker.acme_client import AcmeClient
+
+# acme, josepy, OpenSSL, and cryptography are imported inside the functions that
+# use them. They're slow to import, and the web app imports this module just to
+# queue tasks.
 
 logger = logging.getLogger(__name__)
 
@@ -30,19 +28,28 @@ class ChallengeNotFound(RuntimeError):
         super().__init__(f"Cannot find any challenges for {domain} in {obj}")
 
 
-def dns_challenge(order, domain):
-    """Extract authorization resource from within order resource."""
+def authorizations_by_domain(order) -> dict:
+    """Index the order's authorization resources by the domain they're for"""
+    return {
+        authorization.body.identifier.value: authorization
+        for authorization in order.authorizations
+    }
+
+
+def dns_challenge(authorizations: dict, domain):
+    """
+    Extract the DNS challenge for `domain` from the authorizations returned by
+    authorizations_by_domain.
+    """
+
+    from acme import challenges
 
+    authorization = authorizations.get(domain)
     # authorization.body.challenges is a set of ChallengeBody
     # objects.
-    challenges_for_domain = [
-        authorization.body.challenges
-        for authorization in order.authorizations
-        if authorization.body.identifier.value == domain
-    ][0]
-
-    if not challenges_for_domain:
-        raise ChallengeNotFound(domain, order.authorizations)
+    if authorization is None or not authorization.body.challenges:
+        raise ChallengeNotFound(domain, list(authorizations.values()))
+    challenges_for_domain = authorization.body.challenges
 
     for challenge in challenges_for_domain:
         if isinstance(challenge.chall, challenges.DNS01):
@@ -51,8 +58,41 @@ def dns_challenge(order, domain):
     raise DNSChallengeNotFound(domain, challenges_for_domain)
 
 
+def acme_client_for(acme_user: ACMEUser):
+    """An ACME client that acts as acme_user"""
+    import josepy
+    from acme import messages
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+
+    from broker.acme_client import AcmeClient, ThreadSafeClientNetwork
+
+    account_key = serialization.load_pem_private_key(
+        acme_user.private_key_pem.encode(), password=None, backend=default_backend()
+    )
+    wrapped_account_key = josepy.JWKRSA(key=account_key)
+
+    registration = json.loads(acme_user.registration_json)
+    # thread safe, so tasks can make requests in parallel
+    net = ThreadSafeClientNetwork(
+        wrapped_account_key,
+        user_agent="cloud.gov external domain broker",
+        account=registration,
+    )
+    directory = messages.Directory.from_json(net.get(config.ACME_DIRECTORY).json())
+    return AcmeClient(directory, net=net)
+
+
 @huey.retriable_task
 def create_user(operation_id: int, **kwargs):
+    import josepy
+    from acme import messages
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    from broker.acme_client import AcmeClient, ThreadSafeClientNetwork
+
     operation = Operation.query.get(operation_id)
 
     operation.step_description = "Registering user for Lets Encrypt"
@@ -78,7 +118,7 @@ def create_user(operation_id: int, **kwargs):
     )
     acme_user.private_key_pem = private_key_pem_in_binary.decode("utf-8")
 
-    net = client.ClientNetwork(key, user_agent="cloud.gov external domain broker")
+    net = ThreadSafeClientNetwork(key, user_agent="cloud.gov external domain broker")
     directory = messages.Directory.from_json(net.get(config.ACME_DIRECTORY).json())
     client_acme = AcmeClient(directory, net=net)
 
@@ -98,6 +138,9 @@ def create_user(operation_id: int, **kwargs):
 
 @huey.nonretriable_task
 def generate_private_key(operation_id: int, **kwargs):
+    import OpenSSL
+    from acme import crypto_util
+
     operation = Operation.query.get(operation_id)
     service_instance = operation.service_instance
 
@@ -153,30 +196,21 @@ def initiate_challenges(operation_id: int, **kwargs):
     if certificate.order_json is not None:
         return
 
-    account_key = serialization.load_pem_private_key(
-        acme_user.private_key_pem.encode(), password=None, backend=default_backend()
-    )
-    wrapped_account_key = josepy.JWKRSA(key=account_key)
-
-    registration = json.loads(acme_user.registration_json)
-    net = client.ClientNetwork(
-        wrapped_account_key,
-        user_agent="cloud.gov external domain broker",
-        account=registration,
-    )
-    directory = messages.Directory.from_json(net.get(config.ACME_DIRECTORY).json())
-    client_acme = AcmeClient(directory, net=net)
+    client_acme = acme_client_for(acme_user)
 
     order = client_acme.new_order(certificate.csr_pem.encode())
     order_json = json.dumps(order.to_json())
     certificate.order_json = json.dumps(order.to_json())
+    certificate.order_status = order.body.status.name
+    certificate.ordered_at = datetime.now(timezone.utc)
 
+    authorizations = authorizations_by_domain(order)
     for domain in service_instance.domain_names:
-        challenge_body = dns_challenge(order, domain)
+        challenge_body = dns_challenge(authorizations, domain)
         (
             challenge_response,
             challenge_validation_contents,
-        ) = challenge_body.response_and_validation(wrapped_account_key)
+        ) = challenge_body.response_and_validation(client_acme.net.key)
 
         challenge = Challenge()
         challenge.body_json = challenge_body.json_dumps()
@@ -192,6 +226,9 @@ def initiate_challenges(operation_id: int, **kwargs):
 
 @huey.retriable_task
 def answer_challenges(operation_id: int, **kwargs):
+    from acme import messages
+
+    from broker.acme_client import in_parallel
 
     operation = Operation.query.get(operation_id)
     service_instance = operation.service_instance
@@ -207,45 +244,50 @@ def answer_challenges(operation_id: int, **kwargs):
     if not unanswered:
         return
 
-    time.sleep(int(config.DNS_PROPAGATION_SLEEP_TIME))
-
-    account_key = serialization.load_pem_private_key(
-        acme_user.private_key_pem.encode(), password=None, backend=default_backend()
-    )
-    wrapped_account_key = josepy.JWKRSA(key=account_key)
-
-    registration = json.loads(acme_user.registration_json)
-    net = client.ClientNetwork(
-        wrapped_account_key,
-        user_agent="cloud.gov external domain broker",
-        account=registration,
-    )
-    directory = messages.Directory.from_json(net.get(config.ACME_DIRECTORY).json())
-    client_acme = AcmeClient(directory, net=net)
-
-    for challenge in unanswered:
-        if json.loads(challenge.body_json)["status"] == "valid":
+    txt_records = {
+        f"{challenge.validation_domain}.{config.DNS_ROOT_DOMAIN}": challenge.validation_contents
+        for challenge in unanswered
+    }
+    if not dns.wait_for_txt_records(
+        txt_records, timeout=int(config.DNS_PROPAGATION_SLEEP_TIME)
+    ):
+        logger.info("TXT records may not be visible everywhere yet, answering anyway")
+
+    client_acme = acme_client_for(acme_user)
+
+    # this runs in other threads, so it gets the JSON instead of the Challenge,
+    # which belongs to this thread's database session
+    def answer(body_json):
+        if json.loads(body_json)["status"] == "valid":
             # this covers an edge case where we run an update
             # shortly after initial provisioning or renewal
             # it arguably makes more sense to do when we get the challenges
             # but doing so makes testing worlds harder
-            challenge.answered = True
-            db.session.add(challenge)
-            db.session.commit()
-            continue
-        challenge_body = messages.ChallengeBody.from_json(
-            json.loads(challenge.body_json)
-        )
-        challenge_response = challenge_body.response(wrapped_account_key)
+            return
+        challenge_body = messages.ChallengeBody.from_json(json.loads(body_json))
+        challenge_response = challenge_body.response(client_acme.net.key)
         # Let the CA server know that we are ready for the challenge.
         client_acme.answer_challenge(challenge_body, challenge_response)
-        challenge.answered = True
-        db.session.add(challenge)
-        db.session.commit()
+
+    results = in_parallel(answer, [challenge.body_json for challenge in unanswered])
+    failures = []
+    for challenge, (_, _, exception) in zip(unanswered, results):
+        if exception is None:
+            challenge.answered = True
+            db.session.add(challenge)
+        else:
+            failures.append(exception)
+    # save the ones that worked, so we don't answer them again on retry
+    db.session.commit()
+    if failures:
+        raise failures[0]
 
 
 @huey.retriable_task
 def retrieve_certificate(operation_id: int, **kwargs):
+    import OpenSSL
+    from acme import errors, messages
+
     def cert_from_fullchain(fullchain_pem: str) -> str:
         """extract cert_pem from fullchain_pem
 
@@ -285,19 +327,7 @@ def retrieve_certificate(operation_id: int, **kwargs):
     if certificate.leaf_pem is not None:
         return
 
-    account_key = serialization.load_pem_private_key(
-        acme_user.private_key_pem.encode(), password=None, backend=default_backend()
-    )
-    wrapped_account_key = josepy.JWKRSA(key=account_key)
-
-    registration = json.loads(acme_user.registration_json)
-    net = client.ClientNetwork(
-        wrapped_account_key,
-        user_agent="cloud.gov external domain broker",
-        account=registration,
-    )
-    directory = messages.Directory.from_json(net.get(config.ACME_DIRECTORY).json())
-    client_acme = AcmeClient(directory, net=net)
+    client_acme = acme_client_for(acme_user)
 
     order_json = json.loads(certificate.order_json)
     # The csr_pem in the JSON is a binary string, but finalize_order() expects
@@ -305,35 +335,55 @@ def retrieve_certificate(operation_id: int, **kwargs):
     order_json["csr_pem"] = certificate.csr_pem
     order = messages.OrderResource.from_json(order_json)
 
-    deadline = datetime.now() + timedelta(seconds=config.ACME_POLL_TIMEOUT_IN_SECONDS)
+    # Move the order along as far as it'll go now. If the CA is still working on
+    # it, save where we got to and check again when the CA says to, instead of
+    # holding onto this worker.
+    deadline = time.monotonic() + config.ACME_POLL_TIMEOUT_IN_SECONDS
+    if certificate.ordered_at is None:
+        # orders placed before we started keeping track
+        certificate.ordered_at = datetime.now(timezone.utc)
+    give_up_at = certificate.ordered_at + timedelta(
+        seconds=config.ACME_MAX_ORDER_WAIT_IN_SECONDS
+    )
     try:
-        finalized_order = client_acme.poll_and_finalize(orderr=order, deadline=deadline)
+        while True:
+            order, retry_after = client_acme.refresh_order(order)
+            if order.body.status == messages.STATUS_READY:
+                # this may finish right away, or leave the order processing
+                order, retry_after = client_acme.begin_finalization(order)
+            certificate.order_status = order.body.status.name
+            if order.body.status in (messages.STATUS_VALID, messages.STATUS_INVALID):
+                break
+            db.session.add(certificate)
+            db.session.commit()
+            if time.monotonic() + retry_after > deadline:
+                if datetime.now(timezone.utc) >= give_up_at:
+                    # an ordinary error, so this uses up retries and fails the
+                    # operation like any other
+                    raise RuntimeError(
+                        f"gave up on order for {service_instance.domain_names}, "
+                        f"still {certificate.order_status} since {certificate.ordered_at}"
+                    )
+                raise huey.CheckAgainLater(retry_after)
+            time.sleep(retry_after)
+
+        if order.body.status == messages.STATUS_INVALID:
+            failed = client_acme.failed_authorizations(order)
+            if failed:
+                raise errors.ValidationError(failed)
+            raise errors.IssuanceError(order.body.error)
+
+        finalized_order = client_acme.fetch_certificate(order)
     except messages.Error as e:
-        # this means we're trying to fulfill an order that's already fulfilled
-        if """Order's status ("valid")""" in e.detail:
-            # Check if we got a certificate already. Do we have a cert, and does its expiration look good?
-            next_month = datetime.now() + timedelta(days=31)
-            next_month = next_month.replace(tzinfo=timezone.utc)
-            if (
-                certificate.expires_at is not None
-                and certificate.expires_at > next_month
-            ):
-                return
-            else:
-                finalized_order = client_acme.get_cert_for_finalized_order(
-                    order, deadline
-                )
-        else:
-            logger.error(
-                f"failed to retrieve certificate for {service_instance.domain_names} with code {e.code}, {e.description}, {e.detail}"
-            )
-            raise e
+        logger.error(
+            f"failed to retrieve certificate for {service_instance.domain_names} with code {e.code}, {e.description}, {e.detail}"
+        )
+        raise e
     except errors.ValidationError as e:
-            logger.error(
-                f"failed to retrieve certificate for {service_instance.domain_names} with errors {e.failed_authzrs}"
-            )
-            raise e
-
+        logger.error(
+            f"failed to retrieve certificate for {service_instance.domain_names} with errors {e.failed_authzrs}"
+        )
+        raise e
 
     certificate.leaf_pem, certificate.fullchain_pem = cert_from_fullchain(
         finalized_order.fullchain_pem
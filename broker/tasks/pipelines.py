@@ -1,19 +1,49 @@
 import logging
 
-from broker.tasks import alb, cloudfront, update_operations, iam, letsencrypt, route53
-from broker.tasks.huey import huey
+from broker.extensions import config
+from broker.models import Operation
+from broker.tasks import (
+    alb,
+    cloudfront,
+    dag,
+    update_operations,
+    iam,
+    letsencrypt,
+    route53,
+    validation,
+)
+from broker.tasks.huey import Priority, huey
 
 logger = logging.getLogger(__name__)
 
 
-def queue_all_alb_provision_tasks_for_operation(operation_id: int, correlation_id: str):
+def enqueue(task_pipeline, priority: Priority):
+    """Queue a pipeline, with every one of its tasks at the given priority"""
+    task = task_pipeline
+    while task is not None:
+        task.priority = priority
+        task = task.on_complete
+    huey.enqueue(task_pipeline)
+
+
+def start_provision_pipeline(operation_id: int, correlation: dict):
+    if config.ASYNC_PROVISION_VALIDATION:
+        return validation.validate_domains.s(operation_id, **correlation).then(
+            letsencrypt.create_user, operation_id, **correlation
+        )
+    return letsencrypt.create_user.s(operation_id, **correlation)
+
+
+def queue_all_alb_provision_tasks_for_operation(
+    operation_id: int, correlation_id: str, priority=Priority.PROVISION
+):
     if correlation_id is None:
         raise RuntimeError("correlation_id must be set")
     if operation_id is None:
         raise RuntimeError("operation_id must be set")
     correlation = {"correlation_id": correlation_id}
     task_pipeline = (
-        letsencrypt.create_user.s(operation_id, **correlation)
+        start_provision_pipeline(operation_id, correlation)
         .then(letsencrypt.generate_private_key, operation_id, **correlation)
         .then(letsencrypt.initiate_challenges, operation_id, **correlation)
         .then(route53.create_TXT_records, operation_id, **correlation)
@@ -27,36 +57,46 @@ def queue_all_alb_provision_tasks_for_operation(operation_id: int, correlation_i
         .then(route53.wait_for_changes, operation_id, **correlation)
         .then(update_operations.provision, operation_id, **correlation)
     )
-    huey.enqueue(task_pipeline)
+    enqueue(task_pipeline, priority)
+
+
+alb_deprovision_pipeline = dag.Pipeline(
+    "alb_deprovision",
+    [
+        dag.Step(update_operations.cancel_pending_provisioning),
+        dag.Step(route53.remove_ALIAS_records, after=["cancel_pending_provisioning"]),
+        dag.Step(route53.remove_TXT_records, after=["cancel_pending_provisioning"]),
+        # stop serving the certificate once DNS stops sending traffic our way
+        dag.Step(alb.remove_certificate_from_alb, after=["remove_ALIAS_records"]),
+        dag.Step(iam.delete_server_certificate, after=["remove_certificate_from_alb"]),
+        dag.Step(
+            update_operations.deprovision,
+            after=["remove_TXT_records", "delete_server_certificate"],
+        ),
+    ],
+)
 
 
 def queue_all_alb_deprovision_tasks_for_operation(
-    operation_id: int, correlation_id: str
+    operation_id: int, correlation_id: str, priority=Priority.DEPROVISION
 ):
     if correlation_id is None:
         raise RuntimeError("correlation_id must be set")
     if operation_id is None:
         raise RuntimeError("operation_id must be set")
-    correlation = {"correlation_id": correlation_id}
-    task_pipeline = (
-        update_operations.cancel_pending_provisioning.s(operation_id, **correlation)
-        .then(route53.remove_ALIAS_records, operation_id, **correlation)
-        .then(route53.remove_TXT_records, operation_id, **correlation)
-        .then(alb.remove_certificate_from_alb, operation_id, **correlation)
-        .then(iam.delete_server_certificate, operation_id, **correlation)
-        .then(update_operations.deprovision, operation_id, **correlation)
-    )
-    huey.enqueue(task_pipeline)
+    alb_deprovision_pipeline.enqueue(operation_id, correlation_id, priority)
 
 
-def queue_all_cdn_provision_tasks_for_operation(operation_id: int, correlation_id: str):
+def queue_all_cdn_provision_tasks_for_operation(
+    operation_id: int, correlation_id: str, priority=Priority.PROVISION
+):
     if correlation_id is None:
         raise RuntimeError("correlation_id must be set")
     if operation_id is None:
         raise RuntimeError("operation_id must be set")
     correlation = {"correlation_id": correlation_id}
     task_pipeline = (
-        letsencrypt.create_user.s(operation_id, **correlation)
+        start_provision_pipeline(operation_id, correlation)
         .then(letsencrypt.generate_private_key, operation_id, **correlation)
         .then(letsencrypt.initiate_challenges, operation_id, **correlation)
         .then(route53.create_TXT_records, operation_id, **correlation)
@@ -70,31 +110,79 @@ def queue_all_cdn_provision_tasks_for_operation(operation_id: int, correlation_i
         .then(route53.wait_for_changes, operation_id, **correlation)
         .then(update_operations.provision, operation_id, **correlation)
     )
-    huey.enqueue(task_pipeline)
+    enqueue(task_pipeline, priority)
+
+
+cdn_deprovision_pipeline = dag.Pipeline(
+    "cdn_deprovision",
+    [
+        dag.Step(update_operations.cancel_pending_provisioning),
+        dag.Step(route53.remove_ALIAS_records, after=["cancel_pending_provisioning"]),
+        dag.Step(route53.remove_TXT_records, after=["cancel_pending_provisioning"]),
+        # disabling takes the longest, so start it right away
+        dag.Step(
+            cloudfront.disable_distribution, after=["cancel_pending_provisioning"]
+        ),
+        dag.Step(
+            cloudfront.wait_for_distribution_disabled, after=["disable_distribution"]
+        ),
+        dag.Step(
+            cloudfront.delete_distribution, after=["wait_for_distribution_disabled"]
+        ),
+        # IAM won't delete a certificate while a distribution still has it
+        dag.Step(iam.delete_server_certificate, after=["delete_distribution"]),
+        dag.Step(
+            update_operations.deprovision,
+            after=[
+                "remove_ALIAS_records",
+                "remove_TXT_records",
+                "delete_server_certificate",
+            ],
+        ),
+    ],
+)
+
+
+# the same, but with the distribution and certificates left to
+# cron.reap_cloudfront_distributions
+cdn_deprovision_reaped_pipeline = dag.Pipeline(
+    "cdn_deprovision_reaped",
+    [
+        dag.Step(update_operations.cancel_pending_provisioning),
+        dag.Step(route53.remove_ALIAS_records, after=["cancel_pending_provisioning"]),
+        dag.Step(route53.remove_TXT_records, after=["cancel_pending_provisioning"]),
+        dag.Step(
+            cloudfront.disable_distribution, after=["cancel_pending_provisioning"]
+        ),
+        dag.Step(
+            update_operations.deprovision,
+            after=[
+                "remove_ALIAS_records",
+                "remove_TXT_records",
+                "disable_distribution",
+            ],
+        ),
+    ],
+)
 
 
 def queue_all_cdn_deprovision_tasks_for_operation(
-    operation_id: int, correlation_id: str
+    operation_id: int, correlation_id: str, priority=Priority.DEPROVISION
 ):
     if correlation_id is None:
         raise RuntimeError("correlation_id must be set")
     if operation_id is None:
         raise RuntimeError("operation_id must be set")
-    correlation = {"correlation_id": correlation_id}
-    task_pipeline = (
-        update_operations.cancel_pending_provisioning.s(operation_id, **correlation)
-        .then(route53.remove_ALIAS_records, operation_id, **correlation)
-        .then(route53.remove_TXT_records, operation_id, **correlation)
-        .then(cloudfront.disable_distribution, operation_id, **correlation)
-        .then(cloudfront.wait_for_distribution_disabled, operation_id, **correlation)
-        .then(cloudfront.delete_distribution, operation_id=operation_id, **correlation)
-        .then(iam.delete_server_certificate, operation_id, **correlation)
-        .then(update_operations.deprovision, operation_id, **correlation)
-    )
-    huey.enqueue(task_pipeline)
+    if config.CDN_DEPROVISION_REAPER:
+        pipeline = cdn_deprovision_reaped_pipeline
+    else:
+        pipeline = cdn_deprovision_pipeline
+    pipeline.enqueue(operation_id, correlation_id, priority)
 
 
-def queue_all_alb_renewal_tasks_for_operation(operation_id, **kwargs):
+def queue_all_alb_renewal_tasks_for_operation(
+    operation_id, priority=Priority.RENEWAL, **kwargs
+):
     correlation = {"correlation_id": "Renewal"}
     task_pipeline = (
         letsencrypt.generate_private_key.s(operation_id, **correlation)
@@ -108,14 +196,14 @@ def queue_all_alb_renewal_tasks_for_operation(operation_id, **kwargs):
         .then(alb.add_certificate_to_alb, operation_id, **correlation)
         .then(route53.create_ALIAS_records, operation_id, **correlation)
         .then(route53.wait_for_changes, operation_id, **correlation)
-        .then(alb.remove_certificate_from_previous_alb, operation_id, **correlation)
-        .then(iam.delete_previous_server_certificate, operation_id, **correlation)
-        .then(update_operations.provision, operation_id, **correlation)
+        .then(update_operations.complete_and_clean_up, operation_id, **correlation)
     )
-    huey.enqueue(task_pipeline)
+    enqueue(task_pipeline, priority)
 
 
-def queue_all_cdn_renewal_tasks_for_operation(operation_id, **kwargs):
+def queue_all_cdn_renewal_tasks_for_operation(
+    operation_id, priority=Priority.RENEWAL, **kwargs
+):
     correlation = {"correlation_id": "Renewal"}
     task_pipeline = (
         letsencrypt.generate_private_key.s(operation_id, **correlation)
@@ -126,14 +214,36 @@ def queue_all_cdn_renewal_tasks_for_operation(operation_id, **kwargs):
         .then(letsencrypt.retrieve_certificate, operation_id, **correlation)
         .then(iam.upload_server_certificate, operation_id, **correlation)
         .then(cloudfront.update_certificate, operation_id, **correlation)
-        .then(iam.delete_previous_server_certificate, operation_id, **correlation)
-        .then(update_operations.provision, operation_id, **correlation)
+        .then(update_operations.complete_and_clean_up, operation_id, **correlation)
+    )
+    enqueue(task_pipeline, priority)
+
+
+def reuses_certificate(operation_id) -> bool:
+    """Whether the update was told to keep the current certificate (see API.update)"""
+    service_instance = Operation.query.get(operation_id).service_instance
+    return (
+        service_instance.new_certificate_id is not None
+        and service_instance.new_certificate_id
+        == service_instance.current_certificate_id
     )
-    huey.enqueue(task_pipeline)
 
 
-def queue_all_cdn_update_tasks_for_operation(operation_id, correlation_id):
+def queue_all_cdn_update_tasks_for_operation(
+    operation_id, correlation_id, priority=Priority.UPDATE
+):
     correlation = {"correlation_id": correlation_id}
+    if reuses_certificate(operation_id):
+        # nothing to issue, upload, or clean up afterwards
+        task_pipeline = (
+            cloudfront.update_distribution.s(operation_id, **correlation)
+            .then(cloudfront.wait_for_distribution, operation_id, **correlation)
+            .then(route53.create_ALIAS_records, operation_id, **correlation)
+            .then(route53.wait_for_changes, operation_id, **correlation)
+            .then(update_operations.update_complete, operation_id, **correlation)
+        )
+        enqueue(task_pipeline, priority)
+        return
     task_pipeline = (
         letsencrypt.generate_private_key.s(operation_id, **correlation)
         .then(letsencrypt.initiate_challenges, operation_id, **correlation)
@@ -146,14 +256,24 @@ def queue_all_cdn_update_tasks_for_operation(operation_id, correlation_id):
         .then(cloudfront.wait_for_distribution, operation_id, **correlation)
         .then(route53.create_ALIAS_records, operation_id, **correlation)
         .then(route53.wait_for_changes, operation_id, **correlation)
-        .then(iam.delete_previous_server_certificate, operation_id, **correlation)
-        .then(update_operations.update_complete, operation_id, **correlation)
+        .then(update_operations.complete_and_clean_up, operation_id, **correlation)
     )
-    huey.enqueue(task_pipeline)
+    enqueue(task_pipeline, priority)
 
 
-def queue_all_alb_update_tasks_for_operation(operation_id, correlation_id):
+def queue_all_alb_update_tasks_for_operation(
+    operation_id, correlation_id, priority=Priority.UPDATE
+):
     correlation = {"correlation_id": correlation_id}
+    if reuses_certificate(operation_id):
+        # the certificate is already on the listener
+        task_pipeline = (
+            route53.create_ALIAS_records.s(operation_id, **correlation)
+            .then(route53.wait_for_changes, operation_id, **correlation)
+            .then(update_operations.update_complete, operation_id, **correlation)
+        )
+        enqueue(task_pipeline, priority)
+        return
     task_pipeline = (
         letsencrypt.generate_private_key.s(operation_id, **correlation)
         .then(letsencrypt.initiate_challenges, operation_id, **correlation)
@@ -166,14 +286,14 @@ def queue_all_alb_update_tasks_for_operation(operation_id, correlation_id):
         .then(alb.add_certificate_to_alb, operation_id, **correlation)
         .then(route53.create_ALIAS_records, operation_id, **correlation)
         .then(route53.wait_for_changes, operation_id, **correlation)
-        .then(alb.remove_certificate_from_previous_alb, operation_id, **correlation)
-        .then(iam.delete_previous_server_certificate, operation_id, **correlation)
-        .then(update_operations.provision, operation_id, **correlation)
+        .then(update_operations.complete_and_clean_up, operation_id, **correlation)
     )
-    huey.enqueue(task_pipeline)
+    enqueue(task_pipeline, priority)
 
 
-def queue_all_cdn_broker_migration_tasks_for_operation(operation_id, correlation_id):
+def queue_all_cdn_broker_migration_tasks_for_operation(
+    operation_id, correlation_id, priority=Priority.UPDATE
+):
     correlation = {"correlation_id": correlation_id}
     task_pipeline = (
         cloudfront.remove_s3_bucket_from_cdn_broker_instance.s(
@@ -194,10 +314,12 @@ def queue_all_cdn_broker_migration_tasks_for_operation(operation_id, correlation
         .then(iam.delete_previous_server_certificate, operation_id, **correlation)
         .then(update_operations.provision, operation_id, **correlation)
     )
-    huey.enqueue(task_pipeline)
+    enqueue(task_pipeline, priority)
 
 
-def queue_all_domain_broker_migration_tasks_for_operation(operation_id, correlation_id):
+def queue_all_domain_broker_migration_tasks_for_operation(
+    operation_id, correlation_id, priority=Priority.UPDATE
+):
     correlation = {"correlation_id": correlation_id}
     task_pipeline = (
         letsencrypt.create_user.s(operation_id, **correlation)
@@ -219,4 +341,26 @@ def queue_all_domain_broker_migration_tasks_for_operation(operation_id, correlat
         .then(iam.delete_previous_server_certificate, operation_id, **correlation)
         .then(update_operations.provision, operation_id, **correlation)
     )
-    huey.enqueue(task_pipeline)
+    enqueue(task_pipeline, priority)
+
+
+def queue_all_alb_cleanup_tasks_for_operation(
+    operation_id, correlation_id="Cleanup", priority=Priority.MAINTENANCE
+):
+    correlation = {"correlation_id": correlation_id}
+    task_pipeline = (
+        alb.remove_certificate_from_previous_alb.s(operation_id, **correlation)
+        .then(iam.delete_previous_server_certificate, operation_id, **correlation)
+        .then(update_operations.provision, operation_id, **correlation)
+    )
+    enqueue(task_pipeline, priority)
+
+
+def queue_all_cdn_cleanup_tasks_for_operation(
+    operation_id, correlation_id="Cleanup", priority=Priority.MAINTENANCE
+):
+    correlation = {"correlation_id": correlation_id}
+    task_pipeline = iam.delete_previous_server_certificate.s(
+        operation_id, **correlation
+    ).then(update_operations.provision, operation_id, **correlation)
+    enqueue(task_pipeline, priority)
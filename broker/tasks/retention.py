@@ -0,0 +1,151 @@
+"""
+Keeps the operation, challenge and certificate tables down to what we still
+use, by moving old rows into archived_row.
+
+Challenges only go along with their certificates: deprovisioning finds the
+TXT records to remove through the challenges of the certificates still here.
+
+Rows are moved a batch at a time, one transaction per batch, with a pause
+between batches so tasks and API requests get their turn at the database.
+Each archived row keeps its table name, its key, and the row itself as JSON,
+so the archive doesn't have to change when the tables do.
+"""
+
+from datetime import datetime, timedelta, timezone
+import logging
+import time
+
+from sqlalchemy import text
+
+from broker.extensions import config, db
+from broker.models import Operation
+
+logger = logging.getLogger(__name__)
+
+# everything belonging to an instance goes at once, so these batches are
+# counted in instances
+INSTANCES_PER_BATCH = 10
+
+# we don't keep private keys once we're done with a certificate
+OMITTED_COLUMNS = {"certificate": ["private_key_pem"]}
+
+FINISHED_OPERATIONS = """
+    (state != :in_progress OR canceled_at IS NOT NULL)
+    AND COALESCE(updated_at, created_at) < :cutoff
+"""
+
+
+def move_to_archive(table: str, where: str, key="id", limit=None, **params) -> int:
+    """
+    Move the rows of table matching where (at most limit of them) to
+    archived_row, and return how many were moved. The caller commits.
+    """
+    if limit is not None:
+        # rows a task has locked can wait for the next batch
+        where = f"""
+            {key} IN (
+                SELECT {key} FROM {table} WHERE {where}
+                ORDER BY {key} LIMIT :limit FOR UPDATE SKIP LOCKED
+            )
+        """
+        params["limit"] = limit
+    data = "to_jsonb(moved)"
+    for column in OMITTED_COLUMNS.get(table, []):
+        data += f" - '{column}'"
+    result = db.session.execute(
+        text(f"""
+            WITH moved AS (DELETE FROM {table} WHERE {where} RETURNING *)
+            INSERT INTO archived_row (table_name, row_id, data)
+            SELECT '{table}', CAST({key} AS text), {data} FROM moved
+            """),
+        params,
+    )
+    return result.rowcount
+
+
+def archive_deactivated_instances(cutoff: datetime, limit: int) -> int:
+    """Archive up to limit instances deactivated before cutoff, and all of their rows"""
+    ids = [
+        id_
+        for (id_,) in db.session.execute(
+            text("""
+                SELECT id FROM service_instance WHERE deactivated_at < :cutoff
+                ORDER BY id LIMIT :limit FOR UPDATE SKIP LOCKED
+                """),
+            dict(cutoff=cutoff, limit=limit),
+        )
+    ]
+    if not ids:
+        return 0
+    move_to_archive("operation", "service_instance_id = ANY(:ids)", ids=ids)
+    move_to_archive(
+        "challenge",
+        "certificate_id IN "
+        "(SELECT id FROM certificate WHERE service_instance_id = ANY(:ids))",
+        ids=ids,
+    )
+    move_to_archive(
+        "domain_reservation", "service_instance_id = ANY(:ids)", key="domain", ids=ids
+    )
+    # instances and certificates refer to each other, so copy the instances,
+    # then unhook their certificates, so the certificates can go, then them
+    db.session.execute(
+        text("""
+            INSERT INTO archived_row (table_name, row_id, data)
+            SELECT 'service_instance', id, to_jsonb(service_instance)
+            FROM service_instance WHERE id = ANY(:ids)
+            """),
+        dict(ids=ids),
+    )
+    db.session.execute(
+        text("""
+            UPDATE service_instance
+            SET current_certificate_id = NULL, new_certificate_id = NULL
+            WHERE id = ANY(:ids)
+            """),
+        dict(ids=ids),
+    )
+    move_to_archive("certificate", "service_instance_id = ANY(:ids)", ids=ids)
+    db.session.execute(
+        text("DELETE FROM service_instance WHERE id = ANY(:ids)"), dict(ids=ids)
+    )
+    return len(ids)
+
+
+def in_batches(archive_batch, batch_size: int) -> int:
+    """Call archive_batch, pausing between calls, until it's run out of work"""
+    total = 0
+    while True:
+        moved = archive_batch()
+        db.session.commit()
+        total += moved
+        if moved < batch_size:
+            return total
+        time.sleep(config.ARCHIVE_BATCH_PAUSE_SECONDS)
+
+
+def archive_old_rows() -> dict:
+    """Archive everything past its retention window, and return how much, by table"""
+    now = datetime.now(timezone.utc)
+    batch_size = config.ARCHIVE_BATCH_SIZE
+    archived = dict(
+        service_instance=in_batches(
+            lambda: archive_deactivated_instances(
+                now - timedelta(days=config.DEACTIVATED_INSTANCE_RETENTION_DAYS),
+                INSTANCES_PER_BATCH,
+            ),
+            INSTANCES_PER_BATCH,
+        ),
+        operation=in_batches(
+            lambda: move_to_archive(
+                "operation",
+                FINISHED_OPERATIONS,
+                limit=batch_size,
+                in_progress=Operation.States.IN_PROGRESS.value,
+                cutoff=now - timedelta(days=config.OPERATION_RETENTION_DAYS),
+            ),
+            batch_size,
+        ),
+    )
+    logger.info("Archived old rows: %s", archived)
+    return archived
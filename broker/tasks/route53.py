@@ -1,14 +1,161 @@
 import logging
 
+from botocore.exceptions import ClientError
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm.attributes import flag_modified
 
-from broker.aws import route53
+from broker import aws, rate_limit
 from broker.extensions import config, db
-from broker.models import Operation
+from broker.models import Operation, Route53Record
 from broker.tasks import huey
 
 logger = logging.getLogger(__name__)
 
+# well under Route53's limits on changes and record values per request
+MAX_CHANGES_PER_BATCH = 100
+
+
+def record_key(record_set):
+    # Route53 lists names fully qualified, with a trailing dot
+    return record_set["Name"].rstrip(".").lower(), record_set["Type"]
+
+
+def indexed(record_set):
+    """The parts of a record set we keep in the index, in a comparable form"""
+    result = {}
+    if "TTL" in record_set:
+        result["TTL"] = record_set["TTL"]
+    if "ResourceRecords" in record_set:
+        result["ResourceRecords"] = sorted(
+            r["Value"] for r in record_set["ResourceRecords"]
+        )
+    if "AliasTarget" in record_set:
+        target = record_set["AliasTarget"]
+        result["AliasTarget"] = {
+            "DNSName": target["DNSName"].rstrip(".").lower(),
+            "HostedZoneId": target["HostedZoneId"],
+            "EvaluateTargetHealth": target["EvaluateTargetHealth"],
+        }
+    return result
+
+
+# what the index holds for a record set we deleted, until a listing taken after
+# the delete replaces it - see replace_index
+DELETED = {}
+
+
+def index_clock():
+    """The time on the database's clock, which the index's timestamps use"""
+    return db.session.query(db.func.clock_timestamp()).scalar()
+
+
+def _upsert_into_index(entries):
+    """entries maps record_key to what the index should hold"""
+    # when the change was made, not when the transaction started, so
+    # replace_index can tell it from a listing
+    changed_at = db.func.clock_timestamp()
+    statement = insert(Route53Record).values(
+        [
+            dict(name=name, type=type_, record_set=record_set, updated_at=changed_at)
+            for (name, type_), record_set in entries.items()
+        ]
+    )
+    db.session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[Route53Record.name, Route53Record.type],
+            set_=dict(
+                record_set=statement.excluded.record_set,
+                updated_at=statement.excluded.updated_at,
+            ),
+        )
+    )
+
+
+def is_indexed(record_set) -> bool:
+    """Whether the index says the zone already has exactly this record set"""
+    record = Route53Record.query.get(record_key(record_set))
+    return record is not None and record.record_set == indexed(record_set)
+
+
+def change_record_sets(changes):
+    """
+    Send the changes to the zone and record them in the index. UPSERTs the index
+    says are already made are left out, and if that's all of them nothing is
+    sent. Returns the change ID, or None if nothing was sent.
+    """
+    changes = [
+        change
+        for change in changes
+        if not (
+            change["Action"] == "UPSERT" and is_indexed(change["ResourceRecordSet"])
+        )
+    ]
+    if not changes:
+        logger.info("Skipping DNS changes that are already made")
+        return None
+    route53_response = aws.route53.change_resource_record_sets(
+        ChangeBatch={"Changes": changes}, HostedZoneId=config.ROUTE53_ZONE_ID
+    )
+    entries = {}
+    for change in changes:
+        record_set = change["ResourceRecordSet"]
+        if change["Action"] == "DELETE":
+            # keep a row, so a listing that started before now can't put the
+            # record set back in the index
+            entries[record_key(record_set)] = DELETED
+        else:
+            entries[record_key(record_set)] = indexed(record_set)
+    _upsert_into_index(entries)
+    db.session.commit()
+    return route53_response["ChangeInfo"]["Id"]
+
+
+def list_zone():
+    """Every record set in the zone, by record_key"""
+    record_sets = {}
+    paginator = aws.route53.get_paginator("list_resource_record_sets")
+    for page in paginator.paginate(HostedZoneId=config.ROUTE53_ZONE_ID):
+        for record_set in page["ResourceRecordSets"]:
+            record_sets[record_key(record_set)] = record_set
+    return record_sets
+
+
+def replace_index(record_sets, listed_at):
+    """
+    Replace the index with record_sets, a listing from list_zone that started at
+    listed_at (from index_clock). Changes made since then may be missing from
+    the listing, so the index keeps those.
+    """
+    # in one transaction, so nobody sees the index empty
+    changed_at = db.func.coalesce(Route53Record.updated_at, Route53Record.created_at)
+    Route53Record.query.filter(changed_at < listed_at).delete(synchronize_session=False)
+    if record_sets:
+        statement = insert(Route53Record).values(
+            [
+                dict(
+                    name=name,
+                    type=type_,
+                    record_set=indexed(record_set),
+                    updated_at=listed_at,
+                )
+                for (name, type_), record_set in record_sets.items()
+            ]
+        )
+        # whatever's left changed after the listing started
+        db.session.execute(statement.on_conflict_do_nothing())
+    db.session.commit()
+
+
+def sync_zone_index():
+    """
+    Replace the index with a full listing of the zone. Returns the number of
+    record sets in the zone.
+    """
+    listed_at = index_clock()
+    record_sets = list_zone()
+    replace_index(record_sets, listed_at)
+    return len(record_sets)
+
 
 @huey.retriable_task
 def create_TXT_records(operation_id: int, **kwargs):
@@ -27,23 +174,21 @@ def create_TXT_records(operation_id: int, **kwargs):
         txt_record = f"{domain}.{config.DNS_ROOT_DOMAIN}"
         contents = challenge.validation_contents
         logger.info(f'Creating TXT record {txt_record} with contents "{contents}"')
-        route53_response = route53.change_resource_record_sets(
-            ChangeBatch={
-                "Changes": [
-                    {
-                        "Action": "UPSERT",
-                        "ResourceRecordSet": {
-                            "Type": "TXT",
-                            "Name": txt_record,
-                            "ResourceRecords": [{"Value": f'"{contents}"'}],
-                            "TTL": 60,
-                        },
-                    }
-                ]
-            },
-            HostedZoneId=config.ROUTE53_ZONE_ID,
+        change_id = change_record_sets(
+            [
+                {
+                    "Action": "UPSERT",
+                    "ResourceRecordSet": {
+                        "Type": "TXT",
+                        "Name": txt_record,
+                        "ResourceRecords": [{"Value": f'"{contents}"'}],
+                        "TTL": 60,
+                    },
+                }
+            ]
         )
-        change_id = route53_response["ChangeInfo"]["Id"]
+        if change_id is None:
+            continue
         logger.info(f"Saving Route53 TXT change ID: {change_id}")
         service_instance.route53_change_ids.append(change_id)
         flag_modified(service_instance, "route53_change_ids")
@@ -51,6 +196,27 @@ def create_TXT_records(operation_id: int, **kwargs):
         db.session.commit()
 
 
+def existing_TXT_records(names):
+    """The TXT record sets that exist for names, as Route53 lists them"""
+    record_sets = []
+    for name in sorted(names):
+        # records are listed in order, so the first one from here is the one
+        # we're after if it exists
+        response = aws.route53.list_resource_record_sets(
+            HostedZoneId=config.ROUTE53_ZONE_ID,
+            StartRecordName=name,
+            StartRecordType="TXT",
+            MaxItems="1",
+        )
+        for record_set in response["ResourceRecordSets"]:
+            if (
+                record_set["Type"] == "TXT"
+                and record_set["Name"].rstrip(".").lower() == name.lower()
+            ):
+                record_sets.append(record_set)
+    return record_sets
+
+
 @huey.nonretriable_task
 def remove_TXT_records(operation_id: int, **kwargs):
     operation = Operation.query.get(operation_id)
@@ -61,34 +227,30 @@ def remove_TXT_records(operation_id: int, **kwargs):
     db.session.add(operation)
     db.session.commit()
 
-    for certificate in service_instance.certificates:
-        for challenge in certificate.challenges:
-            domain = challenge.validation_domain
-            txt_record = f"{domain}.{config.DNS_ROOT_DOMAIN}"
-            contents = challenge.validation_contents
-            logger.info(f'Removing TXT record {txt_record} with contents "{contents}"')
-            try:
-                route53_response = route53.change_resource_record_sets(
-                    ChangeBatch={
-                        "Changes": [
-                            {
-                                "Action": "DELETE",
-                                "ResourceRecordSet": {
-                                    "Type": "TXT",
-                                    "Name": txt_record,
-                                    "ResourceRecords": [{"Value": f'"{contents}"'}],
-                                    "TTL": 60,
-                                },
-                            }
-                        ]
-                    },
-                    HostedZoneId=config.ROUTE53_ZONE_ID,
-                )
-            except:
-                logger.info("Ignoring error because we don't care")
-            else:
-                change_id = route53_response["ChangeInfo"]["Id"]
-                logger.info(f"Ignoring Route53 TXT change ID: {change_id}")
+    # every certificate the instance ever had left challenges behind, but there's
+    # only ever one record per domain
+    names = {
+        f"{challenge.validation_domain}.{config.DNS_ROOT_DOMAIN}"
+        for certificate in service_instance.certificates
+        for challenge in certificate.challenges
+    }
+    try:
+        record_sets = existing_TXT_records(names)
+        for start in range(0, len(record_sets), MAX_CHANGES_PER_BATCH):
+            batch = record_sets[start : start + MAX_CHANGES_PER_BATCH]
+            logger.info(
+                f"Removing TXT records {[record_set['Name'] for record_set in batch]}"
+            )
+            change_id = change_record_sets(
+                [
+                    {"Action": "DELETE", "ResourceRecordSet": record_set}
+                    for record_set in batch
+                ]
+            )
+            logger.info(f"Ignoring Route53 TXT change ID: {change_id}")
+    except (ClientError, rate_limit.RateLimitExceeded):
+        # leftover TXT records don't hurt anything, so don't fail the operation
+        logger.exception("Failed removing TXT records")
 
 
 @huey.retriable_task
@@ -105,7 +267,7 @@ def wait_for_changes(operation_id: int, **kwargs):
     logger.info(f"Waiting for {len(change_ids)} Route53 change IDs: {change_ids}")
     for change_id in change_ids:
         logger.info(f"Waiting for: {change_id}")
-        waiter = route53.get_waiter("resource_record_sets_changed")
+        waiter = aws.route53.get_waiter("resource_record_sets_changed")
         waiter.wait(
             Id=change_id,
             WaiterConfig={
@@ -135,38 +297,36 @@ def create_ALIAS_records(operation_id: str, **kwargs):
         alias_record = f"{domain}.{config.DNS_ROOT_DOMAIN}"
         target = service_instance.domain_internal
         logger.info(f'Creating ALIAS record {alias_record} pointing to "{target}"')
-        route53_response = route53.change_resource_record_sets(
-            ChangeBatch={
-                "Changes": [
-                    {
-                        "Action": "UPSERT",
-                        "ResourceRecordSet": {
-                            "Type": "A",
-                            "Name": alias_record,
-                            "AliasTarget": {
-                                "DNSName": target,
-                                "HostedZoneId": service_instance.route53_alias_hosted_zone,
-                                "EvaluateTargetHealth": False,
-                            },
+        change_id = change_record_sets(
+            [
+                {
+                    "Action": "UPSERT",
+                    "ResourceRecordSet": {
+                        "Type": "A",
+                        "Name": alias_record,
+                        "AliasTarget": {
+                            "DNSName": target,
+                            "HostedZoneId": service_instance.route53_alias_hosted_zone,
+                            "EvaluateTargetHealth": False,
                         },
                     },
-                    {
-                        "Action": "UPSERT",
-                        "ResourceRecordSet": {
-                            "Type": "AAAA",
-                            "Name": alias_record,
-                            "AliasTarget": {
-                                "DNSName": target,
-                                "HostedZoneId": service_instance.route53_alias_hosted_zone,
-                                "EvaluateTargetHealth": False,
-                            },
+                },
+                {
+                    "Action": "UPSERT",
+                    "ResourceRecordSet": {
+                        "Type": "AAAA",
+                        "Name": alias_record,
+                        "AliasTarget": {
+                            "DNSName": target,
+                            "HostedZoneId": service_instance.route53_alias_hosted_zone,
+                            "EvaluateTargetHealth": False,
                         },
                     },
-                ]
-            },
-            HostedZoneId=config.ROUTE53_ZONE_ID,
+                },
+            ]
         )
-        change_id = route53_response["ChangeInfo"]["Id"]
+        if change_id is None:
+            continue
         logger.info(f"Saving Route53 ALIAS change ID: {change_id}")
         service_instance.route53_change_ids.append(change_id)
         flag_modified(service_instance, "route53_change_ids")
@@ -191,39 +351,35 @@ def remove_ALIAS_records(operation_id: str, **kwargs):
         target = service_instance.domain_internal
         logger.info(f'Removing ALIAS record {alias_record} pointing to "{target}"')
         try:
-            route53_response = route53.change_resource_record_sets(
-                ChangeBatch={
-                    "Changes": [
-                        {
-                            "Action": "DELETE",
-                            "ResourceRecordSet": {
-                                "Type": "A",
-                                "Name": alias_record,
-                                "AliasTarget": {
-                                    "DNSName": target,
-                                    "HostedZoneId": service_instance.route53_alias_hosted_zone,
-                                    "EvaluateTargetHealth": False,
-                                },
+            change_id = change_record_sets(
+                [
+                    {
+                        "Action": "DELETE",
+                        "ResourceRecordSet": {
+                            "Type": "A",
+                            "Name": alias_record,
+                            "AliasTarget": {
+                                "DNSName": target,
+                                "HostedZoneId": service_instance.route53_alias_hosted_zone,
+                                "EvaluateTargetHealth": False,
                             },
                         },
-                        {
-                            "Action": "DELETE",
-                            "ResourceRecordSet": {
-                                "Type": "AAAA",
-                                "Name": alias_record,
-                                "AliasTarget": {
-                                    "DNSName": target,
-                                    "HostedZoneId": service_instance.route53_alias_hosted_zone,
-                                    "EvaluateTargetHealth": False,
-                                },
+                    },
+                    {
+                        "Action": "DELETE",
+                        "ResourceRecordSet": {
+                            "Type": "AAAA",
+                            "Name": alias_record,
+                            "AliasTarget": {
+                                "DNSName": target,
+                                "HostedZoneId": service_instance.route53_alias_hosted_zone,
+                                "EvaluateTargetHealth": False,
                             },
                         },
-                    ]
-                },
-                HostedZoneId=config.ROUTE53_ZONE_ID,
+                    },
+                ]
             )
         except:
             logger.info("Ignoring error because we don't care")
         else:
-            change_id = route53_response["ChangeInfo"]["Id"]
             logger.info(f"Not tracking change ID: {change_id}")
@@ -1,29 +1,115 @@
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from huey.exceptions import CancelExecution
+from redis import RedisError
+from sqlalchemy.exc import SQLAlchemyError
 
-from broker.extensions import db
+from broker.extensions import config, db
+from broker.validators import UniqueDomains
 from broker.models import Operation
 from broker.tasks import huey
 
 logger = logging.getLogger(__name__)
 
+# Redis set of the ids of canceled operations. Postgres is the source of truth,
+# this is just a cache so we don't have to hit the database before every task.
+CANCELED_OPERATIONS_KEY = "canceled_operations"
 
-@huey.huey.pre_execute(name="Cancel tasks for canceled operations")
-def cancel_canceled_operations(task):
-    with huey.huey.flask_app.app_context():
-        args, kwargs = task.data
-        op = None
+
+def _cancel_checked_key(operation_id) -> str:
+    # set when we've confirmed with postgres that an operation is not canceled
+    return f"operation_cancel_checked:{operation_id}"
+
+
+def mark_operations_canceled(operation_ids):
+    """
+    Flag operations as canceled in Redis. Call this after committing canceled_at.
+    """
+    operation_ids = [str(operation_id) for operation_id in operation_ids]
+    if operation_ids:
+        huey.huey.storage.conn.sadd(CANCELED_OPERATIONS_KEY, *operation_ids)
+
+
+def operation_is_canceled(operation_id) -> bool:
+    conn = huey.huey.storage.conn
+    pipe = conn.pipeline(transaction=False)
+    pipe.sismember(CANCELED_OPERATIONS_KEY, str(operation_id))
+    pipe.exists(_cancel_checked_key(operation_id))
+    flagged, checked = pipe.execute()
+    if flagged:
+        return True
+    if checked:
+        return False
+
+    # cache miss - ask postgres
+    with huey.flask_app().app_context():
         try:
-            # big assumption here: the first arg will always be the operation id.
-            op = Operation.query.get(args[0])
-        except:
-            return
+            canceled_at = (
+                db.session.query(Operation.canceled_at)
+                .filter(Operation.id == operation_id)
+                .scalar()
+            )
         finally:
             db.session.close()
-        if op.canceled_at is not None:
-            raise CancelExecution
+    if canceled_at is not None:
+        mark_operations_canceled([operation_id])
+        return True
+    conn.set(
+        _cancel_checked_key(operation_id),
+        1,
+        ex=config.CANCELED_OPERATIONS_CACHE_TTL_IN_SECONDS,
+    )
+    return False
+
+
+def reconcile_canceled_operations():
+    """
+    Bring the Redis canceled set in line with postgres. This picks up operations
+    canceled or un-canceled by hand in the database.
+    """
+    conn = huey.huey.storage.conn
+    # tasks for an operation stop retrying after a few hours, so we don't need to
+    # remember cancellations forever
+    cutoff = datetime.utcnow() - timedelta(days=1)
+    # read the set before postgres, so an operation canceled in between is
+    # only ever added, never removed
+    flagged = {member.decode() for member in conn.smembers(CANCELED_OPERATIONS_KEY)}
+    canceled = {
+        str(operation_id)
+        for (operation_id,) in db.session.query(Operation.id).filter(
+            Operation.state == Operation.States.IN_PROGRESS.value,
+            Operation.canceled_at.isnot(None),
+            Operation.canceled_at > cutoff,
+        )
+    }
+    pipe = conn.pipeline()
+    if flagged - canceled:
+        pipe.srem(CANCELED_OPERATIONS_KEY, *(flagged - canceled))
+    if canceled - flagged:
+        pipe.sadd(CANCELED_OPERATIONS_KEY, *(canceled - flagged))
+    pipe.execute()
+    return sorted(canceled)
+
+
+@huey.huey.pre_execute(name="Cancel tasks for canceled operations")
+def cancel_canceled_operations(task):
+    args, kwargs = task.data
+    if not args:
+        # not part of an operation, like the cron tasks
+        return
+    try:
+        # big assumption here: the first arg will always be the operation id.
+        canceled = operation_is_canceled(args[0])
+    except (RedisError, SQLAlchemyError) as e:
+        # better to run a task for a canceled operation than to drop one
+        logger.exception(
+            msg=f"exception checking whether operation {args[0]} is canceled",
+            exc_info=e,
+        )
+        return
+    if canceled:
+        raise CancelExecution
 
 
 @huey.retriable_task
@@ -40,10 +126,53 @@ def update_complete(operation_id: str, **kwargs):
     operation = Operation.query.get(operation_id)
     operation.state = Operation.States.SUCCEEDED.value
     operation.step_description = "Complete!"
+    service_instance = operation.service_instance
+    if service_instance.new_certificate_id == service_instance.current_certificate_id:
+        # the update reused the current certificate
+        service_instance.new_certificate = None
+        db.session.add(service_instance)
     db.session.add(operation)
     db.session.commit()
 
 
+@huey.retriable_task
+def complete_and_clean_up(operation_id: str, **kwargs):
+    """
+    Mark the operation complete, then remove whatever it replaced (the previous
+    certificate, and for ALBs the previous listener) in a separate Cleanup
+    operation. The customer doesn't have to wait for that, and it gets its own
+    retries and alerts.
+    """
+    # pipelines imports this module
+    from broker.tasks.pipelines import (
+        queue_all_alb_cleanup_tasks_for_operation,
+        queue_all_cdn_cleanup_tasks_for_operation,
+    )
+
+    operation = Operation.query.get(operation_id)
+    if operation.state == Operation.States.SUCCEEDED.value:
+        # we've been here before and the Cleanup operation exists - if queuing it
+        # failed, restart_stalled_pipelines will pick it up
+        return
+    operation.state = Operation.States.SUCCEEDED.value
+    operation.step_description = "Complete!"
+    db.session.add(operation)
+
+    cleanup = Operation(
+        state=Operation.States.IN_PROGRESS.value,
+        service_instance=operation.service_instance,
+        action=Operation.Actions.CLEANUP.value,
+        step_description="Queuing tasks",
+    )
+    db.session.add(cleanup)
+    db.session.commit()
+
+    if operation.service_instance.instance_type == "cdn_service_instance":
+        queue_all_cdn_cleanup_tasks_for_operation(cleanup.id)
+    else:
+        queue_all_alb_cleanup_tasks_for_operation(cleanup.id)
+
+
 @huey.retriable_task
 def deprovision(operation_id: str, **kwargs):
     operation = Operation.query.get(operation_id)
@@ -54,6 +183,7 @@ def deprovision(operation_id: str, **kwargs):
     service_instance = operation.service_instance
     service_instance.deactivated_at = datetime.utcnow()
     service_instance.private_key_pem = None
+    UniqueDomains.release(service_instance)
     db.session.add(service_instance)
 
     db.session.commit()
@@ -63,11 +193,17 @@ def deprovision(operation_id: str, **kwargs):
 def cancel_pending_provisioning(operation_id: str, **kwargs):
     operation = Operation.query.get(operation_id)
     service_instance = operation.service_instance
+    canceled = []
     for op in service_instance.operations:
         if (
             op.action != Operation.Actions.DEPROVISION.value
+            # cleanup only touches the previous certificate, which deprovisioning
+            # leaves alone, so let it finish
+            and op.action != Operation.Actions.CLEANUP.value
             and op.state == Operation.States.IN_PROGRESS.value
         ):
             op.canceled_at = datetime.utcnow()
             db.session.add(op)
+            canceled.append(op.id)
     db.session.commit()
+    mark_operations_canceled(canceled)
@@ -0,0 +1,44 @@
+import logging
+from datetime import datetime
+
+from openbrokerapi import errors
+from sqlalchemy.orm.attributes import flag_modified
+
+from broker import validators
+from broker.extensions import db
+from broker.models import Operation
+from broker.tasks import huey
+from broker.tasks.update_operations import mark_operations_canceled
+
+logger = logging.getLogger(__name__)
+
+
+@huey.retriable_task
+def validate_domains(operation_id: int, **kwargs):
+    """
+    Run the provision-time checks when config.ASYNC_PROVISION_VALIDATION is set.
+    A failed check fails the operation and stops the rest of the pipeline.
+    """
+    operation = Operation.query.get(operation_id)
+    service_instance = operation.service_instance
+
+    operation.step_description = "Validating domains"
+    flag_modified(operation, "step_description")
+    db.session.add(operation)
+    db.session.commit()
+
+    domain_names = service_instance.domain_names
+    try:
+        validators.CNAME(domain_names).validate()
+        validators.UniqueDomains(domain_names).validate(service_instance)
+    except errors.ErrBadRequest as e:
+        logger.info(f"domain validation failed for operation {operation_id}: {e}")
+        operation.state = Operation.States.FAILED.value
+        operation.step_description = str(e)
+        # canceling the operation stops the rest of the pipeline
+        operation.canceled_at = datetime.utcnow()
+        validators.UniqueDomains.release(service_instance)
+        db.session.add(operation)
+        db.session.add(service_instance)
+        db.session.commit()
+        mark_operations_canceled([operation.id])
@@ -4,7 +4,7 @@ from typing import List
 from openbrokerapi import errors
 
 from broker.dns import acme_challenge_cname_name, acme_challenge_cname_target, get_cname
-from broker.models import ServiceInstance
+from broker.models import DomainReservation, ServiceInstance
 
 
 class CNAME:
@@ -27,7 +27,8 @@ class CNAME:
             raise errors.ErrBadRequest("\n".join(msg))
 
     def _instructions(self, domains: List[str]) -> List[str]:
-        return [self._error_for_domain(d) for d in domains if self._error_for_domain(d)]
+        errors = [self._error_for_domain(d) for d in domains]
+        return [error for error in errors if error]
 
     def _error_for_domain(self, domain: str) -> str:
         cname = get_cname(acme_challenge_cname_name(domain))
@@ -61,26 +62,57 @@ class UniqueDomains:
         self.domains = domains
 
     def validate(self, ignore_instance: ServiceInstance = None):
+        # on the primary: a replica that's behind could miss an instance that
+        # was just given one of these domains
         instructions = self._instructions(self.domains, ignore_instance)
 
         if instructions:
-            msg = [
-                "An external domain service already exists for the following domains:"
-            ]
+            self._raise(instructions)
+
+    def reserve(self, instance: ServiceInstance):
+        """
+        Reserve our domains for the instance, replacing any reservations it
+        already has. Reservations are only guaranteed once they're committed -
+        use check_reservations if the commit fails.
+        """
+        self.check_reservations(instance.id)
+        reservations = {r.domain: r for r in instance.domain_reservations}
+        instance.domain_reservations = [
+            reservations.get(domain) or DomainReservation(domain=domain)
+            for domain in self.domains
+        ]
 
-            for error in instructions:
-                msg.append("  " + error)
+    def check_reservations(self, instance_id: str):
+        reserved = self._reserved_by_others(self.domains, instance_id)
+        if reserved:
+            self._raise(reserved)
 
-            raise errors.ErrBadRequest("\n".join(msg))
+    @staticmethod
+    def release(instance: ServiceInstance):
+        instance.domain_reservations = []
+
+    def _raise(self, instructions: List[str]):
+        msg = ["An external domain service already exists for the following domains:"]
+
+        for error in instructions:
+            msg.append("  " + error)
+
+        raise errors.ErrBadRequest("\n".join(msg))
+
+    def _reserved_by_others(self, domains: List[str], instance_id: str) -> List[str]:
+        return [
+            reservation.domain
+            for reservation in DomainReservation.query.filter(
+                DomainReservation.domain.in_(domains),
+                DomainReservation.service_instance_id != instance_id,
+            ).order_by(DomainReservation.domain)
+        ]
 
     def _instructions(
         self, domains: List[str], ignore_instance: ServiceInstance = None
     ) -> List[str]:
-        return [
-            self._error_for_domain(d, ignore_instance)
-            for d in domains
-            if self._error_for_domain(d, ignore_instance)
-        ]
+        errors = [self._error_for_domain(d, ignore_instance) for d in domains]
+        return [error for error in errors if error]
 
     def _error_for_domain(
         self, domain: str, ignore_instance: ServiceInstance = None
@@ -0,0 +1,70 @@
+import pytest  # noqa F401
+
+from tests.integration.alb import (
+    test_alb_deprovisioning,
+    test_alb_provisioning,
+    test_alb_renewals,
+)
+
+# fixtures from the integration tests we run
+service_instance = test_alb_deprovisioning.service_instance
+alb_instance_needing_renewal = test_alb_renewals.alb_instance_needing_renewal
+
+
+def test_alb_provision_and_update(
+    pipeline_benchmark, client, dns, tasks, route53, iam_govcloud, simple_regex, alb
+):
+    with pipeline_benchmark.scenario("alb_provision_and_update"):
+        test_alb_provisioning.test_provision_happy_path(
+            client, dns, tasks, route53, iam_govcloud, simple_regex, alb
+        )
+
+
+def test_alb_renewal(
+    pipeline_benchmark,
+    clean_db,
+    alb_instance_needing_renewal,
+    tasks,
+    route53,
+    dns,
+    iam_govcloud,
+    simple_regex,
+    cloudfront,
+    alb,
+):
+    with pipeline_benchmark.scenario("alb_renewal"):
+        test_alb_renewals.test_scan_for_expiring_certs_alb_happy_path(
+            clean_db,
+            alb_instance_needing_renewal,
+            tasks,
+            route53,
+            dns,
+            iam_govcloud,
+            simple_regex,
+            cloudfront,
+            alb,
+        )
+
+
+def test_alb_deprovision(
+    pipeline_benchmark,
+    client,
+    service_instance,
+    dns,
+    tasks,
+    route53,
+    iam_govcloud,
+    simple_regex,
+    alb,
+):
+    with pipeline_benchmark.scenario("alb_deprovision"):
+        test_alb_deprovisioning.test_deprovision_happy_path(
+            client,
+            service_instance,
+            dns,
+            tasks,
+            route53,
+            iam_govcloud,
+            simple_regex,
+            alb,
+        )
@@ -0,0 +1,75 @@
+import pytest  # noqa F401
+
+from tests.integration.cdn import (
+    test_cdn_deprovisioning,
+    test_cdn_provisioning,
+    test_cdn_renewals,
+)
+
+# fixtures from the integration tests we run
+service_instance = test_cdn_deprovisioning.service_instance
+cdn_instance_needing_renewal = test_cdn_renewals.cdn_instance_needing_renewal
+
+
+def test_cdn_provision_and_update(
+    pipeline_benchmark,
+    client,
+    dns,
+    tasks,
+    route53,
+    iam_commercial,
+    simple_regex,
+    cloudfront,
+):
+    with pipeline_benchmark.scenario("cdn_provision_and_update"):
+        test_cdn_provisioning.test_provision_happy_path(
+            client, dns, tasks, route53, iam_commercial, simple_regex, cloudfront
+        )
+
+
+def test_cdn_renewal(
+    pipeline_benchmark,
+    clean_db,
+    cdn_instance_needing_renewal,
+    tasks,
+    route53,
+    dns,
+    iam_commercial,
+    simple_regex,
+    cloudfront,
+):
+    with pipeline_benchmark.scenario("cdn_renewal"):
+        test_cdn_renewals.test_scan_for_expiring_certs_cdn_happy_path(
+            clean_db,
+            cdn_instance_needing_renewal,
+            tasks,
+            route53,
+            dns,
+            iam_commercial,
+            simple_regex,
+            cloudfront,
+        )
+
+
+def test_cdn_deprovision(
+    pipeline_benchmark,
+    client,
+    service_instance,
+    dns,
+    tasks,
+    route53,
+    iam_commercial,
+    simple_regex,
+    cloudfront,
+):
+    with pipeline_benchmark.scenario("cdn_deprovision"):
+        test_cdn_deprovisioning.test_deprovision_happy_path(
+            client,
+            service_instance,
+            dns,
+            tasks,
+            route53,
+            iam_commercial,
+            simple_regex,
+            cloudfront,
+        )
@@ -0,0 +1,91 @@
+"""
+How long a fresh process takes to be useful: the web app serving its first
+request, and the huey consumer finishing its first task. Each is measured in
+a new interpreter, so nothing is already imported.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from tests.lib.benchmark import RESULTS_PATH, _update_json
+
+MAX_SECONDS_TO_FIRST_REQUEST = float(
+    os.environ.get("BENCHMARK_MAX_SECONDS_TO_FIRST_REQUEST", "3")
+)
+MAX_SECONDS_TO_FIRST_TASK = float(
+    os.environ.get("BENCHMARK_MAX_SECONDS_TO_FIRST_TASK", "3")
+)
+
+# only the task workers need these
+HEAVY_MODULES = ["boto3", "botocore.client", "acme", "josepy", "OpenSSL"]
+
+FIRST_REQUEST = """
+import time
+start = time.perf_counter()
+
+from broker.app import create_app
+from tests.lib.client import broker_headers
+
+app = create_app()
+response = app.test_client().get("/v2/catalog", headers=broker_headers())
+assert response.status_code == 200, response.data
+"""
+
+FIRST_TASK = """
+import time
+start = time.perf_counter()
+
+from broker.huey_consumer import huey
+from broker.tasks.cron import refresh_canceled_operations
+
+# what the consumer does when it starts
+for hook in huey._startup.values():
+    hook()
+huey.execute(refresh_canceled_operations.s())
+"""
+
+REPORT = """
+import json, sys
+print(json.dumps(dict(
+    seconds=time.perf_counter() - start,
+    imported=[m for m in {modules!r} if m in sys.modules],
+)))
+"""
+
+
+def measure(script: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", script + REPORT.format(modules=HEAVY_MODULES)],
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, FLASK_ENV="test"),
+    )
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def test_web_app_does_not_import_task_dependencies():
+    measurement = measure(FIRST_REQUEST)
+
+    assert measurement["imported"] == []
+
+
+@pytest.mark.parametrize(
+    "name,script,budget",
+    [
+        ("first_request", FIRST_REQUEST, MAX_SECONDS_TO_FIRST_REQUEST),
+        ("first_task", FIRST_TASK, MAX_SECONDS_TO_FIRST_TASK),
+    ],
+)
+def test_time_to_first(name, script, budget, clean_db):
+    if not os.environ.get("RUN_BENCHMARKS"):
+        pytest.skip("set RUN_BENCHMARKS=1 to run benchmarks")
+
+    seconds = measure(script)["seconds"]
+    _update_json(RESULTS_PATH, {f"startup_{name}": dict(seconds=round(seconds, 4))})
+
+    assert seconds <= budget, f"{name} took {seconds:.2f}s (budget {budget}s)"
@@ -5,17 +5,24 @@ from tests.lib.client import (
     no_context_clean_db,
     no_context_app,
 )  # noqa 401
+from tests.lib.benchmark import pipeline_benchmark  # noqa F401
 from tests.lib.fake_alb import alb  # noqa F401
 from tests.lib.fake_cloudfront import cloudfront  # noqa F401
 from tests.lib.fake_iam import iam_commercial, iam_govcloud  # noqa F401
 from tests.lib.fake_route53 import route53  # noqa F401
 from tests.lib.simple_regex import simple_regex  # noqa F401
 from tests.lib.dns import dns  # noqa 401
+from tests.lib.query_budget import query_budgets  # noqa 401
 from tests.lib.tasks import tasks  # noqa 401
 
 
 def pytest_configure(config):
     config.addinivalue_line("markers", "focus: Only run this test.")
+    config.addinivalue_line(
+        "markers",
+        "query_budget(path, queries, seconds): "
+        "Limit the database queries made by an endpoint or task.",
+    )
 
 
 def pytest_collection_modifyitems(items, config):
@@ -92,11 +92,7 @@ def test_deprovision_happy_path(
         client, service_instance
     )
     check_last_operation_description(client, "1234", operation_id, "Queuing tasks")
-    subtest_deprovision_removes_ALIAS_records(tasks, route53)
-    check_last_operation_description(
-        client, "1234", operation_id, "Removing DNS ALIAS records"
-    )
-    subtest_deprovision_removes_TXT_records(tasks, route53)
+    subtest_deprovision_removes_ALIAS_and_TXT_records(tasks, route53)
     check_last_operation_description(
         client, "1234", operation_id, "Removing DNS TXT records"
     )
@@ -132,27 +128,27 @@ def subtest_deprovision_creates_deprovision_operation(client, service_instance):
     return operation_id
 
 
-def subtest_deprovision_removes_ALIAS_records(tasks, route53):
+def subtest_deprovision_removes_ALIAS_and_TXT_records(tasks, route53):
     route53.expect_remove_ALIAS(
         "example.com.domains.cloud.test", "fake1234.cloud.test", "ALBHOSTEDZONEID"
     )
     route53.expect_remove_ALIAS(
         "foo.com.domains.cloud.test", "fake1234.cloud.test", "ALBHOSTEDZONEID"
     )
-
-    # one for marking provisioning tasks canceled, which is tested elsewhere
-    tasks.run_queued_tasks_and_enqueue_dependents()
-    tasks.run_queued_tasks_and_enqueue_dependents()
-
-    route53.assert_no_pending_responses()
-
-
-def subtest_deprovision_removes_TXT_records(tasks, route53):
-    route53.expect_remove_TXT(
+    route53.expect_list_TXT(
         "_acme-challenge.example.com.domains.cloud.test", "example txt"
     )
-    route53.expect_remove_TXT("_acme-challenge.foo.com.domains.cloud.test", "foo txt")
+    route53.expect_list_TXT("_acme-challenge.foo.com.domains.cloud.test", "foo txt")
+    route53.expect_remove_TXT_records(
+        {
+            "_acme-challenge.example.com.domains.cloud.test": "example txt",
+            "_acme-challenge.foo.com.domains.cloud.test": "foo txt",
+        }
+    )
 
+    # one for marking provisioning tasks canceled, which is tested elsewhere
+    tasks.run_queued_tasks_and_enqueue_dependents()
+    # these don't depend on each other, so they're queued together
     tasks.run_queued_tasks_and_enqueue_dependents()
 
     route53.assert_no_pending_responses()
@@ -424,6 +424,7 @@ def subtest_provision_marks_operation_as_succeeded(tasks):
     tasks.run_queued_tasks_and_enqueue_dependents()
     db.session.expunge_all()
     service_instance = ALBServiceInstance.query.get("4321")
-    operation = service_instance.operations.first()
+    # the operation itself, not the Cleanup operation it queues
+    operation = service_instance.operations.order_by(Operation.id).first()
     assert operation
     assert "succeeded" == operation.state
@@ -23,6 +23,7 @@ from tests.integration.alb.test_alb_provisioning import (
 )
 from tests.integration.alb.test_alb_update import (
     subtest_update_creates_private_key_and_csr,
+    subtest_update_marks_cleanup_complete,
 )
 from tests.lib.factories import (
     ALBServiceInstanceFactory,
@@ -128,9 +129,10 @@ def test_scan_for_expiring_certs_alb_happy_path(
     subtest_provision_adds_certificate_to_alb(tasks, alb)
     subtest_provision_provisions_ALIAS_records(tasks, route53, alb)
     subtest_provision_waits_for_route53_changes(tasks, route53)
+    subtest_provision_marks_operation_as_succeeded(tasks)
     subtest_renewal_removes_certificate_from_alb(tasks, alb)
     subtest_renewal_removes_certificate_from_iam(tasks, iam_govcloud)
-    subtest_provision_marks_operation_as_succeeded(tasks)
+    subtest_update_marks_cleanup_complete(tasks)
 
 
 def subtest_queues_tasks():
@@ -1,10 +1,10 @@
 import json
-from datetime import date, datetime
+from datetime import date, datetime, timedelta, timezone
 
 import pytest  # noqa F401
 
 from broker.extensions import config, db
-from broker.models import Challenge, Operation, ALBServiceInstance
+from broker.models import Challenge, Operation, ALBServiceInstance, Route53Record
 from broker.tasks.huey import huey
 from broker.tasks.letsencrypt import create_user, generate_private_key
 
@@ -177,6 +177,42 @@ def test_refuses_update_for_instance_with_operation(client, dns, service_instanc
     assert client.response.status_code == 400
 
 
+def test_update_to_the_current_certificates_domains_reuses_it(
+    client, dns, tasks, route53, service_instance
+):
+    # an earlier update changed the domains, but never got a certificate for them
+    service_instance = ALBServiceInstance.query.get("4321")
+    service_instance.domain_names = ["bar.com", "foo.com"]
+    certificate = service_instance.current_certificate
+    certificate.subject_alternative_names = ["example.com", "foo.com"]
+    certificate.expires_at = datetime.now(timezone.utc) + timedelta(days=60)
+    db.session.add(service_instance)
+    db.session.add(certificate)
+    db.session.commit()
+    db.session.expunge_all()
+    dns.add_cname("_acme-challenge.example.com")
+    dns.add_cname("_acme-challenge.foo.com")
+
+    client.update_alb_instance("4321", params={"domains": "example.com, foo.com"})
+    assert client.response.status_code == 202, client.response.body
+
+    # no ACME, TXT, IAM or listener steps, so the ALIAS records come first
+    for domain in ["example.com", "foo.com"]:
+        route53.expect_create_ALIAS_and_return_change_id(
+            f"{domain}.domains.cloud.test", "fake1234.cloud.test"
+        )
+    tasks.run_queued_tasks_and_enqueue_dependents()
+    route53.assert_no_pending_responses()
+    subtest_waits_for_dns_changes(tasks, route53)
+    subtest_update_marks_update_complete(tasks)
+
+    instance = ALBServiceInstance.query.get("4321")
+    assert len(instance.certificates) == 1
+    assert instance.current_certificate.id == 1001
+    assert instance.new_certificate is None
+    assert not instance.has_active_operations()
+
+
 def subtest_update_happy_path(
     client, dns, tasks, route53, iam_govcloud, simple_regex, alb
 ):
@@ -193,9 +229,10 @@ def subtest_update_happy_path(
     subtest_update_adds_certificate_to_alb(tasks, alb)
     subtest_update_provisions_ALIAS_records(tasks, route53, alb)
     subtest_waits_for_dns_changes(tasks, route53)
+    subtest_update_marks_update_complete(tasks)
     subtest_update_removes_certificate_from_alb(tasks, alb)
     subtest_update_removes_certificate_from_iam(tasks, iam_govcloud)
-    subtest_update_marks_update_complete(tasks)
+    subtest_update_marks_cleanup_complete(tasks)
 
 
 def subtest_update_creates_private_key_and_csr(tasks):
@@ -380,24 +417,40 @@ def subtest_update_adds_certificate_to_alb(tasks, alb):
 def subtest_update_provisions_ALIAS_records(tasks, route53, alb):
     db.session.expunge_all()
     service_instance = ALBServiceInstance.query.get("4321")
-    example_com_change_id = route53.expect_create_ALIAS_and_return_change_id(
+    route53.expect_create_ALIAS_and_return_change_id(
         "bar.com.domains.cloud.test", "alb.cloud.test", "ALBHOSTEDZONEID"
     )
-    foo_com_change_id = route53.expect_create_ALIAS_and_return_change_id(
-        "foo.com.domains.cloud.test", "alb.cloud.test", "ALBHOSTEDZONEID"
-    )
+    # if we provisioned the instance earlier in the test, foo.com's records are
+    # already there, and the index knows it
+    if not Route53Record.query.get(("foo.com.domains.cloud.test", "A")):
+        route53.expect_create_ALIAS_and_return_change_id(
+            "foo.com.domains.cloud.test", "alb.cloud.test", "ALBHOSTEDZONEID"
+        )
     tasks.run_queued_tasks_and_enqueue_dependents()
+    route53.assert_no_pending_responses()
 
 
 def subtest_update_marks_update_complete(tasks):
     tasks.run_queued_tasks_and_enqueue_dependents()
     db.session.expunge_all()
     service_instance = ALBServiceInstance.query.get("4321")
-    operation = service_instance.operations.first()
+    # the operation itself, not the Cleanup operation it queues
+    operation = service_instance.operations.order_by(Operation.id).first()
     assert operation
     assert "succeeded" == operation.state
 
 
+def subtest_update_marks_cleanup_complete(tasks):
+    tasks.run_queued_tasks_and_enqueue_dependents()
+    db.session.expunge_all()
+    service_instance = ALBServiceInstance.query.get("4321")
+    cleanup = service_instance.operations.filter_by(
+        action=Operation.Actions.CLEANUP.value
+    ).one()
+    assert "succeeded" == cleanup.state
+    assert not service_instance.has_active_operations()
+
+
 def subtest_update_removes_certificate_from_alb(tasks, alb):
     alb.expect_remove_certificate_from_listener(
         "listener-arn-0",
@@ -1,7 +1,10 @@
+from datetime import datetime
+
 import pytest  # noqa F401
 
-from broker.extensions import db
+from broker.extensions import config, db
 from broker.models import Operation, CDNServiceInstance
+from broker.tasks.cron import reap_cloudfront_distributions
 from tests.lib import factories
 from tests.lib.client import check_last_operation_description
 
@@ -96,11 +99,11 @@ def test_deprovision_continues_when_resources_dont_exist(
     cloudfront,
 ):
     subtest_deprovision_creates_deprovision_operation(client, service_instance)
-    subtest_deprovision_removes_ALIAS_records_when_missing(tasks, route53)
-    subtest_deprovision_removes_TXT_records_when_missing(tasks, route53)
-
-    subtest_deprovision_disables_cloudfront_distribution_when_missing(
-        tasks, service_instance, cloudfront
+    expect_remove_ALIAS_records_when_missing(route53)
+    expect_remove_TXT_records_when_missing(route53)
+    expect_disable_cloudfront_distribution_when_missing(service_instance, cloudfront)
+    subtest_deprovision_removes_records_and_disables_distribution(
+        tasks, route53, cloudfront
     )
     subtest_deprovision_waits_for_cloudfront_distribution_disabled_when_missing(
         tasks, service_instance, cloudfront
@@ -127,16 +130,11 @@ def test_deprovision_happy_path(
         client, service_instance
     )
     check_last_operation_description(client, "1234", operation_id, "Queuing tasks")
-    subtest_deprovision_removes_ALIAS_records(tasks, route53)
-    check_last_operation_description(
-        client, "1234", operation_id, "Removing DNS ALIAS records"
-    )
-    subtest_deprovision_removes_TXT_records(tasks, route53)
-    check_last_operation_description(
-        client, "1234", operation_id, "Removing DNS TXT records"
-    )
-    subtest_deprovision_disables_cloudfront_distribution(
-        tasks, service_instance, cloudfront
+    expect_remove_ALIAS_records(route53)
+    expect_remove_TXT_records(route53)
+    expect_disable_cloudfront_distribution(service_instance, cloudfront)
+    subtest_deprovision_removes_records_and_disables_distribution(
+        tasks, route53, cloudfront
     )
     check_last_operation_description(
         client, "1234", operation_id, "Disabling CloudFront distribution"
@@ -163,6 +161,106 @@ def test_deprovision_happy_path(
     check_last_operation_description(client, "1234", operation_id, "Complete!")
 
 
+def test_deprovision_with_reaper_leaves_distribution_to_the_reaper(
+    client,
+    service_instance,
+    dns,
+    tasks,
+    route53,
+    iam_commercial,
+    simple_regex,
+    cloudfront,
+    monkeypatch,
+):
+    monkeypatch.setattr(config, "CDN_DEPROVISION_REAPER", True)
+    operation_id = subtest_deprovision_creates_deprovision_operation(
+        client, service_instance
+    )
+    expect_remove_ALIAS_records(route53)
+    expect_remove_TXT_records(route53)
+    expect_disable_cloudfront_distribution(service_instance, cloudfront)
+    subtest_deprovision_removes_records_and_disables_distribution(
+        tasks, route53, cloudfront
+    )
+    subtest_deprovision_marks_operation_as_succeeded(tasks)
+    check_last_operation_description(client, "1234", operation_id, "Complete!")
+
+    subtest_reaper_skips_distributions_still_disabling(cloudfront)
+    subtest_reaper_deletes_disabled_distribution(cloudfront, iam_commercial)
+
+
+def test_reaper_cleans_up_certificates_when_distribution_is_gone(
+    clean_db, service_instance, cloudfront, iam_commercial
+):
+    service_instance = CDNServiceInstance.query.get("1234")
+    service_instance.deactivated_at = datetime.utcnow()
+    db.session.add(service_instance)
+    db.session.commit()
+    cloudfront.expect_list_distributions([])
+    iam_commercial.expects_delete_server_certificate_returning_no_such_entity(
+        name="new_certificate_name"
+    )
+    iam_commercial.expects_delete_server_certificate_returning_no_such_entity(
+        name="certificate_name"
+    )
+
+    assert reap_cloudfront_distributions.call_local() == ["1234"]
+
+    cloudfront.assert_no_pending_responses()
+    iam_commercial.assert_no_pending_responses()
+    db.session.expunge_all()
+    assert CDNServiceInstance.query.get("1234").cloudfront_distribution_id is None
+
+
+def test_reaper_ignores_active_instances(clean_db, service_instance, cloudfront):
+    assert reap_cloudfront_distributions.call_local() == []
+
+    cloudfront.assert_no_pending_responses()
+
+
+def subtest_reaper_skips_distributions_still_disabling(cloudfront):
+    cloudfront.expect_list_distributions(
+        [dict(id="FakeDistributionId", status="InProgress", enabled=False)]
+    )
+
+    assert reap_cloudfront_distributions.call_local() == []
+
+    cloudfront.assert_no_pending_responses()
+    db.session.expunge_all()
+    service_instance = CDNServiceInstance.query.get("1234")
+    assert service_instance.cloudfront_distribution_id == "FakeDistributionId"
+
+
+def subtest_reaper_deletes_disabled_distribution(cloudfront, iam_commercial):
+    service_instance = CDNServiceInstance.query.get("1234")
+    cloudfront.expect_list_distributions(
+        [
+            dict(id="SomeOtherDistributionId", status="Deployed", enabled=True),
+            dict(id="FakeDistributionId", status="Deployed", enabled=False),
+        ]
+    )
+    cloudfront.expect_get_distribution(
+        caller_reference=service_instance.id,
+        domains=service_instance.domain_names,
+        certificate_id=service_instance.current_certificate.iam_server_certificate_id,
+        origin_hostname=service_instance.cloudfront_origin_hostname,
+        origin_path=service_instance.cloudfront_origin_path,
+        distribution_id="FakeDistributionId",
+        status="Deployed",
+        enabled=False,
+    )
+    cloudfront.expect_delete_distribution(distribution_id="FakeDistributionId")
+    iam_commercial.expects_delete_server_certificate("new_certificate_name")
+    iam_commercial.expects_delete_server_certificate("certificate_name")
+
+    assert reap_cloudfront_distributions.call_local() == ["1234"]
+
+    cloudfront.assert_no_pending_responses()
+    iam_commercial.assert_no_pending_responses()
+    db.session.expunge_all()
+    assert CDNServiceInstance.query.get("1234").cloudfront_distribution_id is None
+
+
 def subtest_deprovision_creates_deprovision_operation(client, service_instance):
     client.deprovision_cdn_instance("1234", accepts_incomplete="true")
 
@@ -180,61 +278,53 @@ def subtest_deprovision_creates_deprovision_operation(client, service_instance):
     return operation_id
 
 
-def subtest_deprovision_removes_TXT_records_when_missing(tasks, route53):
-    route53.expect_remove_missing_TXT(
-        "example.com.domains.cloud.test", "fake1234.cloudfront.net"
-    )
-    route53.expect_remove_missing_TXT(
-        "foo.com.domains.cloud.test", "fake1234.cloudfront.net"
-    )
-
+def subtest_deprovision_removes_records_and_disables_distribution(
+    tasks, route53, cloudfront
+):
+    # one for marking provisioning tasks canceled, which is tested elsewhere
+    tasks.run_queued_tasks_and_enqueue_dependents()
+    # these don't depend on each other, so they're queued together
     tasks.run_queued_tasks_and_enqueue_dependents()
 
     route53.assert_no_pending_responses()
+    cloudfront.assert_no_pending_responses()
 
 
-def subtest_deprovision_removes_ALIAS_records_when_missing(tasks, route53):
+def expect_remove_TXT_records_when_missing(route53):
+    route53.expect_list_TXT("_acme-challenge.example.com.domains.cloud.test")
+    route53.expect_list_TXT("_acme-challenge.foo.com.domains.cloud.test")
+
+
+def expect_remove_ALIAS_records_when_missing(route53):
     route53.expect_remove_missing_ALIAS(
-        "_acme-challenge.example.com.domains.cloud.test", "example txt"
+        "example.com.domains.cloud.test", "fake1234.cloudfront.net"
     )
     route53.expect_remove_missing_ALIAS(
-        "_acme-challenge.foo.com.domains.cloud.test", "foo txt"
+        "foo.com.domains.cloud.test", "fake1234.cloudfront.net"
     )
 
-    # one for marking provisioning tasks canceled, which is tested elsewhere
-    tasks.run_queued_tasks_and_enqueue_dependents()
-    tasks.run_queued_tasks_and_enqueue_dependents()
-
-    route53.assert_no_pending_responses()
-
 
-def subtest_deprovision_removes_ALIAS_records(tasks, route53):
+def expect_remove_ALIAS_records(route53):
     route53.expect_remove_ALIAS(
         "example.com.domains.cloud.test", "fake1234.cloudfront.net"
     )
     route53.expect_remove_ALIAS("foo.com.domains.cloud.test", "fake1234.cloudfront.net")
 
-    # one for marking provisioning tasks canceled, which is tested elsewhere
-    tasks.run_queued_tasks_and_enqueue_dependents()
-    tasks.run_queued_tasks_and_enqueue_dependents()
-
-    route53.assert_no_pending_responses()
-
 
-def subtest_deprovision_removes_TXT_records(tasks, route53):
-    route53.expect_remove_TXT(
+def expect_remove_TXT_records(route53):
+    route53.expect_list_TXT(
         "_acme-challenge.example.com.domains.cloud.test", "example txt"
     )
-    route53.expect_remove_TXT("_acme-challenge.foo.com.domains.cloud.test", "foo txt")
-
-    tasks.run_queued_tasks_and_enqueue_dependents()
-
-    route53.assert_no_pending_responses()
+    route53.expect_list_TXT("_acme-challenge.foo.com.domains.cloud.test", "foo txt")
+    route53.expect_remove_TXT_records(
+        {
+            "_acme-challenge.example.com.domains.cloud.test": "example txt",
+            "_acme-challenge.foo.com.domains.cloud.test": "foo txt",
+        }
+    )
 
 
-def subtest_deprovision_disables_cloudfront_distribution(
-    tasks, service_instance, cloudfront
-):
+def expect_disable_cloudfront_distribution(service_instance, cloudfront):
     service_instance = CDNServiceInstance.query.get("1234")
     cloudfront.expect_get_distribution_config(
         caller_reference=service_instance.id,
@@ -253,8 +343,6 @@ def subtest_deprovision_disables_cloudfront_distribution(
         distribution_id=service_instance.cloudfront_distribution_id,
         distribution_hostname=service_instance.domain_internal,
     )
-    tasks.run_queued_tasks_and_enqueue_dependents()
-    cloudfront.assert_no_pending_responses()
 
 
 def subtest_deprovision_waits_for_cloudfront_distribution_disabled(
@@ -307,15 +395,11 @@ def subtest_deprovision_removes_cloudfront_distribution(
     cloudfront.assert_no_pending_responses()
 
 
-def subtest_deprovision_disables_cloudfront_distribution_when_missing(
-    tasks, service_instance, cloudfront
-):
+def expect_disable_cloudfront_distribution_when_missing(service_instance, cloudfront):
     service_instance = CDNServiceInstance.query.get("1234")
     cloudfront.expect_get_distribution_config_returning_no_such_distribution(
         distribution_id=service_instance.cloudfront_distribution_id
     )
-    tasks.run_queued_tasks_and_enqueue_dependents()
-    cloudfront.assert_no_pending_responses()
 
 
 def subtest_deprovision_waits_for_cloudfront_distribution_disabled_when_missing(
@@ -19,6 +19,7 @@ from tests.integration.cdn.test_cdn_provisioning import (
 )
 from tests.integration.cdn.test_cdn_update import (
     subtest_update_creates_private_key_and_csr,
+    subtest_update_marks_cleanup_complete,
 )
 from tests.lib.factories import (
     CDNServiceInstanceFactory,
@@ -122,8 +123,9 @@ def test_scan_for_expiring_certs_cdn_happy_path(
     subtest_renew_retrieves_certificate(tasks)
     subtest_provision_uploads_certificate_to_iam(tasks, iam_commercial, simple_regex)
     subtest_updates_certificate_in_cloudfront(tasks, cloudfront)
-    subtest_renewal_removes_certificate_from_iam(tasks, iam_commercial)
     subtest_provision_marks_operation_as_succeeded(tasks)
+    subtest_renewal_removes_certificate_from_iam(tasks, iam_commercial)
+    subtest_update_marks_cleanup_complete(tasks)
 
 
 def subtest_queues_tasks():
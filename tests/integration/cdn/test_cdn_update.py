@@ -1,10 +1,10 @@
 import json
-from datetime import date, datetime
+from datetime import date, datetime, timedelta, timezone
 
 import pytest  # noqa F401
 
 from broker.extensions import config, db
-from broker.models import Challenge, Operation, CDNServiceInstance
+from broker.models import Challenge, Operation, CDNServiceInstance, Route53Record
 from broker.tasks.huey import huey
 from broker.tasks.letsencrypt import create_user, generate_private_key
 
@@ -200,6 +200,39 @@ def test_refuses_update_for_instance_with_operation(client, dns, service_instanc
     assert client.response.status_code == 400
 
 
+@pytest.mark.parametrize(
+    "subject_alternative_names,days_left,reused",
+    [
+        (["example.com", "foo.com"], 60, True),
+        (["example.com", "foo.com"], 10, False),
+        # certificates from before we recorded SANs
+        (None, 60, True),
+        ([], 60, True),
+    ],
+)
+def test_update_reuses_current_certificate_unless_it_is_due_for_renewal(
+    client, dns, service_instance, subject_alternative_names, days_left, reused
+):
+    service_instance = CDNServiceInstance.query.get("4321")
+    assert sorted(service_instance.domain_names) == ["example.com", "foo.com"]
+    certificate = service_instance.current_certificate
+    certificate.subject_alternative_names = subject_alternative_names
+    certificate.expires_at = datetime.now(timezone.utc) + timedelta(days=days_left)
+    # what a finished operation leaves behind
+    service_instance.new_certificate = None
+    db.session.add(service_instance)
+    db.session.add(certificate)
+    db.session.commit()
+    db.session.expunge_all()
+
+    client.update_cdn_instance("4321", params={"origin": "new-origin.com"})
+    db.session.expunge_all()
+
+    assert client.response.status_code == 202, client.response.body
+    instance = CDNServiceInstance.query.get("4321")
+    assert (instance.new_certificate_id == 1001) == reused
+
+
 def test_provision_sets_default_origin_if_provided_as_none(
     client, dns, service_instance
 ):
@@ -367,8 +400,9 @@ def subtest_update_happy_path(
     subtest_update_waits_for_cloudfront_update(tasks, cloudfront)
     subtest_update_updates_ALIAS_records(tasks, route53)
     subtest_waits_for_dns_changes(tasks, route53)
-    subtest_update_removes_certificate_from_iam(tasks, iam_commercial)
     subtest_update_marks_update_complete(tasks)
+    subtest_update_removes_certificate_from_iam(tasks, iam_commercial)
+    subtest_update_marks_cleanup_complete(tasks)
 
 
 def subtest_update_creates_private_key_and_csr(tasks):
@@ -641,11 +675,23 @@ def subtest_update_marks_update_complete(tasks):
     tasks.run_queued_tasks_and_enqueue_dependents()
     db.session.expunge_all()
     service_instance = CDNServiceInstance.query.get("4321")
-    operation = service_instance.operations.first()
+    # the operation itself, not the Cleanup operation it queues
+    operation = service_instance.operations.order_by(Operation.id).first()
     assert operation
     assert "succeeded" == operation.state
 
 
+def subtest_update_marks_cleanup_complete(tasks):
+    tasks.run_queued_tasks_and_enqueue_dependents()
+    db.session.expunge_all()
+    service_instance = CDNServiceInstance.query.get("4321")
+    cleanup = service_instance.operations.filter_by(
+        action=Operation.Actions.CLEANUP.value
+    ).one()
+    assert "succeeded" == cleanup.state
+    assert not service_instance.has_active_operations()
+
+
 def subtest_update_removes_certificate_from_iam(tasks, iam_commercial):
     iam_commercial.expects_delete_server_certificate(
         f"4321-{date.today().isoformat()}-1"
@@ -662,17 +708,13 @@ def subtest_update_same_domains(
     client, dns, tasks, route53, iam_commercial, simple_regex, cloudfront
 ):
     subtest_update_same_domains_creates_update_operation(client, dns)
-    subtest_update_same_domains_does_not_create_new_certificate(tasks)
-    subtest_update_same_domains_does_not_create_new_challenges(tasks)
-    subtest_update_same_domains_does_not_update_route53(tasks, route53)
-    subtest_update_same_domains_does_not_retrieve_new_certificate(tasks)
-    subtest_update_same_domains_does_not_update_iam(tasks)
+    subtest_update_same_domains_reuses_certificate()
     subtest_update_same_domains_updates_cloudfront(tasks, cloudfront)
     subtest_update_waits_for_cloudfront_update(tasks, cloudfront)
     subtest_update_updates_ALIAS_records(tasks, route53)
     subtest_waits_for_dns_changes(tasks, route53)
-    subtest_update_same_domains_does_not_delete_server_certificate(tasks)
     subtest_update_marks_update_complete(tasks)
+    subtest_update_same_domains_does_not_clean_up(tasks)
 
 
 def subtest_update_same_domains_creates_update_operation(client, dns):
@@ -706,39 +748,12 @@ def subtest_update_same_domains_creates_update_operation(client, dns):
     return operation_id
 
 
-def subtest_update_same_domains_does_not_create_new_certificate(tasks):
-    tasks.run_queued_tasks_and_enqueue_dependents()
+def subtest_update_same_domains_reuses_certificate():
+    # the pipeline goes straight to CloudFront, with no ACME, TXT or IAM steps
     instance = CDNServiceInstance.query.get("4321")
     assert len(instance.certificates) == 1
-
-
-def subtest_update_same_domains_does_not_create_new_challenges(tasks):
-    tasks.run_queued_tasks_and_enqueue_dependents()
-    instance = CDNServiceInstance.query.get("4321")
-    certificate = instance.new_certificate
-    assert len(certificate.challenges.all()) == 2
-    assert all([c.answered for c in certificate.challenges])
-
-
-def subtest_update_same_domains_does_not_update_route53(tasks, route53):
-    tasks.run_queued_tasks_and_enqueue_dependents()
-    instance = CDNServiceInstance.query.get("4321")
+    assert instance.new_certificate.id == instance.current_certificate.id
     assert not instance.route53_change_ids
-    # should run wait for changes, which should do nothing
-    tasks.run_queued_tasks_and_enqueue_dependents()
-
-
-def subtest_update_same_domains_does_not_retrieve_new_certificate(tasks):
-    # the idea here is that we don't have new challenges, so asking
-    # for a new certificate should raise an error.
-    # no errors = did not try to ask for a new certificate
-    tasks.run_queued_tasks_and_enqueue_dependents()  # answer_challenges
-    tasks.run_queued_tasks_and_enqueue_dependents()  # retrieve_certificate
-
-
-def subtest_update_same_domains_does_not_update_iam(tasks):
-    # if we don't prime IAM to expect a call, then we didn't update iam
-    tasks.run_queued_tasks_and_enqueue_dependents()
 
 
 def subtest_update_same_domains_updates_cloudfront(tasks, cloudfront):
@@ -797,22 +812,33 @@ def subtest_update_same_domains_updates_cloudfront(tasks, cloudfront):
     assert service_instance.current_certificate.id == id_
 
 
-def subtest_update_same_domains_does_not_delete_server_certificate(tasks):
+def subtest_update_same_domains_does_not_clean_up(tasks):
     tasks.run_queued_tasks_and_enqueue_dependents()
+    db.session.expunge_all()
     instance = CDNServiceInstance.query.get("4321")
     assert len(instance.certificates) == 1
+    assert instance.new_certificate is None
+    assert not instance.operations.filter_by(
+        action=Operation.Actions.CLEANUP.value
+    ).count()
+    assert not instance.has_active_operations()
 
 
 def subtest_update_updates_ALIAS_records(tasks, route53):
-    bar_com_change_id = route53.expect_create_ALIAS_and_return_change_id(
-        "bar.com.domains.cloud.test", "fake1234.cloudfront.net"
-    )
-    foo_com_change_id = route53.expect_create_ALIAS_and_return_change_id(
-        "foo.com.domains.cloud.test", "fake1234.cloudfront.net"
-    )
+    change_ids = []
+    # records an earlier part of the test created are already there, and the
+    # index knows it
+    for domain in ["bar.com", "foo.com"]:
+        name = f"{domain}.domains.cloud.test"
+        if not Route53Record.query.get((name, "A")):
+            change_ids.append(
+                route53.expect_create_ALIAS_and_return_change_id(
+                    name, "fake1234.cloudfront.net"
+                )
+            )
 
     tasks.run_queued_tasks_and_enqueue_dependents()
     route53.assert_no_pending_responses()
     db.session.expunge_all()
     service_instance = CDNServiceInstance.query.get("4321")
-    assert service_instance.route53_change_ids == [bar_com_change_id, foo_com_change_id]
+    assert service_instance.route53_change_ids == change_ids
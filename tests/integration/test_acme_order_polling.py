@@ -0,0 +1,143 @@
+import datetime
+
+from acme import messages
+import pytest
+
+from broker.acme_client import AcmeClient
+from broker.extensions import config, db
+from broker.models import ALBServiceInstance
+from broker.tasks.huey import CheckAgainLater, huey
+from broker.tasks.letsencrypt import retrieve_certificate
+
+from tests.integration.alb.test_alb_provisioning import (
+    subtest_provision_answers_challenges,
+    subtest_provision_creates_LE_user,
+    subtest_provision_creates_private_key_and_csr,
+    subtest_provision_creates_provision_operation,
+    subtest_provision_initiates_LE_challenge,
+    subtest_provision_updates_TXT_records,
+    subtest_provision_waits_for_route53_changes,
+)
+from tests.lib.tasks import fallible_huey
+
+
+def test_check_again_later_reschedules_without_using_a_retry(clean_db):
+    @huey.task(retries=2, retry_delay=600)
+    def waiting_task():
+        raise CheckAgainLater(30)
+
+    with fallible_huey():
+        huey.execute(waiting_task.s())
+
+    [scheduled] = huey.scheduled()
+    huey.flush()
+    assert scheduled.retries == 2
+    assert scheduled.retry_delay == 30
+    delay = scheduled.eta - datetime.datetime.utcnow()
+    assert datetime.timedelta(seconds=20) < delay <= datetime.timedelta(seconds=30)
+
+
+def test_failing_after_checking_again_backs_off_as_usual(clean_db):
+    runs = []
+
+    @huey.task(retries=2, retry_delay=45)
+    def waiting_then_failing_task():
+        runs.append(len(runs))
+        if len(runs) == 1:
+            raise CheckAgainLater(30)
+        raise RuntimeError("nope")
+
+    with fallible_huey():
+        huey.execute(waiting_then_failing_task.s())
+        [scheduled] = huey.scheduled()
+        huey.flush()
+        huey.execute(scheduled, timestamp=scheduled.eta)
+
+    [scheduled] = huey.scheduled()
+    huey.flush()
+    assert len(runs) == 2
+    assert scheduled.retries == 1
+    assert scheduled.retry_delay == 45
+
+
+def test_retrieve_certificate_checks_again_while_order_is_processing(
+    client, dns, tasks, route53, monkeypatch
+):
+    subtest_provision_creates_provision_operation(client, dns)
+    subtest_provision_creates_LE_user(tasks)
+    subtest_provision_creates_private_key_and_csr(tasks)
+    subtest_provision_initiates_LE_challenge(tasks)
+    subtest_provision_updates_TXT_records(tasks, route53)
+    subtest_provision_waits_for_route53_changes(tasks, route53)
+    subtest_provision_answers_challenges(tasks, dns)
+
+    instance = ALBServiceInstance.query.get("4321")
+    assert instance.new_certificate.order_status == "pending"
+    operation_id = instance.operations[0].id
+
+    refresh_order = AcmeClient.refresh_order
+
+    def processing(self, orderr):
+        orderr, _ = refresh_order(self, orderr)
+        body = orderr.body.update(status=messages.STATUS_PROCESSING)
+        return orderr.update(body=body), 120
+
+    monkeypatch.setattr(AcmeClient, "refresh_order", processing)
+    with pytest.raises(CheckAgainLater) as e:
+        retrieve_certificate.call_local(operation_id)
+    assert e.value.delay == 120
+
+    db.session.expunge_all()
+    certificate = ALBServiceInstance.query.get("4321").new_certificate
+    assert certificate.order_status == "processing"
+    assert certificate.leaf_pem is None
+
+    monkeypatch.undo()
+    retrieve_certificate.call_local(operation_id)
+
+    db.session.expunge_all()
+    certificate = ALBServiceInstance.query.get("4321").new_certificate
+    assert certificate.order_status == "valid"
+    assert certificate.leaf_pem is not None
+
+
+def test_retrieve_certificate_gives_up_on_orders_that_never_finish(
+    client, dns, tasks, route53, monkeypatch
+):
+    subtest_provision_creates_provision_operation(client, dns)
+    subtest_provision_creates_LE_user(tasks)
+    subtest_provision_creates_private_key_and_csr(tasks)
+    subtest_provision_initiates_LE_challenge(tasks)
+    subtest_provision_updates_TXT_records(tasks, route53)
+    subtest_provision_waits_for_route53_changes(tasks, route53)
+    subtest_provision_answers_challenges(tasks, dns)
+
+    instance = ALBServiceInstance.query.get("4321")
+    assert instance.new_certificate.ordered_at is not None
+    operation_id = instance.operations[0].id
+
+    refresh_order = AcmeClient.refresh_order
+
+    def processing(self, orderr):
+        orderr, _ = refresh_order(self, orderr)
+        body = orderr.body.update(status=messages.STATUS_PROCESSING)
+        return orderr.update(body=body), 120
+
+    monkeypatch.setattr(AcmeClient, "refresh_order", processing)
+    with pytest.raises(CheckAgainLater):
+        retrieve_certificate.call_local(operation_id)
+
+    certificate = ALBServiceInstance.query.get("4321").new_certificate
+    certificate.ordered_at -= datetime.timedelta(
+        seconds=config.ACME_MAX_ORDER_WAIT_IN_SECONDS + 1
+    )
+    db.session.add(certificate)
+    db.session.commit()
+
+    with pytest.raises(RuntimeError, match="gave up on order"):
+        retrieve_certificate.call_local(operation_id)
+
+    db.session.expunge_all()
+    certificate = ALBServiceInstance.query.get("4321").new_certificate
+    assert certificate.order_status == "processing"
+    assert certificate.leaf_pem is None
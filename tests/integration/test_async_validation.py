@@ -0,0 +1,140 @@
+import pytest
+
+from broker import validators
+from broker.extensions import config, db
+from broker.models import ALBServiceInstance, DomainReservation, Operation
+from broker.tasks.update_operations import deprovision
+from tests.lib.factories import ALBServiceInstanceFactory, OperationFactory
+
+
+@pytest.fixture
+def async_validation(monkeypatch):
+    monkeypatch.setattr(config, "ASYNC_PROVISION_VALIDATION", True)
+
+
+def reserved_domains():
+    db.session.expunge_all()
+    return {
+        reservation.domain: reservation.service_instance_id
+        for reservation in DomainReservation.query.all()
+    }
+
+
+def test_provision_responds_without_checking_cnames(client, async_validation):
+    client.provision_alb_instance("4321", params={"domains": "bar.com,foo.com"})
+
+    assert client.response.status_code == 202, client.response.body
+    assert reserved_domains() == {"bar.com": "4321", "foo.com": "4321"}
+
+
+def test_provision_refuses_domains_reserved_by_another_instance(
+    client, async_validation
+):
+    client.provision_alb_instance("4321", params={"domains": "bar.com,foo.com"})
+    client.provision_cdn_instance("1234", params={"domains": "example.com,foo.com"})
+
+    assert "already exists" in client.response.body, client.response.body
+    assert "  foo.com" in client.response.body
+    assert client.response.status_code == 400, client.response.body
+    assert reserved_domains() == {"bar.com": "4321", "foo.com": "4321"}
+
+
+def test_missing_cname_fails_operation(client, tasks, async_validation):
+    client.provision_alb_instance("4321", params={"domains": "bar.com"})
+    operation_id = client.response.json["operation"]
+
+    tasks.run_queued_tasks_and_enqueue_dependents()
+
+    client.get_last_operation("4321", operation_id)
+    assert client.response.json["state"] == "failed"
+    desc = client.response.json["description"]
+    assert "We could not find correct CNAME records" in desc
+    assert "_acme-challenge.bar.com.domains.cloud.test" in desc
+    assert reserved_domains() == {}
+
+    # nothing else in the pipeline runs
+    tasks.run_queued_tasks_and_enqueue_dependents()
+    operation = Operation.query.get(operation_id)
+    assert operation.state == "failed"
+    assert operation.service_instance.acme_user is None
+
+
+def test_duplicate_domain_fails_operation(client, tasks, dns, async_validation):
+    # instances provisioned before reservations existed don't have any
+    ALBServiceInstanceFactory.create(domain_names=["foo.com"])
+    dns.add_cname("_acme-challenge.foo.com")
+    client.provision_alb_instance("4321", params={"domains": "foo.com"})
+    assert client.response.status_code == 202, client.response.body
+    operation_id = client.response.json["operation"]
+
+    tasks.run_queued_tasks_and_enqueue_dependents()
+
+    client.get_last_operation("4321", operation_id)
+    assert client.response.json["state"] == "failed"
+    assert "already exists" in client.response.json["description"]
+    assert reserved_domains() == {}
+
+
+def test_valid_domains_continue_pipeline(client, tasks, dns, async_validation):
+    dns.add_cname("_acme-challenge.foo.com")
+    client.provision_alb_instance("4321", params={"domains": "foo.com"})
+    operation_id = client.response.json["operation"]
+
+    tasks.run_queued_tasks_and_enqueue_dependents()
+
+    client.get_last_operation("4321", operation_id)
+    assert client.response.json["state"] == "in progress"
+    assert client.response.json["description"] == "Validating domains"
+    assert reserved_domains() == {"foo.com": "4321"}
+
+    tasks.run_queued_tasks_and_enqueue_dependents()
+
+    client.get_last_operation("4321", operation_id)
+    assert client.response.json["description"] == "Registering user for Lets Encrypt"
+
+
+def test_deprovision_releases_reservations(client, async_validation):
+    client.provision_alb_instance("4321", params={"domains": "foo.com"})
+    operation = OperationFactory.create(
+        service_instance=ALBServiceInstance.query.get("4321"),
+        action=Operation.Actions.DEPROVISION.value,
+    )
+    db.session.commit()
+
+    deprovision.call_local(operation.id)
+
+    assert reserved_domains() == {}
+
+
+def test_update_refuses_domains_reserved_since_it_checked(
+    client, dns, async_validation, monkeypatch
+):
+    client.provision_alb_instance("4321", params={"domains": "foo.com"})
+    ALBServiceInstanceFactory.create(id="1234", domain_names=["example.com"])
+    operation = ALBServiceInstance.query.get("4321").operations.first()
+    operation.state = Operation.States.SUCCEEDED.value
+    db.session.commit()
+    dns.add_cname("_acme-challenge.foo.com")
+    dns.add_cname("_acme-challenge.bar.com")
+    reserve = validators.UniqueDomains.reserve
+
+    def reserve_racing_another_instance(self, instance):
+        reserve(self, instance)
+        # another instance claims bar.com before our reservation is committed
+        with db.engine.begin() as connection:
+            connection.execute(
+                DomainReservation.__table__.insert().values(
+                    domain="bar.com", service_instance_id="1234"
+                )
+            )
+
+    monkeypatch.setattr(
+        validators.UniqueDomains, "reserve", reserve_racing_another_instance
+    )
+
+    client.update_alb_instance("4321", params={"domains": "bar.com,foo.com"})
+
+    assert "already exists" in client.response.body, client.response.body
+    assert "  bar.com" in client.response.body
+    assert client.response.status_code == 400, client.response.body
+    assert reserved_domains() == {"bar.com": "1234", "foo.com": "4321"}
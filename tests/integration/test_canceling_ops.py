@@ -4,6 +4,9 @@ from datetime import date, datetime
 import pytest  # noqa F401
 
 from huey.exceptions import CancelExecution
+import redis
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 from broker.extensions import config, db
 from broker.models import Challenge, Operation, CDNServiceInstance
@@ -13,7 +16,13 @@ from tests.lib.factories import (
     ALBServiceInstanceFactory,
 )
 
+from broker.tasks import update_operations
 from broker.tasks.huey import huey
+from broker.tasks.update_operations import (
+    CANCELED_OPERATIONS_KEY,
+    mark_operations_canceled,
+    reconcile_canceled_operations,
+)
 
 from broker.tasks.alb import select_alb, add_certificate_to_alb
 from broker.tasks.cloudfront import create_distribution, wait_for_distribution
@@ -45,7 +54,7 @@ params = [
 
 
 @pytest.mark.parametrize("task_type", params)
-def test_noop_when_operation_canceled(task_type):
+def test_noop_when_operation_canceled(clean_db, task_type):
     op = OperationFactory.create(id="4321", canceled_at=datetime.now())
     db.session.refresh(op)
     task = task_type.s("4321")
@@ -55,7 +64,7 @@ def test_noop_when_operation_canceled(task_type):
 
 
 @pytest.mark.parametrize("task_type", params)
-def test_no_cancel_for_uncanceled_tasks(task_type):
+def test_no_cancel_for_uncanceled_tasks(clean_db, task_type):
     op = OperationFactory.create(id="4321")
     db.session.refresh(op)
     task = task_type.s("4321")
@@ -63,6 +72,71 @@ def test_no_cancel_for_uncanceled_tasks(task_type):
         callback(task)
 
 
+def run_pre_execute_hooks(task):
+    for name, callback in huey._pre_execute.items():
+        callback(task)
+
+
+def test_cancels_from_redis_without_checking_database(clean_db):
+    op = OperationFactory.create(id="4321")
+    db.session.commit()
+
+    mark_operations_canceled([op.id])
+
+    with pytest.raises(CancelExecution):
+        run_pre_execute_hooks(create_user.s("4321"))
+
+
+def test_caches_uncanceled_operations(clean_db):
+    op = OperationFactory.create(id="4321")
+    db.session.commit()
+    run_pre_execute_hooks(create_user.s("4321"))
+
+    # canceling in the database without telling redis isn't noticed right away
+    op = Operation.query.get("4321")
+    op.canceled_at = datetime.now()
+    db.session.commit()
+    run_pre_execute_hooks(create_user.s("4321"))
+
+    # until we reconcile
+    assert reconcile_canceled_operations() == ["4321"]
+    with pytest.raises(CancelExecution):
+        run_pre_execute_hooks(create_user.s("4321"))
+
+
+def test_reconcile_removes_uncanceled_operations(clean_db):
+    op = OperationFactory.create(id="4321", canceled_at=datetime.now())
+    db.session.commit()
+    with pytest.raises(CancelExecution):
+        run_pre_execute_hooks(create_user.s("4321"))
+
+    op = Operation.query.get("4321")
+    op.canceled_at = None
+    db.session.commit()
+    assert reconcile_canceled_operations() == []
+
+    run_pre_execute_hooks(create_user.s("4321"))
+
+
+def test_reconcile_keeps_operations_canceled_while_it_runs(clean_db):
+    OperationFactory.create(id="4321")
+    db.session.commit()
+
+    def cancel_meanwhile(conn, cursor, statement, *args):
+        # canceled and flagged after reconcile looks in postgres
+        if "canceled_at" in statement:
+            mark_operations_canceled(["4321"])
+
+    event.listen(Engine, "after_cursor_execute", cancel_meanwhile)
+    try:
+        assert reconcile_canceled_operations() == []
+    finally:
+        event.remove(Engine, "after_cursor_execute", cancel_meanwhile)
+
+    with pytest.raises(CancelExecution):
+        run_pre_execute_hooks(create_user.s("4321"))
+
+
 def test_cancel_operation_cdn(client, tasks):
     service_instance = CDNServiceInstanceFactory.create(id="4321")
     in_progress = OperationFactory.create(
@@ -96,6 +170,9 @@ def test_cancel_operation_cdn(client, tasks):
     assert completed.canceled_at is None
     assert failed.canceled_at is None
 
+    canceled = huey.storage.conn.smembers(CANCELED_OPERATIONS_KEY)
+    assert canceled == {str(in_progress_id).encode()}
+
 
 def test_cancel_operation_alb(client, tasks):
     service_instance = ALBServiceInstanceFactory.create(id="4321")
@@ -129,3 +206,33 @@ def test_cancel_operation_alb(client, tasks):
     assert in_progress.canceled_at is not None
     assert completed.canceled_at is None
     assert failed.canceled_at is None
+
+    canceled = huey.storage.conn.smembers(CANCELED_OPERATIONS_KEY)
+    assert canceled == {str(in_progress_id).encode()}
+
+
+def test_deprovision_does_not_cancel_cleanup(client, tasks):
+    service_instance = ALBServiceInstanceFactory.create(id="4321")
+    cleanup = OperationFactory.create(
+        service_instance=service_instance,
+        state=Operation.States.IN_PROGRESS.value,
+        action=Operation.Actions.CLEANUP.value,
+    )
+    cleanup_id = cleanup.id
+
+    client.deprovision_alb_instance("4321")
+    tasks.run_queued_tasks_and_enqueue_dependents()
+
+    cleanup = Operation.query.get(cleanup_id)
+    assert cleanup.canceled_at is None
+    assert not huey.storage.conn.sismember(CANCELED_OPERATIONS_KEY, str(cleanup_id))
+
+
+def test_runs_tasks_when_cancellation_cannot_be_checked(clean_db, monkeypatch):
+    def redis_is_down(operation_id):
+        raise redis.ConnectionError("Connection refused")
+
+    monkeypatch.setattr(update_operations, "operation_is_canceled", redis_is_down)
+
+    # doesn't raise CancelExecution, or the ConnectionError
+    run_pre_execute_hooks(create_user.s("4321"))
@@ -0,0 +1,54 @@
+import pytest
+
+from broker.extensions import config, db
+from broker.models import Certificate, CertificateChain
+from broker.tasks.cron import deduplicate_certificate_chains
+
+from tests.lib import factories
+
+
+@pytest.fixture
+def service_instance(clean_db):
+    return factories.CDNServiceInstanceFactory.create(id="1234")
+
+
+def test_certificates_share_chains(service_instance):
+    for id_ in [1001, 1002]:
+        factories.CertificateFactory.create(
+            id=id_, service_instance=service_instance, fullchain_pem="SOMECHAINPEM"
+        )
+    factories.CertificateFactory.create(
+        id=1003, service_instance=service_instance, fullchain_pem="OTHERCHAINPEM"
+    )
+    db.session.commit()
+    db.session.expunge_all()
+
+    assert CertificateChain.query.count() == 2
+    assert Certificate.query.get(1001).fullchain_pem == "SOMECHAINPEM"
+    assert Certificate.query.get(1003).fullchain_pem == "OTHERCHAINPEM"
+    assert (
+        Certificate.query.get(1001).certificate_chain_sha256
+        == Certificate.query.get(1002).certificate_chain_sha256
+    )
+
+
+def test_moves_chains_out_of_certificates_in_batches(service_instance, monkeypatch):
+    monkeypatch.setattr(config, "CERTIFICATE_CHAIN_BATCH_SIZE", 2)
+    for id_ in [1001, 1002, 1003]:
+        certificate = factories.CertificateFactory.create(
+            id=id_, service_instance=service_instance
+        )
+        # the way certificates stored chains before certificate_chain
+        certificate._fullchain_pem = "SOMECHAINPEM"
+    db.session.commit()
+    db.session.expunge_all()
+
+    assert deduplicate_certificate_chains.call_local() == 2
+    assert deduplicate_certificate_chains.call_local() == 1
+    assert deduplicate_certificate_chains.call_local() == 0
+
+    db.session.expunge_all()
+    assert CertificateChain.query.count() == 1
+    for certificate in Certificate.query.all():
+        assert certificate._fullchain_pem is None
+        assert certificate.fullchain_pem == "SOMECHAINPEM"
@@ -0,0 +1,97 @@
+import pytest
+
+from broker.extensions import db
+from broker.models import Operation
+from broker.tasks import dag
+from broker.tasks.huey import Priority, huey
+
+from tests.lib.factories import OperationFactory
+from tests.lib.tasks import fallible_huey
+
+
+@huey.task()
+def first(operation_id, **kwargs):
+    pass
+
+
+@huey.task()
+def left(operation_id, **kwargs):
+    pass
+
+
+@huey.task()
+def right(operation_id, **kwargs):
+    pass
+
+
+@huey.task()
+def last(operation_id, **kwargs):
+    pass
+
+
+@huey.task()
+def failing(operation_id, **kwargs):
+    raise RuntimeError("nope")
+
+
+diamond = dag.Pipeline(
+    "test_diamond",
+    [
+        dag.Step(first),
+        dag.Step(left, after=["first"]),
+        dag.Step(right, after=["first"]),
+        dag.Step(last, after=["left", "right"]),
+    ],
+)
+
+failing_pipeline = dag.Pipeline(
+    "test_failing", [dag.Step(failing), dag.Step(last, after=["failing"])]
+)
+
+
+def pending_names():
+    return sorted(task.name for task in huey.pending())
+
+
+def test_runs_independent_steps_together_and_joins_them(clean_db, tasks):
+    diamond.enqueue(1234, "test", Priority.UPDATE)
+    assert pending_names() == ["first"]
+
+    tasks.run_queued_tasks_and_enqueue_dependents()
+    assert pending_names() == ["left", "right"]
+    assert {task.priority for task in huey.pending()} == {Priority.UPDATE}
+
+    # last waits for both
+    left_task, right_task = sorted(huey.pending(), key=lambda task: task.name)
+    huey.dequeue()
+    huey.dequeue()
+    huey.execute(left_task)
+    assert pending_names() == []
+    huey.execute(right_task)
+    assert pending_names() == ["last"]
+
+
+def test_does_not_run_dependents_of_failed_steps(clean_db, tasks):
+    OperationFactory.create(id=1234)
+    db.session.commit()
+    failing_pipeline.enqueue(1234, "test", Priority.UPDATE)
+
+    with fallible_huey():
+        tasks.run_queued_tasks_and_enqueue_dependents()
+
+    assert pending_names() == []
+    db.session.expunge_all()
+    operation = Operation.query.get(1234)
+    assert operation.state == Operation.States.FAILED.value
+
+
+def test_steps_come_after_their_dependencies():
+    with pytest.raises(ValueError, match="comes before its dependency"):
+        dag.Pipeline(
+            "test_backwards", [dag.Step(left, after=["first"]), dag.Step(first)]
+        )
+
+
+def test_step_names_are_unique():
+    with pytest.raises(ValueError, match="more than one step named first"):
+        dag.Pipeline("test_duplicates", [dag.Step(first), dag.Step(first)])
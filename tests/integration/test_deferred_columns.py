@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+
+from broker.extensions import db
+from broker.models import ACMEUser, Certificate
+from broker.tasks.cron import scan_for_expiring_certs
+
+from tests.lib import factories
+
+PEM_COLUMNS = ["leaf_pem", "private_key_pem", "csr_pem", "fullchain_pem", "order_json"]
+# fullchain_pem is a property over the certificate_chain relationship, with the
+# old column behind it as _fullchain_pem
+PEM_ATTRIBUTES = ["leaf_pem", "private_key_pem", "csr_pem", "_fullchain_pem"]
+
+
+@pytest.fixture
+def statements():
+    sent = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        sent.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    yield sent
+    event.remove(Engine, "before_cursor_execute", record)
+
+
+@pytest.fixture
+def certificate(clean_db):
+    service_instance = factories.CDNServiceInstanceFactory.create(
+        id="1234", domain_names=["example.com"]
+    )
+    certificate = factories.CertificateFactory.create(
+        id=1001,
+        service_instance=service_instance,
+        expires_at=datetime.now() + timedelta(days=60),
+        private_key_pem="SOMEPRIVATEKEY",
+        leaf_pem="SOMECERTPEM",
+        fullchain_pem="FULLCHAINOFSOMECERTPEM",
+        csr_pem="SOMECSRPEM",
+        order_json="{}",
+    )
+    service_instance.current_certificate = certificate
+    db.session.add(service_instance)
+    db.session.commit()
+    db.session.expunge_all()
+    return certificate
+
+
+def test_certificates_load_without_their_pems(certificate, statements):
+    certificate = Certificate.query.get(1001)
+
+    assert certificate.iam_server_certificate_name is None
+    assert set(PEM_ATTRIBUTES + ["order_json"]) <= inspect(certificate).unloaded
+    assert len(statements) == 1
+    assert not any(column in statements[0] for column in PEM_COLUMNS)
+
+
+def test_using_one_pem_loads_the_rest(certificate, statements):
+    certificate = Certificate.query.get(1001)
+
+    assert certificate.private_key_pem == "SOMEPRIVATEKEY"
+    assert certificate.leaf_pem == "SOMECERTPEM"
+    assert certificate.fullchain_pem == "FULLCHAINOFSOMECERTPEM"
+    # one for the certificate, one for the group, and one for the chain;
+    # order_json isn't in the group
+    assert len(statements) == 3
+    assert "FROM certificate_chain" in statements[2]
+    assert "order_json" in inspect(certificate).unloaded
+
+
+def test_acme_users_load_without_their_keys(clean_db, statements):
+    db.session.add(
+        ACMEUser(
+            id=1,
+            email="foo@example.com",
+            uri="https://acme.test/acct/1",
+            private_key_pem="SOMEPRIVATEKEY",
+            registration_json="{}",
+        )
+    )
+    db.session.commit()
+    db.session.expunge_all()
+    statements.clear()
+
+    acme_user = ACMEUser.query.get(1)
+
+    assert {"private_key_pem", "registration_json"} <= inspect(acme_user).unloaded
+    assert acme_user.private_key_pem == "SOMEPRIVATEKEY"
+    assert acme_user.registration_json == "{}"
+    assert len(statements) == 2
+
+
+def test_renewal_scan_does_not_load_certificates(certificate, statements):
+    scan_for_expiring_certs.call_local()
+
+    assert statements
+    assert not any(
+        column in statement for statement in statements for column in PEM_COLUMNS
+    )
@@ -0,0 +1,47 @@
+import time
+
+from broker import dns as broker_dns
+from broker.extensions import config
+
+
+def test_txt_records_visible(dns):
+    dns.add_txt("_acme-challenge.foo.example.com.", "foo-challenge")
+    dns.add_txt("_acme-challenge.bar.example.com.", "bar-challenge")
+
+    start = time.monotonic()
+    visible = broker_dns.wait_for_txt_records(
+        {
+            "_acme-challenge.foo.example.com.": "foo-challenge",
+            "_acme-challenge.bar.example.com.": "bar-challenge",
+        },
+        timeout=30,
+        nameservers=[config.DNS_VERIFICATION_SERVER],
+    )
+
+    assert visible
+    assert time.monotonic() - start < 5
+
+
+def test_txt_records_not_visible_waits_until_timeout(dns):
+    dns.add_txt("_acme-challenge.foo.example.com.", "old-challenge")
+
+    start = time.monotonic()
+    visible = broker_dns.wait_for_txt_records(
+        {"_acme-challenge.foo.example.com.": "new-challenge"},
+        timeout=1,
+        interval=0.2,
+        nameservers=[config.DNS_VERIFICATION_SERVER],
+    )
+
+    assert not visible
+    assert 1 <= time.monotonic() - start < 3
+
+
+def test_no_timeout_means_no_waiting():
+    assert (
+        broker_dns.wait_for_txt_records(
+            {"_acme-challenge.foo.example.com.": "challenge"}, timeout=0
+        )
+        is False
+    )
+    assert broker_dns.wait_for_txt_records({}, timeout=0)
@@ -0,0 +1,154 @@
+import pytest
+
+from broker.extensions import config, db
+from broker.models import Operation, Route53Record, ServiceInstance
+from broker.tasks import drift
+from broker.tasks.cron import check_for_drift
+
+from tests.lib import factories
+
+
+def alias(name):
+    return {
+        "Name": f"{name}.",
+        "Type": "A",
+        "AliasTarget": {
+            "DNSName": "target.test.",
+            "HostedZoneId": "Z2FDTNDATAQYW2",
+            "EvaluateTargetHealth": False,
+        },
+    }
+
+
+@pytest.fixture
+def service_instances(clean_db):
+    cdn_instance = factories.CDNServiceInstanceFactory.create(
+        id="1234",
+        domain_names=["example.com", "foo.com"],
+        cloudfront_distribution_id="FakeDistributionId",
+    )
+    alb_instance = factories.ALBServiceInstanceFactory.create(
+        id="5678", domain_names=["bar.com"], alb_listener_arn="listener-arn-0"
+    )
+    busy = factories.CDNServiceInstanceFactory.create(
+        id="9999", domain_names=["busy.com"]
+    )
+    for service_instance, name, arn in [
+        (cdn_instance, "cdn_certificate_name", "cdn_certificate_arn"),
+        (alb_instance, "alb_certificate_name", "certificate-arn-0"),
+        (busy, "busy_certificate_name", "busy_certificate_arn"),
+    ]:
+        certificate = factories.CertificateFactory.create(
+            service_instance=service_instance,
+            iam_server_certificate_id=f"{name}_id",
+            iam_server_certificate_name=name,
+            iam_server_certificate_arn=arn,
+        )
+        service_instance.current_certificate = certificate
+        db.session.add(service_instance)
+    factories.OperationFactory.create(service_instance=busy)
+    db.session.commit()
+    db.session.expunge_all()
+
+
+def expect_inventory(cloudfront, alb, iam_commercial, iam_govcloud, route53):
+    cloudfront.expect_list_distributions(
+        [
+            dict(
+                id="FakeDistributionId",
+                status="Deployed",
+                enabled=True,
+                certificate_id="some_other_certificate_id",
+            )
+        ]
+    )
+    alb.expect_get_certificates_for_listener("listener-arn-0", num_certificates=1)
+    alb.expect_get_certificates_for_listener("listener-arn-1")
+    iam_commercial.expect_list_server_certificates(
+        config.CLOUDFRONT_IAM_SERVER_CERTIFICATE_PREFIX, ["cdn_certificate_name"]
+    )
+    iam_govcloud.expect_list_server_certificates(
+        config.ALB_IAM_SERVER_CERTIFICATE_PREFIX, []
+    )
+    route53.expect_list_zone(
+        [alias("example.com.domains.cloud.test"), alias("bar.com.domains.cloud.test")]
+    )
+
+
+def assert_inventory_taken(cloudfront, alb, iam_commercial, iam_govcloud, route53):
+    for fake in [cloudfront, alb, iam_commercial, iam_govcloud, route53]:
+        fake.assert_no_pending_responses()
+
+
+def test_check_for_drift_reports_what_does_not_match(
+    service_instances, cloudfront, alb, iam_commercial, iam_govcloud, route53
+):
+    expect_inventory(cloudfront, alb, iam_commercial, iam_govcloud, route53)
+
+    found, repaired = check_for_drift.call_local()
+
+    assert_inventory_taken(cloudfront, alb, iam_commercial, iam_govcloud, route53)
+    assert sorted(found) == [
+        drift.Drift(
+            "1234",
+            drift.DISTRIBUTION_CERTIFICATE_MISMATCH,
+            "FakeDistributionId has some_other_certificate_id",
+        ),
+        drift.Drift("1234", drift.MISSING_ALIAS_RECORD, "foo.com.domains.cloud.test"),
+        drift.Drift("5678", drift.MISSING_SERVER_CERTIFICATE, "alb_certificate_name"),
+    ]
+    assert repaired == []
+    assert Operation.query.filter_by(action=Operation.Actions.RENEW.value).count() == 0
+    # the zone listing refreshes the index too
+    assert Route53Record.query.count() == 2
+
+
+def test_check_for_drift_renews_instances_with_certificate_drift(
+    service_instances,
+    cloudfront,
+    alb,
+    iam_commercial,
+    iam_govcloud,
+    route53,
+    monkeypatch,
+):
+    monkeypatch.setattr(config, "DRIFT_AUTO_REPAIR", True)
+    expect_inventory(cloudfront, alb, iam_commercial, iam_govcloud, route53)
+
+    _, repaired = check_for_drift.call_local()
+
+    assert repaired == ["1234", "5678"]
+    renewals = Operation.query.filter_by(action=Operation.Actions.RENEW.value)
+    assert sorted(r.service_instance_id for r in renewals) == ["1234", "5678"]
+
+
+def test_check_for_drift_skips_instances_that_started_an_operation(
+    service_instances,
+    cloudfront,
+    alb,
+    iam_commercial,
+    iam_govcloud,
+    route53,
+    monkeypatch,
+):
+    monkeypatch.setattr(config, "DRIFT_AUTO_REPAIR", True)
+    take_inventory = drift.take_inventory
+
+    def take_inventory_while_updating(listener_arns):
+        inventory = take_inventory(listener_arns)
+        # an update starts on 5678 while we're looking at AWS
+        factories.OperationFactory.create(
+            service_instance=ServiceInstance.query.get("5678"),
+            action=Operation.Actions.UPDATE.value,
+        )
+        db.session.commit()
+        return inventory
+
+    monkeypatch.setattr(drift, "take_inventory", take_inventory_while_updating)
+    expect_inventory(cloudfront, alb, iam_commercial, iam_govcloud, route53)
+
+    _, repaired = check_for_drift.call_local()
+
+    assert repaired == ["1234"]
+    renewals = Operation.query.filter_by(action=Operation.Actions.RENEW.value)
+    assert [r.service_instance_id for r in renewals] == ["1234"]
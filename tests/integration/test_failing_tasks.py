@@ -1,9 +1,11 @@
+import json
 import time
 import pytest
 
 from huey.exceptions import TaskException
 from broker.extensions import config, db
-from broker.tasks.huey import huey
+from broker.tasks.cron import send_failed_operation_alerts
+from broker.tasks.huey import FAILED_OPERATION_ALERTS_KEY, huey
 from broker.tasks.letsencrypt import initiate_challenges
 from broker.models import Operation
 
@@ -75,3 +77,54 @@ def test_retry_tasks_marked_failed_only_after_last_retry():
     operation_with_retries = Operation.query.get("6789")
     assert operation_with_retries.state == "failed"
     assert not retry_marked_failed
+
+
+def test_failed_operations_alert_in_one_digest(clean_db, monkeypatch):
+    @huey.task()
+    def failing_task(operation_id):
+        raise Exception()
+
+    for operation_id in ["1111", "2222"]:
+        OperationFactory.create(
+            id=operation_id,
+            state="InProgress",
+            action="Provision",
+            service_instance_id="nonextistent",
+        )
+    db.session.commit()
+    with fallible_huey() as h:
+        with immediate_huey() as h:
+            for operation_id in ["1111", "2222"]:
+                with pytest.raises(TaskException):
+                    failing_task(operation_id)()
+
+    queued = huey.storage.conn.lrange(FAILED_OPERATION_ALERTS_KEY, 0, -1)
+    assert [json.loads(alert)["operation_id"] for alert in queued] == [1111, 2222]
+
+    sent = []
+    monkeypatch.setattr("broker.tasks.cron.send_failed_operations_digest", sent.append)
+    assert send_failed_operation_alerts.call_local() == 2
+    assert len(sent) == 1
+    assert [alert["operation_id"] for alert in sent[0]] == [1111, 2222]
+    assert huey.storage.conn.llen(FAILED_OPERATION_ALERTS_KEY) == 0
+
+    assert send_failed_operation_alerts.call_local() == 0
+    assert len(sent) == 1
+
+
+def test_failed_operation_alerts_requeued_when_smtp_fails(clean_db, monkeypatch):
+    huey.storage.conn.rpush(
+        FAILED_OPERATION_ALERTS_KEY,
+        json.dumps(dict(operation_id=1, step_description="a")),
+        json.dumps(dict(operation_id=2, step_description="b")),
+    )
+
+    def fail_to_send(alerts):
+        raise ConnectionRefusedError()
+
+    monkeypatch.setattr("broker.tasks.cron.send_failed_operations_digest", fail_to_send)
+    with pytest.raises(ConnectionRefusedError):
+        send_failed_operation_alerts.call_local()
+
+    queued = huey.storage.conn.lrange(FAILED_OPERATION_ALERTS_KEY, 0, -1)
+    assert [json.loads(alert)["operation_id"] for alert in queued] == [1, 2]
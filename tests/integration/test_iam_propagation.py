@@ -0,0 +1,80 @@
+from botocore.exceptions import ClientError
+import pytest
+
+from broker.extensions import config, db
+from broker.models import ALBServiceInstance
+from broker.tasks.alb import add_certificate_to_alb
+from broker.tasks.iam import delete_server_certificate
+
+from tests.lib import factories
+
+
+@pytest.fixture
+def service_instance():
+    service_instance = factories.ALBServiceInstanceFactory.create(
+        id="1234",
+        domain_names=["example.com"],
+        alb_listener_arn="listener-arn-0",
+        alb_arn="alb-arn-0",
+    )
+    new_cert = factories.CertificateFactory.create(
+        service_instance=service_instance,
+        private_key_pem="SOMEPRIVATEKEY",
+        iam_server_certificate_name="new_certificate_name",
+        iam_server_certificate_arn="new_certificate_arn",
+        id=1002,
+    )
+    service_instance.new_certificate = new_cert
+    db.session.add(service_instance)
+    db.session.add(new_cert)
+    db.session.commit()
+    db.session.expunge_all()
+    return service_instance
+
+
+@pytest.fixture
+def operation(service_instance):
+    return factories.OperationFactory.create(id=4321, service_instance=service_instance)
+
+
+def test_add_certificate_to_alb_waits_for_certificate_to_propagate(
+    clean_db, operation, alb, monkeypatch
+):
+    monkeypatch.setattr(config, "IAM_CERTIFICATE_PROPAGATION_TIME", 10)
+    alb.expect_add_certificate_to_listener_raising_not_found(
+        "listener-arn-0", "new_certificate_arn"
+    )
+    alb.expect_add_certificate_to_listener("listener-arn-0", "new_certificate_arn")
+    alb.expect_describe_alb("alb-arn-0", "alb.cloud.test")
+
+    add_certificate_to_alb.call_local(4321)
+
+    alb.assert_no_pending_responses()
+    service_instance = ALBServiceInstance.query.get("1234")
+    assert service_instance.current_certificate_id == 1002
+
+
+def test_add_certificate_to_alb_gives_up_after_propagation_time(
+    clean_db, operation, alb, monkeypatch
+):
+    monkeypatch.setattr(config, "IAM_CERTIFICATE_PROPAGATION_TIME", 0)
+    alb.expect_add_certificate_to_listener_raising_not_found(
+        "listener-arn-0", "new_certificate_arn"
+    )
+
+    with pytest.raises(ClientError, match="CertificateNotFound"):
+        add_certificate_to_alb.call_local(4321)
+
+
+def test_delete_server_certificate_waits_for_alb_to_let_go(
+    clean_db, operation, iam_govcloud, monkeypatch
+):
+    monkeypatch.setattr(config, "IAM_CERTIFICATE_PROPAGATION_TIME", 10)
+    iam_govcloud.expects_delete_server_certificate_returning_delete_conflict(
+        "new_certificate_name"
+    )
+    iam_govcloud.expects_delete_server_certificate("new_certificate_name")
+
+    delete_server_certificate.call_local(4321)
+
+    iam_govcloud.assert_no_pending_responses()
@@ -0,0 +1,85 @@
+import pytest
+
+from broker import instrumentation
+from broker.tasks.huey import huey
+from broker.validators import CNAME
+from tests.lib.factories import ALBServiceInstanceFactory, OperationFactory
+
+
+def test_queries_are_attributed_to_the_endpoint(client, dns):
+    dns.add_cname("_acme-challenge.example.com")
+
+    with instrumentation.recording() as stats:
+        client.provision_alb_instance("4321", params={"domains": "example.com"})
+
+    assert client.response.status_code == 202, client.response.body
+    assert stats["open_broker.provision"]["queries"] > 0
+    assert stats["open_broker.provision"]["seconds"] > 0
+    assert instrumentation.current_code_path() is None
+
+
+def test_queries_are_attributed_to_the_task(client, dns, tasks):
+    dns.add_cname("_acme-challenge.example.com")
+    client.provision_alb_instance("4321", params={"domains": "example.com"})
+
+    with instrumentation.recording() as stats:
+        tasks.run_queued_tasks_and_enqueue_dependents()
+
+    assert stats["create_user"]["queries"] > 0
+    assert "open_broker.provision" not in stats
+    assert instrumentation.current_code_path() is None
+
+
+def test_tasks_give_back_the_code_path_they_started_in(clean_db):
+    @huey.task()
+    def attributed_task():
+        return instrumentation.current_code_path()
+
+    with instrumentation.code_path("outer"):
+        result = huey.execute(attributed_task.s())
+        assert instrumentation.current_code_path() == "outer"
+
+    assert result == "attributed_task"
+    assert instrumentation.current_code_path() is None
+
+
+@pytest.mark.query_budget("open_broker.last_operation", queries=0)
+def test_going_over_budget_fails(client, dns):
+    dns.add_cname("_acme-challenge.example.com")
+    client.provision_alb_instance("4321", params={"domains": "example.com"})
+    operation_id = client.response.json["operation"]
+
+    with pytest.raises(pytest.fail.Exception, match="open_broker.last_operation"):
+        client.get_last_operation("4321", operation_id)
+
+
+def test_has_active_operations_uses_one_query(clean_db):
+    instance = ALBServiceInstanceFactory.create(id="4321")
+    for _ in range(5):
+        OperationFactory.create(service_instance=instance, state="complete")
+    OperationFactory.create(service_instance=instance, state="in progress")
+    clean_db.session.commit()
+    # load the instance before we start counting
+    assert instance.id == "4321"
+
+    with instrumentation.recording() as stats:
+        assert instance.has_active_operations()
+
+    assert stats[None]["queries"] == 1
+
+
+def test_cname_errors_are_checked_once_per_domain(dns, monkeypatch):
+    dns.add_cname("_acme-challenge.foo.example.gov")
+    checked = []
+    error_for_domain = CNAME._error_for_domain
+
+    def counting_error_for_domain(self, domain):
+        checked.append(domain)
+        return error_for_domain(self, domain)
+
+    monkeypatch.setattr(CNAME, "_error_for_domain", counting_error_for_domain)
+
+    with pytest.raises(Exception):
+        CNAME(["foo.example.gov", "bar.example.gov"]).validate()
+
+    assert sorted(checked) == ["bar.example.gov", "foo.example.gov"]
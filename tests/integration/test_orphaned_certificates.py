@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from broker.extensions import config, db
+from broker.tasks.cron import collect_orphaned_server_certificates
+
+from tests.lib import factories
+
+
+@pytest.fixture
+def certificates(clean_db):
+    for factory, instance_id, name, deactivated_at in [
+        (factories.CDNServiceInstanceFactory, "1234", "in_use_cdn", None),
+        (
+            factories.CDNServiceInstanceFactory,
+            "5678",
+            "deprovisioned_cdn",
+            datetime.now(timezone.utc),
+        ),
+        (factories.ALBServiceInstanceFactory, "9012", "in_use_alb", None),
+    ]:
+        service_instance = factory.create(id=instance_id, deactivated_at=deactivated_at)
+        factories.CertificateFactory.create(
+            service_instance=service_instance, iam_server_certificate_name=name
+        )
+    db.session.commit()
+
+
+def test_deletes_old_unreferenced_certificates(
+    certificates, iam_commercial, iam_govcloud, monkeypatch
+):
+    # one at a time, so the fakes see them in order
+    monkeypatch.setattr(config, "IAM_MAX_CONCURRENT_REQUESTS", 1)
+    last_month = datetime.now(timezone.utc) - timedelta(days=30)
+    iam_commercial.expect_list_server_certificates(
+        config.CLOUDFRONT_IAM_SERVER_CERTIFICATE_PREFIX,
+        ["in_use_cdn", "deprovisioned_cdn", "orphan_cdn", "just_uploaded_cdn"],
+        uploaded_at=dict(
+            in_use_cdn=last_month,
+            deprovisioned_cdn=last_month,
+            orphan_cdn=last_month,
+        ),
+    )
+    iam_govcloud.expect_list_server_certificates(
+        config.ALB_IAM_SERVER_CERTIFICATE_PREFIX,
+        ["in_use_alb", "attached_alb"],
+        uploaded_at=dict(in_use_alb=last_month, attached_alb=last_month),
+    )
+    iam_commercial.expects_delete_server_certificate("deprovisioned_cdn")
+    iam_commercial.expects_delete_server_certificate_returning_no_such_entity(
+        "orphan_cdn"
+    )
+    iam_govcloud.expects_delete_server_certificate_returning_delete_conflict(
+        "attached_alb"
+    )
+
+    deleted = collect_orphaned_server_certificates.call_local()
+
+    iam_commercial.assert_no_pending_responses()
+    iam_govcloud.assert_no_pending_responses()
+    assert deleted == ["deprovisioned_cdn", "orphan_cdn"]
+
+
+def test_does_nothing_without_certificates(certificates, iam_commercial, iam_govcloud):
+    iam_commercial.expect_list_server_certificates(
+        config.CLOUDFRONT_IAM_SERVER_CERTIFICATE_PREFIX, []
+    )
+    iam_govcloud.expect_list_server_certificates(
+        config.ALB_IAM_SERVER_CERTIFICATE_PREFIX, []
+    )
+
+    assert collect_orphaned_server_certificates.call_local() == []
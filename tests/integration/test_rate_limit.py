@@ -0,0 +1,60 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from broker import rate_limit
+from broker.extensions import config
+
+
+@pytest.fixture
+def limits(clean_db, monkeypatch):
+    monkeypatch.setattr(config, "RATE_LIMITS", dict(route53=10))
+    monkeypatch.setattr(config, "RATE_LIMIT_MAX_WAIT_SECONDS", 30)
+    return config.RATE_LIMITS
+
+
+def timed(fn, *args):
+    start = time.monotonic()
+    fn(*args)
+    return time.monotonic() - start
+
+
+def test_calls_within_the_rate_do_not_wait(limits):
+    for _ in range(10):
+        assert timed(rate_limit.wait_for_token, "route53", "commercial") < 0.05
+
+
+def test_calls_over_the_rate_wait_their_turn(limits):
+    for _ in range(10):
+        rate_limit.wait_for_token("route53", "commercial")
+
+    waits = [
+        timed(rate_limit.wait_for_token, "route53", "commercial") for _ in range(3)
+    ]
+
+    # a token every 0.1 seconds
+    assert all(0.05 < wait < 0.2 for wait in waits)
+
+
+def test_accounts_have_separate_limits(limits):
+    for _ in range(10):
+        rate_limit.wait_for_token("route53", "commercial")
+
+    assert timed(rate_limit.wait_for_token, "route53", "govcloud") < 0.05
+
+
+def test_gives_up_when_booked_up(limits, monkeypatch):
+    monkeypatch.setattr(config, "RATE_LIMIT_MAX_WAIT_SECONDS", 0.5)
+    # book tokens as fast as we can, without waiting for them
+    monkeypatch.setattr(rate_limit, "time", SimpleNamespace(sleep=lambda _: None))
+    for _ in range(15):
+        rate_limit.wait_for_token("route53", "commercial")
+
+    with pytest.raises(rate_limit.RateLimitExceeded):
+        rate_limit.wait_for_token("route53", "commercial")
+
+
+def test_services_without_a_limit_do_not_wait(limits):
+    for _ in range(100):
+        rate_limit.wait_for_token("cloudfront", "commercial")
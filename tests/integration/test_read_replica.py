@@ -0,0 +1,120 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from openbrokerapi import errors
+import pytest
+
+from broker import extensions
+from broker.extensions import REPLICA_BIND, db, read_replica, replica_stats
+from broker.tasks import cron
+from broker.validators import UniqueDomains
+from tests.lib.factories import (
+    ALBServiceInstanceFactory,
+    CertificateFactory,
+    OperationFactory,
+)
+
+
+@pytest.fixture
+def replica(app, monkeypatch):
+    # there's no real replica in the test environment, so point the replica
+    # bind at the primary
+    monkeypatch.setitem(
+        app.config,
+        "SQLALCHEMY_BINDS",
+        {REPLICA_BIND: app.config["SQLALCHEMY_DATABASE_URI"]},
+    )
+
+
+def test_reads_from_primary_without_replica(clean_db):
+    with read_replica() as used_replica:
+        assert not used_replica
+        assert db.session.get_bind() is db.engine
+
+
+def test_reads_from_replica(clean_db, replica):
+    before = replica_stats["replica"]
+
+    with read_replica() as used_replica:
+        assert used_replica
+        assert db.session.get_bind() is db.get_engine(bind=REPLICA_BIND)
+    assert db.session.get_bind() is db.engine
+
+    assert replica_stats["replica"] == before + 1
+
+
+def test_reads_from_primary_when_replica_is_behind(clean_db, replica, monkeypatch):
+    monkeypatch.setattr(extensions, "_replica_is_current", lambda min_lsn: False)
+    before = replica_stats["primary_replica_lag"]
+
+    with read_replica() as used_replica:
+        assert not used_replica
+        assert db.session.get_bind() is db.engine
+
+    assert replica_stats["primary_replica_lag"] == before + 1
+
+
+def test_reads_from_primary_when_replica_is_broken(clean_db, replica, monkeypatch):
+    def broken(min_lsn):
+        raise ConnectionRefusedError()
+
+    monkeypatch.setattr(extensions, "_replica_is_current", broken)
+
+    with read_replica() as used_replica:
+        assert not used_replica
+        assert db.session.get_bind() is db.engine
+
+
+def test_last_operation_waits_for_replica_to_see_last_write(
+    client, dns, replica, monkeypatch
+):
+    dns.add_cname("_acme-challenge.example.com")
+    client.provision_alb_instance("4321", params={"domains": "example.com"})
+    operation_id = client.response.json["operation"]
+
+    min_lsns = []
+
+    def replica_is_current(min_lsn):
+        min_lsns.append(min_lsn)
+        return True
+
+    monkeypatch.setattr(extensions, "_replica_is_current", replica_is_current)
+
+    client.get_last_operation("4321", operation_id)
+
+    assert client.response.json["description"] == "Queuing tasks"
+    assert len(min_lsns) == 1
+    assert "/" in min_lsns[0]
+
+
+def test_unique_domains_are_checked_on_the_primary(clean_db, replica):
+    ALBServiceInstanceFactory.create(id="4321", domain_names=["example.com"])
+    db.session.commit()
+    before = dict(replica_stats)
+
+    with pytest.raises(errors.ErrBadRequest, match="example.com"):
+        UniqueDomains(["example.com"]).validate()
+
+    assert dict(replica_stats) == before
+
+
+def test_renewal_scan_rechecks_operations_on_the_primary(
+    clean_db, replica, monkeypatch
+):
+    instance = ALBServiceInstanceFactory.create(id="4321")
+    instance.current_certificate = CertificateFactory.create(
+        service_instance=instance, expires_at=datetime.now() + timedelta(days=1)
+    )
+    db.session.commit()
+    replica_block = cron.read_replica
+
+    @contextmanager
+    def operation_starts_after_replica_read(*args, **kwargs):
+        with replica_block(*args, **kwargs) as used_replica:
+            yield used_replica
+        OperationFactory.create(service_instance=instance)
+        db.session.commit()
+
+    monkeypatch.setattr(cron, "read_replica", operation_starts_after_replica_read)
+
+    assert cron.scan_for_expiring_certs.call_local() == []
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from broker.extensions import config, db
+from broker.models import (
+    ArchivedRow,
+    Certificate,
+    Challenge,
+    Operation,
+    ServiceInstance,
+)
+from broker.tasks.cron import archive_old_rows
+from broker.tasks.route53 import remove_TXT_records
+
+from tests.lib import factories
+
+LONG_AGO = datetime.now(timezone.utc) - timedelta(days=400)
+RECENTLY = datetime.now(timezone.utc) - timedelta(days=1)
+
+
+@pytest.fixture
+def rows(clean_db, monkeypatch):
+    monkeypatch.setattr(config, "ARCHIVE_BATCH_PAUSE_SECONDS", 0)
+    active = factories.CDNServiceInstanceFactory.create(
+        id="1234", domain_names=["example.com"]
+    )
+    deactivated = factories.CDNServiceInstanceFactory.create(
+        id="5678", deactivated_at=LONG_AGO
+    )
+    for id_, service_instance, state, updated_at in [
+        (1, active, Operation.States.SUCCEEDED.value, LONG_AGO),
+        (2, active, Operation.States.FAILED.value, LONG_AGO),
+        (3, active, Operation.States.SUCCEEDED.value, RECENTLY),
+        (4, active, Operation.States.IN_PROGRESS.value, LONG_AGO),
+        (5, deactivated, Operation.States.SUCCEEDED.value, RECENTLY),
+    ]:
+        factories.OperationFactory.create(
+            id=id_,
+            service_instance=service_instance,
+            state=state,
+            created_at=updated_at,
+            updated_at=updated_at,
+        )
+    for id_, service_instance in [
+        (1001, active),
+        (1002, active),
+        (1003, deactivated),
+    ]:
+        factories.CertificateFactory.create(
+            id=id_, service_instance=service_instance, private_key_pem="SOMEKEY"
+        )
+        factories.ChallengeFactory.create(
+            id=id_,
+            certificate_id=id_,
+            domain="example.com",
+            validation_contents="example txt",
+            created_at=LONG_AGO,
+        )
+    active.current_certificate_id = 1001
+    # 1002 is being issued
+    active.new_certificate_id = 1002
+    deactivated.current_certificate_id = 1003
+    db.session.add(active)
+    db.session.add(deactivated)
+    db.session.commit()
+    db.session.expunge_all()
+
+
+def archived(table_name):
+    return {
+        row.row_id for row in ArchivedRow.query.filter_by(table_name=table_name).all()
+    }
+
+
+def test_archives_rows_past_their_retention_windows(rows):
+    assert archive_old_rows.call_local() == dict(service_instance=1, operation=2)
+
+    assert {o.id for o in Operation.query.all()} == {3, 4}
+    assert archived("operation") == {"1", "2", "5"}
+    # challenges stay as long as their certificates do
+    assert {c.id for c in Challenge.query.all()} == {1001, 1002}
+    assert archived("challenge") == {"1003"}
+    assert [s.id for s in ServiceInstance.query.all()] == ["1234"]
+    assert archived("service_instance") == {"5678"}
+    assert {c.id for c in Certificate.query.all()} == {1001, 1002}
+    assert archived("certificate") == {"1003"}
+    certificate = ArchivedRow.query.filter_by(table_name="certificate").one()
+    assert certificate.data["service_instance_id"] == "5678"
+    assert "private_key_pem" not in certificate.data
+
+
+def test_archives_in_batches(rows, monkeypatch):
+    monkeypatch.setattr(config, "ARCHIVE_BATCH_SIZE", 1)
+
+    archive_old_rows.call_local()
+
+    assert {o.id for o in Operation.query.all()} == {3, 4}
+    assert archived("operation") == {"1", "2", "5"}
+
+
+def test_deprovisioning_after_archiving_removes_TXT_records(rows, route53):
+    archive_old_rows.call_local()
+    factories.OperationFactory.create(
+        id=6,
+        service_instance=ServiceInstance.query.get("1234"),
+        action=Operation.Actions.DEPROVISION.value,
+    )
+    db.session.commit()
+    name = "_acme-challenge.example.com.domains.cloud.test"
+    route53.expect_list_TXT(name, "example txt")
+    route53.expect_remove_TXT_records({name: "example txt"})
+
+    remove_TXT_records.call_local(6)
+
+    route53.assert_no_pending_responses()
+
+
+def test_does_nothing_when_nothing_is_old(clean_db):
+    assert archive_old_rows.call_local() == dict(service_instance=0, operation=0)
@@ -0,0 +1,198 @@
+import pytest
+
+from broker.extensions import db
+from broker.models import CDNServiceInstance, Route53Record
+from broker.tasks.cron import sync_route53_index
+from broker.tasks import route53 as route53_tasks
+from broker.tasks.route53 import create_ALIAS_records, indexed
+
+from tests.lib import factories
+
+
+def alias(name, target="fake1234.cloudfront.net.", type_="A"):
+    return {
+        "Name": name,
+        "Type": type_,
+        "AliasTarget": {
+            "DNSName": target,
+            "HostedZoneId": "Z2FDTNDATAQYW2",
+            "EvaluateTargetHealth": False,
+        },
+    }
+
+
+@pytest.fixture
+def operation():
+    service_instance = factories.CDNServiceInstanceFactory.create(
+        id="1234",
+        domain_names=["example.com", "foo.com"],
+        domain_internal="fake1234.cloudfront.net",
+        route53_alias_hosted_zone="Z2FDTNDATAQYW2",
+    )
+    return factories.OperationFactory.create(id=4321, service_instance=service_instance)
+
+
+def test_sync_replaces_the_index_with_the_zone(clean_db, route53):
+    db.session.add(
+        Route53Record(name="gone.domains.cloud.test", type="TXT", record_set={})
+    )
+    db.session.commit()
+    route53.expect_list_zone(
+        [
+            alias("example.com.domains.cloud.test."),
+            alias("example.com.domains.cloud.test.", type_="AAAA"),
+            {
+                "Name": "_acme-challenge.example.com.domains.cloud.test.",
+                "Type": "TXT",
+                "TTL": 60,
+                "ResourceRecords": [{"Value": '"example txt"'}],
+            },
+        ]
+    )
+
+    assert sync_route53_index.call_local() == 3
+
+    route53.assert_no_pending_responses()
+    records = Route53Record.query.all()
+    assert {(record.name, record.type) for record in records} == {
+        ("_acme-challenge.example.com.domains.cloud.test", "TXT"),
+        ("example.com.domains.cloud.test", "A"),
+        ("example.com.domains.cloud.test", "AAAA"),
+    }
+    record = Route53Record.query.get(("example.com.domains.cloud.test", "A"))
+    assert record.record_set == {
+        "AliasTarget": {
+            "DNSName": "fake1234.cloudfront.net",
+            "HostedZoneId": "Z2FDTNDATAQYW2",
+            "EvaluateTargetHealth": False,
+        }
+    }
+
+
+def test_create_ALIAS_records_skips_records_already_in_the_zone(
+    clean_db, operation, route53
+):
+    for type_ in ["A", "AAAA"]:
+        db.session.add(
+            Route53Record(
+                name="example.com.domains.cloud.test",
+                type=type_,
+                record_set=indexed(alias("example.com.domains.cloud.test.")),
+            )
+        )
+    db.session.commit()
+    foo_com_change_id = route53.expect_create_ALIAS_and_return_change_id(
+        "foo.com.domains.cloud.test", "fake1234.cloudfront.net"
+    )
+
+    create_ALIAS_records.call_local(4321)
+
+    route53.assert_no_pending_responses()
+    db.session.expunge_all()
+    service_instance = CDNServiceInstance.query.get("1234")
+    assert service_instance.route53_change_ids == [foo_com_change_id]
+    assert Route53Record.query.get(("foo.com.domains.cloud.test", "AAAA"))
+
+
+def test_create_ALIAS_records_replaces_records_pointing_elsewhere(
+    clean_db, operation, route53
+):
+    db.session.add(
+        Route53Record(
+            name="example.com.domains.cloud.test",
+            type="A",
+            record_set=indexed(alias("example.com", target="elsewhere.test")),
+        )
+    )
+    db.session.commit()
+    route53.expect_create_ALIAS_and_return_change_id(
+        "example.com.domains.cloud.test", "fake1234.cloudfront.net"
+    )
+    route53.expect_create_ALIAS_and_return_change_id(
+        "foo.com.domains.cloud.test", "fake1234.cloudfront.net"
+    )
+
+    create_ALIAS_records.call_local(4321)
+
+    route53.assert_no_pending_responses()
+    record = Route53Record.query.get(("example.com.domains.cloud.test", "A"))
+    assert record.record_set["AliasTarget"]["DNSName"] == "fake1234.cloudfront.net"
+
+
+def test_sync_keeps_changes_made_while_listing(
+    clean_db, operation, route53, monkeypatch
+):
+    list_zone = route53_tasks.list_zone
+
+    def list_zone_while_changing():
+        listing = list_zone()
+        # these land after the listing has seen the zone without them
+        route53.expect_remove_ALIAS(
+            "example.com.domains.cloud.test", "fake1234.cloudfront.net"
+        )
+        route53_tasks.change_record_sets(
+            [
+                {"Action": "DELETE", "ResourceRecordSet": record_set}
+                for record_set in [
+                    alias("example.com.domains.cloud.test", "fake1234.cloudfront.net"),
+                    alias(
+                        "example.com.domains.cloud.test",
+                        "fake1234.cloudfront.net",
+                        type_="AAAA",
+                    ),
+                ]
+            ]
+        )
+        route53.expect_create_ALIAS_and_return_change_id(
+            "foo.com.domains.cloud.test", "fake1234.cloudfront.net"
+        )
+        route53_tasks.change_record_sets(
+            [
+                {"Action": "UPSERT", "ResourceRecordSet": record_set}
+                for record_set in [
+                    alias("foo.com.domains.cloud.test", "fake1234.cloudfront.net"),
+                    alias(
+                        "foo.com.domains.cloud.test",
+                        "fake1234.cloudfront.net",
+                        type_="AAAA",
+                    ),
+                ]
+            ]
+        )
+        return listing
+
+    monkeypatch.setattr(route53_tasks, "list_zone", list_zone_while_changing)
+    route53.expect_list_zone(
+        [
+            alias("example.com.domains.cloud.test."),
+            alias("example.com.domains.cloud.test.", type_="AAAA"),
+        ]
+    )
+
+    sync_route53_index.call_local()
+
+    route53.assert_no_pending_responses()
+    db.session.expunge_all()
+    # the index doesn't bring back what was deleted, or forget what was added
+    assert not route53_tasks.is_indexed(alias("example.com.domains.cloud.test."))
+    assert route53_tasks.is_indexed(alias("foo.com.domains.cloud.test."))
+
+    # so the deleted records are put back when they're wanted again
+    route53.expect_create_ALIAS_and_return_change_id(
+        "example.com.domains.cloud.test", "fake1234.cloudfront.net"
+    )
+    create_ALIAS_records.call_local(4321)
+    route53.assert_no_pending_responses()
+
+    # and the next listing clears out what was deleted
+    route53.expect_list_zone(
+        [
+            alias("example.com.domains.cloud.test."),
+            alias("example.com.domains.cloud.test.", type_="AAAA"),
+            alias("foo.com.domains.cloud.test."),
+            alias("foo.com.domains.cloud.test.", type_="AAAA"),
+        ]
+    )
+    monkeypatch.setattr(route53_tasks, "list_zone", list_zone)
+    assert sync_route53_index.call_local() == 4
+    assert Route53Record.query.count() == 4
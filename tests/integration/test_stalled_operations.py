@@ -88,7 +88,8 @@ def test_does_not_find_canceled_operations(clean_db):
 
 
 @pytest.mark.parametrize(
-    "action", ["Provision", "Deprovision", "Renew", "Update", "Migrate to broker"]
+    "action",
+    ["Provision", "Deprovision", "Renew", "Update", "Migrate to broker", "Cleanup"],
 )
 def test_reschedules_operation(clean_db, action):
     stalled_operation = factories.OperationFactory.create(
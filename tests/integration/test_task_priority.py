@@ -0,0 +1,65 @@
+import time
+
+from broker.extensions import config
+from broker.tasks.huey import Priority, huey
+from broker.tasks.letsencrypt import generate_private_key
+from broker.tasks.pipelines import (
+    queue_all_alb_provision_tasks_for_operation,
+    queue_all_alb_renewal_tasks_for_operation,
+)
+
+
+def dequeued_task_names():
+    names = []
+    task = huey.dequeue()
+    while task:
+        names.append(task.name)
+        task = huey.dequeue()
+    return names
+
+
+def test_every_task_in_a_pipeline_gets_its_priority(clean_db):
+    queue_all_alb_renewal_tasks_for_operation(1234)
+
+    task = huey.dequeue()
+    priorities = []
+    while task is not None:
+        priorities.append(task.priority)
+        task = task.on_complete
+
+    assert len(priorities) > 1
+    assert set(priorities) == {Priority.RENEWAL}
+
+
+def test_provisions_go_ahead_of_earlier_renewals(clean_db):
+    queue_all_alb_renewal_tasks_for_operation(1234)
+    queue_all_alb_renewal_tasks_for_operation(1235)
+    queue_all_alb_provision_tasks_for_operation(1236, "provision")
+
+    assert dequeued_task_names() == [
+        "create_user",
+        "generate_private_key",
+        "generate_private_key",
+    ]
+
+
+def test_renewals_that_waited_long_enough_go_first(clean_db, monkeypatch):
+    monkeypatch.setattr(config, "TASK_PRIORITY_AGING_SECONDS", 0.01)
+    queue_all_alb_renewal_tasks_for_operation(1234)
+    time.sleep(0.1)
+    queue_all_alb_provision_tasks_for_operation(1236, "provision")
+
+    assert dequeued_task_names() == ["generate_private_key", "create_user"]
+
+
+def test_moves_tasks_from_the_fifo_queue(clean_db):
+    conn = huey.storage.conn
+    for operation_id in [1234, 1235]:
+        message = huey.serialize_task(generate_private_key.s(operation_id))
+        # how RedisStorage queues tasks
+        conn.lpush(huey.storage.fifo_queue_key, message)
+
+    assert huey.storage.move_fifo_queue() == 2
+
+    assert [task.args for task in huey.pending()] == [(1234,), (1235,)]
+    assert conn.llen(huey.storage.fifo_queue_key) == 0
@@ -0,0 +1,215 @@
+"""
+Records how much work each pipeline step does, and compares it to a baseline.
+
+Steps are recorded as huey executes them, so this works with anything that
+runs tasks through huey - normally `tasks.run_queued_tasks_and_enqueue_dependents`.
+For each step we record:
+
+- seconds: wall time
+- queries: SQL statements sent to the database
+- redis: Redis commands (each command in a pipeline counts)
+- aws: calls made through the boto3 clients in broker.aws
+- acme: HTTP requests made to the ACME server
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import time
+
+from acme.client import ClientNetwork
+import pytest
+from redis.client import Pipeline, Redis
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from broker import aws
+from broker.tasks.huey import huey
+
+BENCHMARK_DIR = Path(__file__).parent.parent / "benchmarks"
+BASELINE_PATH = BENCHMARK_DIR / "baseline.json"
+RESULTS_PATH = BENCHMARK_DIR / "results.json"
+
+COUNTERS = ["queries", "redis", "aws", "acme"]
+
+# how much a step can regress before we fail, as a fraction of the baseline
+MAX_COUNT_REGRESSION = float(os.environ.get("BENCHMARK_MAX_COUNT_REGRESSION", "0.1"))
+MAX_TIME_REGRESSION = float(os.environ.get("BENCHMARK_MAX_TIME_REGRESSION", "0.5"))
+# anything faster than this is mostly noise
+MIN_SECONDS = float(os.environ.get("BENCHMARK_MIN_SECONDS", "0.1"))
+
+AWS_CLIENTS = [
+    aws.route53,
+    aws.iam_commercial,
+    aws.cloudfront,
+    aws.alb,
+    aws.iam_govcloud,
+]
+
+
+class PipelineBenchmark:
+    def __init__(self):
+        self.counts = Counter()
+        self.scenarios = {}
+        self._steps = None
+        self._step_start = None
+
+    @contextmanager
+    def scenario(self, name: str):
+        """Record every step run inside this block as part of scenario `name`"""
+        self._steps = []
+        start_counts = self.counts.copy()
+        start = time.perf_counter()
+        with self._recording():
+            yield
+        total = self._measurement(start, start_counts)
+        self.scenarios[name] = dict(steps=self._steps, total=total)
+        self._steps = None
+        self._write_results()
+        self._check(name)
+
+    @contextmanager
+    def _recording(self):
+        huey.pre_execute(name="Benchmark step start")(self._start_step)
+        # go first, so we measure the other hooks too
+        huey._pre_execute.move_to_end("Benchmark step start", last=False)
+        huey.post_execute(name="Benchmark step end")(self._end_step)
+        event.listen(Engine, "before_cursor_execute", self._count_query)
+        for client in AWS_CLIENTS:
+            client.meta.events.register("before-call", self._count_aws_call)
+        originals = self._patch_redis_and_acme()
+        try:
+            yield
+        finally:
+            huey.unregister_pre_execute("Benchmark step start")
+            huey.unregister_post_execute("Benchmark step end")
+            event.remove(Engine, "before_cursor_execute", self._count_query)
+            for client in AWS_CLIENTS:
+                client.meta.events.unregister("before-call", self._count_aws_call)
+            for cls, name, original in originals:
+                setattr(cls, name, original)
+
+    def _patch_redis_and_acme(self):
+        counts = self.counts
+        originals = [
+            (Redis, "execute_command", Redis.execute_command),
+            (Pipeline, "execute", Pipeline.execute),
+            (ClientNetwork, "_send_request", ClientNetwork._send_request),
+        ]
+        redis_execute_command = Redis.execute_command
+        pipeline_execute = Pipeline.execute
+        send_request = ClientNetwork._send_request
+
+        def execute_command(self, *args, **options):
+            counts["redis"] += 1
+            return redis_execute_command(self, *args, **options)
+
+        def execute(self, *args, **kwargs):
+            counts["redis"] += len(self.command_stack)
+            return pipeline_execute(self, *args, **kwargs)
+
+        def _send_request(self, *args, **kwargs):
+            counts["acme"] += 1
+            return send_request(self, *args, **kwargs)
+
+        Redis.execute_command = execute_command
+        Pipeline.execute = execute
+        ClientNetwork._send_request = _send_request
+        return originals
+
+    def _count_query(self, *args, **kwargs):
+        self.counts["queries"] += 1
+
+    def _count_aws_call(self, *args, **kwargs):
+        self.counts["aws"] += 1
+
+    def _start_step(self, task):
+        self._step_start = (time.perf_counter(), self.counts.copy())
+
+    def _end_step(self, task, task_value, exc):
+        start, start_counts = self._step_start
+        step = dict(task=task.name)
+        step.update(self._measurement(start, start_counts))
+        self._steps.append(step)
+
+    def _measurement(self, start, start_counts):
+        measurement = dict(seconds=round(time.perf_counter() - start, 4))
+        for counter in COUNTERS:
+            measurement[counter] = self.counts[counter] - start_counts[counter]
+        return measurement
+
+    def _write_results(self):
+        _update_json(RESULTS_PATH, self.scenarios)
+        if os.environ.get("BENCHMARK_UPDATE_BASELINE"):
+            _update_json(BASELINE_PATH, self.scenarios)
+
+    def _check(self, name):
+        baseline = _read_json(BASELINE_PATH).get(name)
+        if baseline is None:
+            pytest.skip(
+                f"No baseline for {name}, so nothing to check it against - record "
+                "one with BENCHMARK_UPDATE_BASELINE=1"
+            )
+        regressions = compare(baseline, self.scenarios[name])
+        if regressions:
+            pytest.fail(f"{name} regressed:\n" + "\n".join(regressions))
+
+
+def compare(baseline: dict, current: dict) -> list:
+    """Return descriptions of every step in `current` that regressed or is new"""
+    regressions = []
+    baseline_steps = _steps_by_key(baseline["steps"])
+    current_steps = _steps_by_key(current["steps"])
+    pairs = [
+        (key, baseline_steps.get(key), step) for key, step in current_steps.items()
+    ]
+    pairs.append(("total", baseline["total"], current["total"]))
+    for key, before, after in pairs:
+        if before is None:
+            # a new step has to be added to the baseline on purpose, or it
+            # would never be checked
+            regressions.append(f"  {key}: not in the baseline")
+            continue
+        for counter in COUNTERS:
+            allowed = before[counter] * (1 + MAX_COUNT_REGRESSION)
+            if after[counter] > allowed and after[counter] > before[counter]:
+                regressions.append(
+                    f"  {key}: {counter} went from {before[counter]} to {after[counter]}"
+                )
+        allowed = max(before["seconds"] * (1 + MAX_TIME_REGRESSION), MIN_SECONDS)
+        if after["seconds"] > allowed:
+            regressions.append(
+                f"  {key}: seconds went from {before['seconds']} to {after['seconds']}"
+            )
+    return regressions
+
+
+def _steps_by_key(steps: list) -> dict:
+    # some tasks run more than once in a pipeline (e.g. wait_for_changes)
+    seen = Counter()
+    by_key = {}
+    for step in steps:
+        seen[step["task"]] += 1
+        by_key[f"{step['task']}#{seen[step['task']]}"] = step
+    return by_key
+
+
+def _read_json(path: Path) -> dict:
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def _update_json(path: Path, scenarios: dict):
+    data = _read_json(path)
+    data.update(scenarios)
+    path.write_text(json.dumps(data, indent=2, sort_keys=True) + "\n")
+
+
+@pytest.fixture(scope="session")
+def pipeline_benchmark():
+    if not os.environ.get("RUN_BENCHMARKS"):
+        pytest.skip("set RUN_BENCHMARKS=1 to run benchmarks")
+    return PipelineBenchmark()
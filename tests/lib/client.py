@@ -11,6 +11,38 @@ from werkzeug.datastructures import Headers
 
 from broker.app import create_app, db
 from broker.tasks.huey import huey
+from tests.lib.query_budget import query_budgets_checked
+
+
+SERVICE_ID = "8c16de31-104a-47b0-ba79-25e747be91d6"
+ALB_PLAN_ID = "6f60835c-8964-4f1f-a19a-579fb27ce694"
+CDN_PLAN_ID = "1cc78b0c-c296-48f5-9182-0b38404f79ef"
+MIGRATION_PLAN_ID = "739e78F5-a919-46ef-9193-1293cc086c17"
+
+
+def broker_headers(username="broker", password="sekrit") -> dict:
+    """ The headers the CF API sends with every request to the broker """
+    credentials = f"{username}:{password}".encode()
+    return {
+        "X-Broker-Api-Version": "2.13",
+        "Content-Type": "application/json",
+        "Authorization": "Basic " + base64.b64encode(credentials).decode("ascii"),
+    }
+
+
+def instance_request_body(plan_id: str, params: dict = None) -> dict:
+    """ The body the CF API sends to create or update a service instance """
+    json = {
+        "service_id": SERVICE_ID,
+        "plan_id": plan_id,
+        "organization_guid": "abc",
+        "space_guid": "123",
+    }
+
+    if params is not None:
+        json["parameters"] = params
+
+    return json
 
 
 class CFAPIResponse(Response):
@@ -38,6 +70,7 @@ class CFAPIClient(FlaskClient):
     - injects the right headers
     - adds a `response` attribute
     - uses the CFAPIResponse wrapper for all responses
+    - fails the test if the endpoint goes over its query budget
 
     Use it like such:
 
@@ -48,71 +81,40 @@ class CFAPIClient(FlaskClient):
     """
 
     def open(self, url, *args, **kwargs):
-        auth_header = "Basic " + base64.b64encode(b"broker:sekrit").decode("ascii")
         headers = kwargs.pop("headers", Headers())
-        headers.add_header("X-Broker-Api-Version", "2.13")
-        headers.add_header("Content-Type", "application/json")
-        headers.add_header("Authorization", auth_header)
+        for name, value in broker_headers().items():
+            headers.add_header(name, value)
         kwargs["headers"] = headers
 
-        self.response = super().open(url, *args, **kwargs)
+        with query_budgets_checked():
+            self.response = super().open(url, *args, **kwargs)
 
         return self.response
 
     def provision_cdn_instance(
         self, id: str, accepts_incomplete: str = "true", params: dict = None
     ):
-        json = {
-            "service_id": "8c16de31-104a-47b0-ba79-25e747be91d6",
-            "plan_id": "1cc78b0c-c296-48f5-9182-0b38404f79ef",
-            "organization_guid": "abc",
-            "space_guid": "123",
-        }
-
-        if params is not None:
-            json["parameters"] = params
-
         self.put(
             f"/v2/service_instances/{id}",
-            json=json,
+            json=instance_request_body(CDN_PLAN_ID, params),
             query_string={"accepts_incomplete": accepts_incomplete},
         )
 
     def provision_migration_instance(
         self, id: str, accepts_incomplete: str = "true", params: dict = None
     ):
-        json = {
-            "service_id": "8c16de31-104a-47b0-ba79-25e747be91d6",
-            "plan_id": "739e78F5-a919-46ef-9193-1293cc086c17",
-            "organization_guid": "abc",
-            "space_guid": "123",
-        }
-
-        if params is not None:
-            json["parameters"] = params
-
         self.put(
             f"/v2/service_instances/{id}",
-            json=json,
+            json=instance_request_body(MIGRATION_PLAN_ID, params),
             query_string={"accepts_incomplete": accepts_incomplete},
         )
 
     def update_cdn_instance(
         self, id: str, accepts_incomplete: str = "true", params: dict = None
     ):
-        json = {
-            "service_id": "8c16de31-104a-47b0-ba79-25e747be91d6",
-            "plan_id": "1cc78b0c-c296-48f5-9182-0b38404f79ef",
-            "organization_guid": "abc",
-            "space_guid": "123",
-        }
-
-        if params is not None:
-            json["parameters"] = params
-
         self.patch(
             f"/v2/service_instances/{id}",
-            json=json,
+            json=instance_request_body(CDN_PLAN_ID, params),
             query_string={"accepts_incomplete": accepts_incomplete},
         )
 
@@ -120,8 +122,8 @@ class CFAPIClient(FlaskClient):
         self.delete(
             f"/v2/service_instances/{id}",
             query_string={
-                "service_id": "8c16de31-104a-47b0-ba79-25e747be91d6",
-                "plan_id": "1cc78b0c-c296-48f5-9182-0b38404f79ef",
+                "service_id": SERVICE_ID,
+                "plan_id": CDN_PLAN_ID,
                 "accepts_incomplete": accepts_incomplete,
             },
         )
@@ -129,38 +131,18 @@ class CFAPIClient(FlaskClient):
     def provision_alb_instance(
         self, id: str, accepts_incomplete: str = "true", params: dict = None
     ):
-        json = {
-            "service_id": "8c16de31-104a-47b0-ba79-25e747be91d6",
-            "plan_id": "6f60835c-8964-4f1f-a19a-579fb27ce694",
-            "organization_guid": "abc",
-            "space_guid": "123",
-        }
-
-        if params is not None:
-            json["parameters"] = params
-
         self.put(
             f"/v2/service_instances/{id}",
-            json=json,
+            json=instance_request_body(ALB_PLAN_ID, params),
             query_string={"accepts_incomplete": accepts_incomplete},
         )
 
     def update_alb_instance(
         self, id: str, accepts_incomplete: str = "true", params: dict = None
     ):
-        json = {
-            "service_id": "8c16de31-104a-47b0-ba79-25e747be91d6",
-            "plan_id": "6f60835c-8964-4f1f-a19a-579fb27ce694",
-            "organization_guid": "abc",
-            "space_guid": "123",
-        }
-
-        if params is not None:
-            json["parameters"] = params
-
         self.patch(
             f"/v2/service_instances/{id}",
-            json=json,
+            json=instance_request_body(ALB_PLAN_ID, params),
             query_string={"accepts_incomplete": accepts_incomplete},
         )
 
@@ -168,8 +150,8 @@ class CFAPIClient(FlaskClient):
         self.delete(
             f"/v2/service_instances/{id}",
             query_string={
-                "service_id": "8c16de31-104a-47b0-ba79-25e747be91d6",
-                "plan_id": "6f60835c-8964-4f1f-a19a-579fb27ce694",
+                "service_id": SERVICE_ID,
+                "plan_id": ALB_PLAN_ID,
                 "accepts_incomplete": accepts_incomplete,
             },
         )
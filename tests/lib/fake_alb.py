@@ -66,6 +66,20 @@ class FakeALB(FakeAWS):
             },
         )
 
+    def expect_add_certificate_to_listener_raising_not_found(
+        self, listener_arn, iam_cert_arn
+    ):
+        self.stubber.add_client_error(
+            "add_listener_certificates",
+            service_error_code="CertificateNotFound",
+            service_message="The specified SSL certificate does not exist",
+            http_status_code=400,
+            expected_params={
+                "ListenerArn": listener_arn,
+                "Certificates": [{"CertificateArn": iam_cert_arn}],
+            },
+        )
+
     def expect_remove_certificate_from_listener(self, listener_arn, iam_cert_arn):
         self.stubber.add_response(
             "remove_listener_certificates",
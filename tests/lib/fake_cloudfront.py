@@ -171,6 +171,59 @@ class FakeCloudFront(FakeAWS):
             expected_params={"Id": distribution_id, "IfMatch": "No-ETag"},
         )
 
+    def expect_list_distributions(self, distributions: List[Dict[str, Any]]):
+        """
+        distributions are dicts of id, status, enabled, and optionally
+        certificate_id
+        """
+        items = []
+        for distribution in distributions:
+            config = self._distribution_config(
+                "ignored",
+                [],
+                distribution.get("certificate_id", "ignored"),
+                "origin_hostname",
+                "",
+                distribution["enabled"],
+            )
+            items.append(
+                {
+                    "Id": distribution["id"],
+                    "ARN": f"arn:aws:cloudfront::000000000000:distribution/{distribution['id']}",
+                    "Status": distribution["status"],
+                    "LastModifiedTime": datetime.utcnow(),
+                    "DomainName": "ignored",
+                    "Aliases": config["Aliases"],
+                    "Origins": config["Origins"],
+                    "DefaultCacheBehavior": config["DefaultCacheBehavior"],
+                    "CacheBehaviors": config["CacheBehaviors"],
+                    "CustomErrorResponses": {"Quantity": 0},
+                    "Comment": config["Comment"],
+                    "PriceClass": config["PriceClass"],
+                    "Enabled": distribution["enabled"],
+                    "ViewerCertificate": config["ViewerCertificate"],
+                    "Restrictions": {
+                        "GeoRestriction": {"RestrictionType": "none", "Quantity": 0}
+                    },
+                    "WebACLId": "",
+                    "HttpVersion": "http2",
+                    "IsIPV6Enabled": True,
+                }
+            )
+        self.stubber.add_response(
+            "list_distributions",
+            {
+                "DistributionList": {
+                    "Marker": "",
+                    "MaxItems": 100,
+                    "IsTruncated": False,
+                    "Quantity": len(items),
+                    "Items": items,
+                }
+            },
+            {},
+        )
+
     def expect_get_distribution(
         self,
         caller_reference: str,
@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta, timezone
+import uuid
 
 import pytest
 
@@ -49,6 +50,31 @@ class FakeIAM(FakeAWS):
             },
         )
 
+    def expect_list_server_certificates(
+        self, path_prefix: str, names, uploaded_at: dict = None
+    ):
+        """uploaded_at is upload dates by name, for any not uploaded just now"""
+        uploaded_at = uploaded_at or {}
+        now = datetime.now(timezone.utc)
+        self.stubber.add_response(
+            "list_server_certificates",
+            {
+                "ServerCertificateMetadataList": [
+                    {
+                        "Path": path_prefix,
+                        "ServerCertificateName": name,
+                        # at least 16 characters, like the real ones
+                        "ServerCertificateId": uuid.uuid4().hex.upper(),
+                        "Arn": f"arn:aws:iam::000000000000:server-certificate{path_prefix}{name}",
+                        "UploadDate": uploaded_at.get(name, now),
+                    }
+                    for name in names
+                ],
+                "IsTruncated": False,
+            },
+            {"PathPrefix": path_prefix},
+        )
+
     def expects_delete_server_certificate(self, name: str):
         self.stubber.add_response(
             "delete_server_certificate", {}, {"ServerCertificateName": name}
@@ -63,6 +89,15 @@ class FakeIAM(FakeAWS):
             expected_params={"ServerCertificateName": name},
         )
 
+    def expects_delete_server_certificate_returning_delete_conflict(self, name: str):
+        self.stubber.add_client_error(
+            "delete_server_certificate",
+            service_error_code="DeleteConflict",
+            service_message="Certificate is in use",
+            http_status_code=409,
+            expected_params={"ServerCertificateName": name},
+        )
+
 
 @pytest.fixture(autouse=True)
 def iam_commercial():
@@ -31,53 +31,61 @@ class FakeRoute53(FakeAWS):
         )
         return change_id
 
-    def expect_remove_missing_TXT(self, domain, challenge_text):
-        change_id = f"{domain} ID"
-        self.stubber.add_client_error(
-            "change_resource_record_sets",
-            "InvalidChangeBatch",
-            f"Tried to delete resource record set [name='{domain}', type='A'] but it was not found",
+    def expect_list_zone(self, record_sets):
+        self.stubber.add_response(
+            "list_resource_record_sets",
+            {
+                "ResourceRecordSets": record_sets,
+                "IsTruncated": False,
+                "MaxItems": "300",
+            },
+            {"HostedZoneId": "TestZoneID"},
+        )
+
+    def expect_list_TXT(self, domain, challenge_text=None):
+        record_sets = []
+        if challenge_text is not None:
+            record_sets.append(self._TXT_record_set(domain, challenge_text))
+        self.stubber.add_response(
+            "list_resource_record_sets",
+            {"ResourceRecordSets": record_sets, "IsTruncated": False, "MaxItems": "1"},
             {
-                "ChangeBatch": {
-                    "Changes": [
-                        {
-                            "Action": "DELETE",
-                            "ResourceRecordSet": {
-                                "Name": domain,
-                                "ResourceRecords": [{"Value": f'"{challenge_text}"'}],
-                                "TTL": 60,
-                                "Type": "TXT",
-                            },
-                        }
-                    ]
-                },
                 "HostedZoneId": "TestZoneID",
+                "StartRecordName": domain,
+                "StartRecordType": "TXT",
+                "MaxItems": "1",
             },
         )
 
-    def expect_remove_TXT(self, domain, challenge_text):
-        change_id = f"{domain} ID"
+    def expect_remove_TXT_records(self, challenge_texts_by_domain):
         self.stubber.add_response(
             "change_resource_record_sets",
-            self._change_info(change_id, "PENDING"),
+            self._change_info("ignored", "PENDING"),
             {
                 "ChangeBatch": {
                     "Changes": [
                         {
                             "Action": "DELETE",
-                            "ResourceRecordSet": {
-                                "Name": domain,
-                                "ResourceRecords": [{"Value": f'"{challenge_text}"'}],
-                                "TTL": 60,
-                                "Type": "TXT",
-                            },
+                            "ResourceRecordSet": self._TXT_record_set(
+                                domain, challenge_text
+                            ),
                         }
+                        for domain, challenge_text in challenge_texts_by_domain.items()
                     ]
                 },
                 "HostedZoneId": "TestZoneID",
             },
         )
 
+    def _TXT_record_set(self, domain, challenge_text):
+        # the way Route53 lists them, with the trailing dot
+        return {
+            "Name": f"{domain}.",
+            "Type": "TXT",
+            "TTL": 60,
+            "ResourceRecords": [{"Value": f'"{challenge_text}"'}],
+        }
+
     def expect_create_ALIAS_and_return_change_id(
         self, domain, target, target_hosted_zone_id="Z2FDTNDATAQYW2"
     ) -> str:
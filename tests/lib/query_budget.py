@@ -0,0 +1,117 @@
+"""
+Fails tests when an endpoint or task sends more queries to the database than
+its budget allows, and reports (but doesn't fail) ones that spend longer there
+than their budget's seconds.
+
+Every request made through the test client and every task run through
+`tasks.run_queued_tasks_and_enqueue_dependents` is checked against its budget
+in BUDGETS, or DEFAULT_BUDGET if it doesn't have one. Tests can set a tighter
+(or looser) budget for a code path:
+
+    @pytest.mark.query_budget("open_broker.last_operation", queries=3)
+    def test_last_operation(client):
+        ...
+
+Code paths are named the way broker.instrumentation names them: the Flask
+endpoint for requests, and the task name for tasks.
+"""
+
+from contextlib import contextmanager
+import warnings
+
+import pytest
+
+from broker import instrumentation
+
+# for code paths without a budget of their own. Time in the database depends on
+# the machine running the tests, so it's only reported.
+DEFAULT_BUDGET = dict(queries=40, seconds=0.1)
+
+
+def _with_margin(measured: int) -> int:
+    # room for a query or two more on instances with more domains than the
+    # tests use, without hiding a query per operation or per certificate
+    return measured + max(2, measured // 2)
+
+
+# The most queries each endpoint and pipeline step made in a run of the
+# integration suite. Budgets allow half as many again, and at least two more
+# (see _with_margin). When a change needs more, measure again and update the
+# count in the same change, so the reviewer sees it. Steps that talk to the ACME server aren't listed: they
+# couldn't be measured without one, so they get DEFAULT_BUDGET.
+MEASURED_QUERIES = {
+    # endpoints
+    "open_broker.catalog": 0,
+    "open_broker.last_operation": 2,
+    "open_broker.provision": 5,
+    "open_broker.deprovision": 3,
+    "open_broker.update": 12,
+    # provisioning, renewals and updates
+    "validate_domains": 11,
+    "wait_for_changes": 6,
+    "create_ALIAS_records": 16,
+    "update_complete": 4,
+    # cleaning up after renewals, updates and migrations
+    "remove_s3_bucket_from_cdn_broker_instance": 4,
+    "add_logging_to_bucket": 1,
+    # deprovisioning
+    "cancel_pending_provisioning": 5,
+    "remove_ALIAS_records": 7,
+    "remove_TXT_records": 8,
+    "remove_certificate_from_alb": 4,
+    "disable_distribution": 4,
+    "wait_for_distribution_disabled": 3,
+    "delete_distribution": 3,
+    "delete_server_certificate": 5,
+    "deprovision": 4,
+}
+
+BUDGETS = {
+    path: dict(DEFAULT_BUDGET, queries=_with_margin(queries))
+    for path, queries in MEASURED_QUERIES.items()
+}
+
+_budgets = {}
+
+
+def budget_for(path: str) -> dict:
+    return _budgets.get(path) or BUDGETS.get(path, DEFAULT_BUDGET)
+
+
+def check_query_budgets(stats: dict):
+    overspent = []
+    for path, spent in stats.items():
+        if path is None:
+            # test setup and assertions
+            continue
+        budget = budget_for(path)
+        if spent["queries"] > budget["queries"]:
+            overspent.append(
+                f"  {path}: {spent['queries']} queries (budget {budget['queries']})"
+            )
+        if spent["seconds"] > budget["seconds"]:
+            warnings.warn(
+                f"{path}: {spent['seconds']:.3f}s in the database "
+                f"(budget {budget['seconds']}s)"
+            )
+    if overspent:
+        pytest.fail("Query budget exceeded:\n" + "\n".join(overspent))
+
+
+@contextmanager
+def query_budgets_checked():
+    """Check the query budget of every code path run inside this block"""
+    with instrumentation.recording() as stats:
+        yield stats
+    check_query_budgets(stats)
+
+
+@pytest.fixture(autouse=True)
+def query_budgets(request):
+    for marker in request.node.iter_markers("query_budget"):
+        path = marker.args[0]
+        # the closest marker wins
+        if path not in _budgets:
+            _budgets[path] = dict(BUDGETS.get(path, DEFAULT_BUDGET), **marker.kwargs)
+    yield _budgets
+    _budgets.clear()
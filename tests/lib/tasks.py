@@ -4,7 +4,8 @@ import pytest
 from huey import Huey
 from huey import signals as S
 
-from broker.tasks.huey import huey, create_app
+from broker.tasks.huey import huey, flask_app
+from tests.lib.query_budget import query_budgets_checked
 
 
 @huey.signal(S.SIGNAL_ERROR)
@@ -56,10 +57,11 @@ class Tasks:
         but does not execute them.  This is useful for stepping through
         pipeline stages in your tests.
 
-        Will fail the test if there's not at least a single Task to be run.
+        Will fail the test if there's not at least a single Task to be run,
+        or if a Task goes over its query budget (see tests.lib.query_budget).
         """
         # __tracebackhide__ = True
-        create_app()
+        flask_app()
 
         currently_queued_tasks = []
 
@@ -73,7 +75,8 @@ class Tasks:
 
         for task in currently_queued_tasks:
             print(f"Executing Task {task.name}")
-            huey.execute(task, None)
+            with query_budgets_checked():
+                huey.execute(task, None)
 
 
 @pytest.fixture(scope="function")
@@ -0,0 +1,67 @@
+import socket
+import threading
+import time
+
+import dns.message
+import dns.rdatatype
+import dns.rrset
+
+
+class DNSStandIn:
+    """
+    I'm a tiny DNS server that says every _acme-challenge CNAME is set up
+    correctly, after waiting `delay` seconds. This lets the load harness make
+    provision requests without registering anything with pebble-challtestsrv,
+    and lets us pretend customers' DNS servers are slow.
+    """
+
+    def __init__(self, root_domain: str, delay: float = 0.0, host="127.0.0.1"):
+        self.root_domain = root_domain
+        self.delay = delay
+        self.queries = 0
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((host, 0))
+        self._running = False
+
+    @property
+    def address(self) -> str:
+        host, port = self._socket.getsockname()
+        return f"{host}:{port}"
+
+    def start(self):
+        self._running = True
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def stop(self):
+        self._running = False
+        self._socket.close()
+
+    def _serve(self):
+        while self._running:
+            try:
+                data, client = self._socket.recvfrom(512)
+            except OSError:
+                return
+            # answer from another thread, so slow answers don't hold up the others
+            threading.Thread(target=self._answer, args=(data, client)).start()
+
+    def _answer(self, data, client):
+        self.queries += 1
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        name = question.name.to_text(omit_final_dot=True)
+        if question.rdtype == dns.rdatatype.CNAME and name.startswith(
+            "_acme-challenge."
+        ):
+            response.answer.append(
+                dns.rrset.from_text(
+                    question.name, 60, "IN", "CNAME", f"{name}.{self.root_domain}."
+                )
+            )
+        time.sleep(self.delay)
+        try:
+            self._socket.sendto(response.to_wire(), client)
+        except OSError:
+            # we were stopped while waiting
+            pass
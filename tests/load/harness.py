@@ -0,0 +1,329 @@
+"""
+Load test the broker's HTTP API the way Cloud Controller uses it: steady
+last_operation polling across thousands of operations, with bursts of
+provision requests mixed in. Each combination of gunicorn worker class and
+worker count gets a fresh server, and we report throughput and latency
+percentiles per endpoint.
+
+Run it from the docker dev environment (it needs postgres and redis):
+
+    python -m tests.load.harness --worker-classes sync,gthread --workers 1,4
+
+This wipes the huey queue when it's done, so don't point it at a database or
+Redis you care about.
+"""
+import argparse
+from collections import defaultdict
+from dataclasses import dataclass, field
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List
+
+os.environ.setdefault("FLASK_ENV", "local-development")
+
+import flask_migrate  # noqa: E402
+import requests  # noqa: E402
+
+from broker.app import create_app  # noqa: E402
+from broker.extensions import config, db  # noqa: E402
+from broker.models import DomainReservation, Operation, ServiceInstance  # noqa: E402
+from broker.tasks.huey import huey  # noqa: E402
+from tests.lib.client import (  # noqa: E402
+    ALB_PLAN_ID,
+    broker_headers,
+    instance_request_body,
+)
+from tests.load.dns_stand_in import DNSStandIn  # noqa: E402
+
+INSTANCE_PREFIX = "load-"
+
+
+@dataclass
+class Results:
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    errors: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def record(self, endpoint: str, seconds: float, ok: bool):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    # nearest-rank
+    index = max(0, int(round(percent / 100 * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+def summarize(results: Results, duration: float) -> Dict[str, dict]:
+    summary = {}
+    for endpoint, latencies in sorted(results.latencies.items()):
+        latencies = sorted(latencies)
+        summary[endpoint] = dict(
+            requests=len(latencies),
+            errors=results.errors[endpoint],
+            requests_per_second=round(len(latencies) / duration, 1),
+            p50_ms=round(percentile(latencies, 50) * 1000, 1),
+            p90_ms=round(percentile(latencies, 90) * 1000, 1),
+            p99_ms=round(percentile(latencies, 99) * 1000, 1),
+            max_ms=round(latencies[-1] * 1000, 1),
+        )
+    return summary
+
+
+def remove_load_instances():
+    like = f"{INSTANCE_PREFIX}%"
+    DomainReservation.query.filter(
+        DomainReservation.service_instance_id.like(like)
+    ).delete(synchronize_session=False)
+    Operation.query.filter(Operation.service_instance_id.like(like)).delete(
+        synchronize_session=False
+    )
+    ServiceInstance.query.filter(ServiceInstance.id.like(like)).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+
+
+def seed_operations(count: int) -> List[tuple]:
+    """ Create `count` instances with an in-progress operation each, for polling """
+    remove_load_instances()
+    instance_ids = [f"{INSTANCE_PREFIX}seed-{n}" for n in range(count)]
+    db.session.execute(
+        ServiceInstance.__table__.insert(),
+        [
+            dict(
+                id=id,
+                instance_type="alb_service_instance",
+                domain_names=[f"{id}.example.com"],
+            )
+            for id in instance_ids
+        ],
+    )
+    db.session.execute(
+        Operation.__table__.insert(),
+        [
+            dict(
+                service_instance_id=id,
+                action=Operation.Actions.PROVISION.value,
+                state=Operation.States.IN_PROGRESS.value,
+                step_description="Waiting for DNS changes",
+            )
+            for id in instance_ids
+        ],
+    )
+    db.session.commit()
+    return [
+        (operation.service_instance_id, operation.id)
+        for operation in Operation.query.filter(
+            Operation.service_instance_id.in_(instance_ids)
+        )
+    ]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(worker_class: str, workers: int, threads: int, dns_address: str):
+    port = free_port()
+    command = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "--bind",
+        f"127.0.0.1:{port}",
+        "--worker-class",
+        worker_class,
+        "--workers",
+        str(workers),
+        "--threads",
+        str(threads),
+        "broker.app:create_app()",
+    ]
+    env = dict(os.environ, DNS_VERIFICATION_SERVER=dns_address)
+    server = subprocess.Popen(
+        command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {server.returncode}")
+        try:
+            requests.get(f"{base}/ping", timeout=1).raise_for_status()
+            return server, base
+        except requests.RequestException:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start in 30 seconds")
+
+
+def poll(base, operations, results, stop):
+    session = requests.Session()
+    session.headers.update(broker_headers())
+    while not stop.is_set():
+        instance_id, operation_id = random.choice(operations)
+        start = time.perf_counter()
+        try:
+            response = session.get(
+                f"{base}/v2/service_instances/{instance_id}/last_operation",
+                params={"operation": operation_id},
+                timeout=60,
+            )
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        results.record("last_operation", time.perf_counter() - start, ok)
+
+
+def provision(base, instance_id, results):
+    start = time.perf_counter()
+    try:
+        response = requests.put(
+            f"{base}/v2/service_instances/{instance_id}",
+            params={"accepts_incomplete": "true"},
+            headers=broker_headers(),
+            json=instance_request_body(
+                ALB_PLAN_ID, {"domains": f"{instance_id}.example.com"}
+            ),
+            timeout=60,
+        )
+        ok = response.status_code == 202
+    except requests.RequestException:
+        ok = False
+    results.record("provision", time.perf_counter() - start, ok)
+
+
+def provision_bursts(base, run_name, burst_size, interval, results, stop):
+    burst = 0
+    while not stop.wait(0 if burst == 0 else interval):
+        threads = [
+            threading.Thread(
+                target=provision,
+                args=(base, f"{INSTANCE_PREFIX}{run_name}-{burst}-{n}", results),
+            )
+            for n in range(burst_size)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        burst += 1
+
+
+def run(args, worker_class, workers, operations, dns_address):
+    run_name = f"{worker_class}-{workers}"
+    server, base = start_server(worker_class, workers, args.threads, dns_address)
+    results = Results()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=poll, args=(base, operations, results, stop))
+        for _ in range(args.pollers)
+    ]
+    threads.append(
+        threading.Thread(
+            target=provision_bursts,
+            args=(base, run_name, args.burst_size, args.burst_interval, results, stop),
+        )
+    )
+    try:
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - start
+    finally:
+        server.terminate()
+        server.wait()
+    return summarize(results, duration)
+
+
+def print_report(report):
+    columns = ["requests", "errors", "requests_per_second", "p50_ms", "p90_ms"]
+    columns += ["p99_ms", "max_ms"]
+    header = ["worker class", "workers", "endpoint"] + columns
+    print("\t".join(header))
+    for run_report in report:
+        for endpoint, stats in run_report["endpoints"].items():
+            row = [run_report["worker_class"], run_report["workers"], endpoint]
+            row += [stats[column] for column in columns]
+            print("\t".join(str(value) for value in row))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--worker-classes", default="sync,gthread")
+    parser.add_argument("--workers", default="1,4")
+    parser.add_argument(
+        "--threads", type=int, default=4, help="threads per gthread worker"
+    )
+    parser.add_argument("--duration", type=float, default=30, help="seconds per run")
+    parser.add_argument(
+        "--operations", type=int, default=2000, help="operations to poll"
+    )
+    parser.add_argument(
+        "--pollers", type=int, default=20, help="concurrent last_operation pollers"
+    )
+    parser.add_argument("--burst-size", type=int, default=10)
+    parser.add_argument("--burst-interval", type=float, default=5, help="seconds")
+    parser.add_argument(
+        "--dns-delay",
+        type=float,
+        default=0.2,
+        help="seconds the DNS stand-in waits before each answer",
+    )
+    parser.add_argument("--json", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    dns_server = DNSStandIn(config.DNS_ROOT_DOMAIN, delay=args.dns_delay)
+    dns_server.start()
+    app = create_app()
+    report = []
+    with app.app_context():
+        flask_migrate.upgrade()
+        operations = seed_operations(args.operations)
+        try:
+            for worker_class in args.worker_classes.split(","):
+                for workers in [int(w) for w in args.workers.split(",")]:
+                    print(f"Running {worker_class} with {workers} workers")
+                    endpoints = run(
+                        args, worker_class, workers, operations, dns_server.address
+                    )
+                    report.append(
+                        dict(
+                            worker_class=worker_class,
+                            workers=workers,
+                            endpoints=endpoints,
+                        )
+                    )
+        finally:
+            # nothing is going to work the provisions we queued
+            huey.flush()
+            remove_load_instances()
+            dns_server.stop()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
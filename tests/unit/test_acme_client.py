@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import threading
+import time
+from types import SimpleNamespace
+
+from acme import challenges
+import pytest
+
+from broker.acme_client import in_parallel, retry_after_seconds
+from broker.extensions import config
+from broker.tasks.letsencrypt import (
+    ChallengeNotFound,
+    authorizations_by_domain,
+    dns_challenge,
+)
+
+
+def authorization(domain, *challs):
+    return SimpleNamespace(
+        body=SimpleNamespace(
+            identifier=SimpleNamespace(value=domain),
+            challenges=[SimpleNamespace(chall=chall) for chall in challs],
+        )
+    )
+
+
+def test_in_parallel_returns_results_in_order():
+    def fn(n):
+        if n == 2:
+            raise ValueError("two")
+        time.sleep(0.01 * (5 - n))
+        return n * 10
+
+    results = in_parallel(fn, range(5))
+
+    assert [item for item, _, _ in results] == [0, 1, 2, 3, 4]
+    assert [result for _, result, _ in results] == [0, 10, None, 30, 40]
+    assert isinstance(results[2][2], ValueError)
+    assert [e for _, _, e in results if e is not None] == [results[2][2]]
+
+
+def test_in_parallel_limits_concurrency(monkeypatch):
+    monkeypatch.setattr(config, "ACME_MAX_CONCURRENT_REQUESTS", 2)
+    lock = threading.Lock()
+    running = []
+    most_running = []
+
+    def fn(n):
+        with lock:
+            running.append(n)
+            most_running.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(n)
+
+    in_parallel(fn, range(6))
+
+    assert max(most_running) == 2
+
+
+def test_dns_challenge_picks_the_domains_dns_challenge():
+    dns01 = challenges.DNS01(token=b"a" * 16)
+    order = SimpleNamespace(
+        authorizations=[
+            authorization("foo.com", challenges.HTTP01(token=b"b" * 16)),
+            authorization("bar.com", challenges.HTTP01(token=b"c" * 16), dns01),
+        ]
+    )
+
+    authorizations = authorizations_by_domain(order)
+
+    assert dns_challenge(authorizations, "bar.com").chall is dns01
+    with pytest.raises(ChallengeNotFound):
+        dns_challenge(authorizations, "baz.com")
+
+
+@pytest.mark.parametrize(
+    "headers,expected",
+    [
+        ({}, 1),
+        ({"Retry-After": "30"}, 30),
+        ({"Retry-After": "-5"}, 0),
+        ({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0),
+        ({"Retry-After": "soon"}, 1),
+    ],
+)
+def test_retry_after_seconds(headers, expected):
+    response = SimpleNamespace(headers=headers)
+
+    assert retry_after_seconds(response) == expected
+
+
+def test_retry_after_seconds_from_a_date():
+    when = datetime.now(timezone.utc) + timedelta(seconds=60)
+    response = SimpleNamespace(headers={"Retry-After": format_datetime(when)})
+
+    assert 55 < retry_after_seconds(response) <= 60
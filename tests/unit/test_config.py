@@ -208,3 +208,22 @@ def test_config_fixes_db_uri(env, monkeypatch, mocked_env, dburl_in):
     config = config_from_env()
 
     assert config.SQLALCHEMY_DATABASE_URI == "postgresql://mydb"
+
+
+@pytest.mark.parametrize("env", ["production", "staging", "development"])
+def test_config_has_no_replica_by_default(env, monkeypatch, mocked_env):
+    monkeypatch.setenv("FLASK_ENV", env)
+
+    config = config_from_env()
+
+    assert config.SQLALCHEMY_BINDS == {}
+
+
+@pytest.mark.parametrize("env", ["production", "staging", "development"])
+def test_config_binds_replica_from_env(env, monkeypatch, mocked_env):
+    monkeypatch.setenv("FLASK_ENV", env)
+    monkeypatch.setenv("DATABASE_REPLICA_URL", "postgres://myreplica")
+
+    config = config_from_env()
+
+    assert config.SQLALCHEMY_BINDS == {"replica": "postgresql://myreplica"}
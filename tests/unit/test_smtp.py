@@ -0,0 +1,36 @@
+from broker.smtp import build_failed_operations_digest
+
+
+def alert(operation_id, step, instance_type="cdn_service_instance"):
+    return dict(
+        operation_id=operation_id,
+        action="Provision",
+        step_description=step,
+        service_instance_id=f"instance-{operation_id}",
+        instance_type=instance_type,
+    )
+
+
+def test_digest_groups_failures_by_step_and_instance_type():
+    subject, body = build_failed_operations_digest(
+        [
+            alert(1, "Creating CloudFront distribution"),
+            alert(2, "Uploading SSL certificate to AWS", "alb_service_instance"),
+            alert(3, "Creating CloudFront distribution"),
+        ]
+    )
+
+    assert "3 pipelines failed" in subject
+    assert "2 failed at: Creating CloudFront distribution" in body
+    assert "1 failed at: Uploading SSL certificate to AWS" in body
+    # biggest group first
+    assert body.index("CloudFront") < body.index("Uploading")
+    for operation_id in [1, 2, 3]:
+        assert f"service instance id: instance-{operation_id}" in body
+
+
+def test_digest_for_one_failure_keeps_original_subject():
+    subject, body = build_failed_operations_digest([alert(1, "Creating user")])
+
+    assert subject.endswith("external-domain-broker pipeline failed")
+    assert "operation id: 1," in body